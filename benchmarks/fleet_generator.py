@@ -0,0 +1,79 @@
+import hashlib
+import random
+
+'''
+Synthetic ECS fleet and base image policy generator for the benchmarks.
+
+The fleet mirrors what we see in real accounts: a few hundred distinct images shared across many task replicas,
+most tasks running 1-4 containers, a handful of very large clusters and a long tail of small ones.
+'''
+
+REGISTRY = "99999999.dkr.ecr.us-east-1.amazonaws.com"
+BASE_FAMILIES = ["14.17.6_{0}-slim", "{0}", "3.9_{0}-bullseye"]
+
+
+def _base_tag(rng) -> str:
+    # base tags are dated builds e.g. 2021.09.25
+    date = "{0}.{1:02d}.{2:02d}".format(rng.randint(2020, 2023), rng.randint(1, 12), rng.randint(1, 28))
+    return rng.choice(BASE_FAMILIES).format(date)
+
+
+def generate_images(image_count, seed = 1) -> list:
+    rng = random.Random(seed)
+    images = []
+    for i in range(image_count):
+        repo = "{0}/team{1}/app{2}".format(REGISTRY, i % 25, i)
+        images.append("{0}:{1}.{2}.{3}_base-{4}".format(repo, rng.randint(1, 5), rng.randint(0, 20), rng.randint(0, 99), _base_tag(rng)))
+    return images
+
+
+def generate_fleet(cluster_count = 100, task_count = 10000, max_containers_per_task = 4, image_count = 300,
+        account_id = "123456789012", region = "us-east-1", seed = 1) -> dict:
+    """
+        Build a fleet as { cluster_arn: [task_description, ...] } where task descriptions look like describe_tasks output.
+        Tasks are spread over clusters with a skewed (pareto) distribution so a few clusters are very large.
+    """
+    rng = random.Random(seed)
+    images = generate_images(image_count, seed)
+    cluster_arns = ["arn:aws:ecs:{0}:{1}:cluster/cluster{2}".format(region, account_id, i) for i in range(cluster_count)]
+    weights = [rng.paretovariate(1.2) for _ in cluster_arns]
+    fleet = { a_cluster_arn: [] for a_cluster_arn in cluster_arns }
+
+    for task_index, cluster_arn in enumerate(rng.choices(cluster_arns, weights = weights, k = task_count)):
+        service_index = rng.randint(0, 50)
+        task_arn = "arn:aws:ecs:{0}:{1}:task/{2}/{3:032x}".format(region, account_id, cluster_arn.rsplit('/', 1)[1], task_index)
+        containers = []
+        for container_index in range(rng.randint(1, max_containers_per_task)):
+            image = rng.choice(images)
+            containers.append({
+                'name': "container{0}".format(container_index),
+                'image': image,
+                'imageDigest': "sha256:" + hashlib.sha256(image.encode('utf-8')).hexdigest()
+            })
+        fleet[cluster_arn].append({
+            'taskArn': task_arn,
+            'group': "service:svc{0}".format(service_index),
+            'clusterArn': cluster_arn,
+            'lastStatus': 'STOPPED',
+            'containers': containers
+        })
+    return fleet
+
+
+def generate_policy_csv(entry_count = 100, seed = 1) -> str:
+    """
+        Build a valid base images csv with entry_count entries, mostly exact tags plus some globs and version ranges
+    """
+    rng = random.Random(seed)
+    lines = ["image_tag,image_type"]
+    for i in range(entry_count):
+        kind = i % 10
+        if kind == 8:
+            entry = "{0}.{1:02d}.*".format(rng.randint(2020, 2023), rng.randint(1, 12))
+        elif kind == 9:
+            year = rng.randint(2020, 2023)
+            entry = "{0}.01.01..{0}.{1:02d}.28".format(year, rng.randint(1, 12))
+        else:
+            entry = _base_tag(rng)
+        lines.append('"{0}","type{1}"'.format(entry, i % 5))
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,137 @@
+import hashlib
+import io
+import threading
+import time
+from collections import Counter
+
+'''
+In-process stand-ins for the ECS and S3 endpoints the scanner talks to. They implement just the operations ecshelpers uses,
+with the same request/response shapes, paging and limits as the real APIs plus an optional per call latency so the
+benefits of concurrency show up in the numbers.
+'''
+
+PAGE_SIZE = 100
+
+
+class localEndpoint:
+    def __init__(self, latency_seconds = 0.0) -> None:
+        self.latency_seconds = latency_seconds
+        self.call_counts = Counter()
+        self._lock = threading.Lock()
+
+    def _call(self, operation_name) -> None:
+        with self._lock:
+            self.call_counts[operation_name] += 1
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+
+
+def _page(items, next_token, page_size = PAGE_SIZE) -> tuple:
+    start = int(next_token) if next_token else 0
+    end = start + page_size
+    return items[start:end], (str(end) if end < len(items) else None)
+
+
+class localEcsClient(localEndpoint):
+    ''' Serves a fleet from fleet_generator.generate_fleet ({ cluster_arn: [task_description] }).'''
+
+    def __init__(self, fleet, latency_seconds = 0.0) -> None:
+        super().__init__(latency_seconds)
+        self.fleet = fleet
+        self.cluster_arns = list(fleet.keys())
+        self.cluster_names = { a_cluster_arn.rsplit('/', 1)[1]: a_cluster_arn for a_cluster_arn in self.cluster_arns }
+        self.tasks_by_arn = { a_task['taskArn']: a_task for tasks in fleet.values() for a_task in tasks }
+
+    def _cluster_arn(self, cluster) -> str:
+        return self.cluster_names.get(cluster, cluster)
+
+    def list_clusters(self, nextToken = None, **kwargs) -> dict:
+        self._call('list_clusters')
+        page, next_token = _page(self.cluster_arns, nextToken)
+        response = { 'clusterArns': page }
+        if next_token:
+            response['nextToken'] = next_token
+        return response
+
+    def list_tasks(self, cluster, desiredStatus = None, nextToken = None, **kwargs) -> dict:
+        self._call('list_tasks')
+        task_arns = [a_task['taskArn'] for a_task in self.fleet.get(self._cluster_arn(cluster), [])]
+        page, next_token = _page(task_arns, nextToken)
+        response = { 'taskArns': page }
+        if next_token:
+            response['nextToken'] = next_token
+        return response
+
+    def describe_tasks(self, cluster, tasks, **kwargs) -> dict:
+        self._call('describe_tasks')
+        if len(tasks) > PAGE_SIZE:
+            raise ValueError("describe_tasks accepts at most {0} tasks".format(PAGE_SIZE))
+        found = [self.tasks_by_arn[a_task_arn] for a_task_arn in tasks if a_task_arn in self.tasks_by_arn]
+        failures = [{ 'arn': a_task_arn, 'reason': 'MISSING' } for a_task_arn in tasks if a_task_arn not in self.tasks_by_arn]
+        return { 'tasks': found, 'failures': failures }
+
+    def describe_clusters(self, clusters, **kwargs) -> dict:
+        self._call('describe_clusters')
+        return { 'clusters': [{ 'clusterName': a_cluster.rsplit('/', 1)[-1], 'clusterArn': self._cluster_arn(a_cluster) } for a_cluster in clusters] }
+
+
+class localS3Client(localEndpoint):
+    ''' Keeps objects in memory, supports get/put/list and multipart uploads.'''
+
+    def __init__(self, objects = None, latency_seconds = 0.0) -> None:
+        super().__init__(latency_seconds)
+        self.objects = objects if objects is not None else {}
+        self.content_encodings = {}
+        self.uploads = {}
+
+    def get_object(self, Bucket, Key, **kwargs) -> dict:
+        self._call('get_object')
+        body = self.objects[(Bucket, Key)]
+        response = { 'Body': io.BytesIO(body), 'ETag': '"{0}"'.format(hashlib.md5(body).hexdigest()), 'ContentLength': len(body) }
+        if (Bucket, Key) in self.content_encodings:
+            response['ContentEncoding'] = self.content_encodings[(Bucket, Key)]
+        return response
+
+    def put_object(self, Bucket, Key, Body, ContentEncoding = None, **kwargs) -> dict:
+        self._call('put_object')
+        self.objects[(Bucket, Key)] = Body if isinstance(Body, bytes) else Body.encode('utf-8')
+        self._set_encoding(Bucket, Key, ContentEncoding)
+        return {}
+
+    def _set_encoding(self, bucket, key, content_encoding) -> None:
+        if content_encoding:
+            self.content_encodings[(bucket, key)] = content_encoding
+        else:
+            self.content_encodings.pop((bucket, key), None)
+
+    def list_objects_v2(self, Bucket, Prefix = '', ContinuationToken = None, **kwargs) -> dict:
+        self._call('list_objects_v2')
+        keys = sorted(a_key for a_bucket, a_key in list(self.objects) if a_bucket == Bucket and a_key.startswith(Prefix))
+        page, next_token = _page(keys, ContinuationToken, page_size = 1000)
+        response = { 'Contents': [{ 'Key': a_key } for a_key in page], 'IsTruncated': next_token is not None }
+        if next_token:
+            response['NextContinuationToken'] = next_token
+        return response
+
+    def create_multipart_upload(self, Bucket, Key, ContentEncoding = None, **kwargs) -> dict:
+        self._call('create_multipart_upload')
+        upload_id = str(len(self.uploads) + 1)
+        self.uploads[upload_id] = {}
+        self._set_encoding(Bucket, Key, ContentEncoding)
+        return { 'UploadId': upload_id }
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs) -> dict:
+        self._call('upload_part')
+        self.uploads[UploadId][PartNumber] = Body
+        return { 'ETag': '"part{0}"'.format(PartNumber) }
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs) -> dict:
+        self._call('complete_multipart_upload')
+        parts = self.uploads.pop(UploadId)
+        self.objects[(Bucket, Key)] = b''.join(parts[a_part['PartNumber']] for a_part in MultipartUpload['Parts'])
+        return {}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs) -> dict:
+        self._call('abort_multipart_upload')
+        self.uploads.pop(UploadId, None)
+        return {}
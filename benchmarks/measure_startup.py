@@ -0,0 +1,68 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+'''
+Startup measurement harness for the Lambda handlers in ecshelpers.
+
+Each run starts a fresh python process (like a Lambda cold start) and reports
+* import_ms: time to import the handler module (and everything it imports, e.g. boto3)
+* init_ms: time for the handler's init_clients() (session/client construction)
+* warm_init_ms: a second init_clients() call, which should be ~0 since clients are reused
+
+Usage:
+    python benchmarks/measure_startup.py --runs 5
+'''
+
+HANDLERS = ['ecs_reader', 'base_image_finder']
+ECSHELPERS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ecshelpers')
+
+_CHILD_SCRIPT = '''
+import importlib, json, sys, time
+sys.path.insert(0, {ecshelpers_dir!r})
+start = time.perf_counter()
+module = importlib.import_module({handler!r})
+imported = time.perf_counter()
+module.init_clients()
+initialized = time.perf_counter()
+module.init_clients()
+warm = time.perf_counter()
+print(json.dumps({{
+    'import_ms': (imported - start) * 1000,
+    'init_ms': (initialized - imported) * 1000,
+    'warm_init_ms': (warm - initialized) * 1000
+}}))
+'''
+
+
+def measure_handler(handler, runs) -> dict:
+    env = dict(os.environ)
+    # clients need a region to be constructed, no AWS calls are made
+    env.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    samples = []
+    for _ in range(runs):
+        script = _CHILD_SCRIPT.format(ecshelpers_dir = ECSHELPERS_DIR, handler = handler)
+        output = subprocess.run([sys.executable, '-c', script], env = env, check = True, capture_output = True, text = True).stdout
+        samples.append(json.loads(output.strip().splitlines()[-1]))
+
+    return { a_metric: statistics.median(a_sample[a_metric] for a_sample in samples) for a_metric in samples[0] }
+
+
+def main(argv = None) -> None:
+    parser = argparse.ArgumentParser(description = 'Measure cold start import and init time for the ecshelpers handlers')
+    parser.add_argument('--runs', type = int, default = 5, help = 'fresh processes per handler (median is reported)')
+    parser.add_argument('--handler', action = 'append', help = 'handler module to measure (default: all)')
+    args = parser.parse_args(argv)
+
+    results = { a_handler: measure_handler(a_handler, args.runs) for a_handler in (args.handler or HANDLERS) }
+    for a_handler, metrics in results.items():
+        print("{0:<20} import {1:8.1f} ms  init {2:8.1f} ms  warm init {3:6.2f} ms".format(
+            a_handler, metrics['import_ms'], metrics['init_ms'], metrics['warm_init_ms']))
+    print(json.dumps(results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, '..', 'ecshelpers'))
+sys.path.insert(0, BENCHMARKS_DIR)
+
+from ecs_utils import ecsUtils
+from docker_image_analyzer import dockerImageAnalyzer, clear_base_image_cache
+from ecs_reader import write_results_to_s3, REPORT_FIELD_NAMES
+from s3_report_writer import s3ReportWriter
+from scan_pipeline import scan_records, run_pipeline
+from rate_limiter import adaptiveRateLimiter
+from scan_metrics import metricsCollector
+from fleet_generator import generate_fleet, generate_policy_csv
+from local_endpoints import localEcsClient, localS3Client
+
+'''
+Benchmark suite for the ECS scan. Generates a synthetic fleet, serves it through the local ECS/S3 stand-ins and runs each
+stage of the scan (discovery, task scan, classification, report upload), reporting throughput, time per stage, API call
+counts and peak (python heap) memory.
+
+Usage:
+    python benchmarks/run_benchmarks.py --profile medium --save medium-baseline
+    python benchmarks/run_benchmarks.py --profile medium --compare benchmarks/results/medium-baseline.json
+'''
+
+PROFILES = {
+    'small': { 'clusters': 20, 'tasks': 1000, 'containers': 3, 'images': 100, 'policy_entries': 50 },
+    'medium': { 'clusters': 500, 'tasks': 20000, 'containers': 4, 'images': 300, 'policy_entries': 1000 },
+    'large': { 'clusters': 2000, 'tasks': 50000, 'containers': 4, 'images': 500, 'policy_entries': 5000 },
+}
+RESULTS_DIR = os.path.join(BENCHMARKS_DIR, 'results')
+BUCKET_NAME = 'benchmark-bucket'
+POLICY_KEY = 'validBaseImages.csv'
+REPORT_KEY = 'scanResults.csv'
+
+
+def _timed(stages, stage_name, fn):
+    start = time.perf_counter()
+    result = fn()
+    stages[stage_name] = time.perf_counter() - start
+    return result
+
+
+def run_benchmark(clusters, tasks, containers, images, policy_entries, workers = 8, api_latency_ms = 0.0, seed = 1, mode = 'lists',
+        api_rate = None) -> dict:
+    """
+        mode 'lists' runs each stage to completion (list of rows between stages), 'pipeline' streams records through
+        scan_pipeline straight into the report writer (the scan/classification/upload stages overlap so they're reported as one)
+        api_rate limits ECS calls per second through the adaptive rate limiter (None = unlimited, the stand-ins never throttle)
+    """
+    fleet = generate_fleet(clusters, tasks, containers, images, seed = seed)
+    ecs_client = localEcsClient(fleet, latency_seconds = api_latency_ms / 1000.0)
+    s3_client = localS3Client({ (BUCKET_NAME, POLICY_KEY): generate_policy_csv(policy_entries, seed).encode('utf-8') },
+        latency_seconds = api_latency_ms / 1000.0)
+    rate_limiter = adaptiveRateLimiter(rate = api_rate)
+    metrics = metricsCollector()
+    utils_instance = ecsUtils(False, max_workers = workers, ecs_client = ecs_client, rate_limiter = rate_limiter, metrics = metrics)
+    analyzer = dockerImageAnalyzer(False)
+    clear_base_image_cache()
+
+    stages = {}
+    tracemalloc.start()
+    total_start = time.perf_counter()
+
+    policy = _timed(stages, 'policy', lambda: analyzer.get_base_image_policy(BUCKET_NAME, POLICY_KEY, s3_client))
+    cluster_arns = _timed(stages, 'discovery', utils_instance.get_cluster_arns)
+    if mode == 'pipeline':
+        def stream():
+            with s3ReportWriter(BUCKET_NAME, REPORT_KEY, REPORT_FIELD_NAMES, s3_client = s3_client) as report_writer:
+                return run_pipeline(scan_records(utils_instance, analyzer, policy, cluster_arns, 'STOPPED', max_workers = workers), report_writer, metrics)
+        row_count = _timed(stages, 'scan+classify+upload', stream)
+    else:
+        rows = _timed(stages, 'scan', lambda: utils_instance.get_image_info_for_all_clusters('STOPPED', cluster_arns, workers))
+
+        def classify():
+            results = analyzer.classify_images((a_row['image'] for a_row in rows), policy)
+            for a_row, result in zip(rows, results):
+                a_row['validBaseImage'] = result
+        _timed(stages, 'classification', classify)
+        _timed(stages, 'upload', lambda: write_results_to_s3(rows, BUCKET_NAME, REPORT_KEY, s3_client = s3_client))
+        row_count = len(rows)
+
+    total_seconds = time.perf_counter() - total_start
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'config': { 'clusters': clusters, 'tasks': tasks, 'containers': containers, 'images': images, 'policy_entries': policy_entries,
+            'workers': workers, 'api_latency_ms': api_latency_ms, 'seed': seed, 'mode': mode },
+        'rows': row_count,
+        'total_seconds': total_seconds,
+        'rows_per_second': row_count / total_seconds if total_seconds else 0.0,
+        'stage_seconds': stages,
+        'api_calls': dict(ecs_client.call_counts + s3_client.call_counts),
+        'api_latency_ms': metrics.api_call_summary(),
+        # cumulative busy time per pipeline stage (summed across threads), only filled in 'pipeline' mode
+        'pipeline_stage_seconds': metrics.summary()['stage_seconds'],
+        'rate_limiter': rate_limiter.stats(),
+        'peak_memory_mb': peak_bytes / (1024 * 1024),
+        'report_bytes': len(s3_client.objects[(BUCKET_NAME, REPORT_KEY)]),
+        'python': platform.python_version()
+    }
+
+
+def compare_results(current, baseline, threshold = 0.2) -> list:
+    """
+        Return a list of regression messages for timings/memory that got worse than baseline by more than threshold (20%)
+    """
+    regressions = []
+    checks = [('total_seconds', current['total_seconds'], baseline['total_seconds']),
+        ('peak_memory_mb', current['peak_memory_mb'], baseline['peak_memory_mb'])]
+    checks += [('stage_seconds.' + a_stage, current['stage_seconds'].get(a_stage, 0.0), a_value)
+        for a_stage, a_value in baseline['stage_seconds'].items()]
+
+    for a_metric, current_value, baseline_value in checks:
+        if baseline_value and current_value > baseline_value * (1 + threshold):
+            regressions.append("{0}: {1:.3f} vs baseline {2:.3f} (+{3:.0%})".format(
+                a_metric, current_value, baseline_value, current_value / baseline_value - 1))
+    return regressions
+
+
+def print_results(results) -> None:
+    print("rows: {0}  total: {1:.2f}s  throughput: {2:,.0f} rows/s  peak memory: {3:.1f} MB".format(
+        results['rows'], results['total_seconds'], results['rows_per_second'], results['peak_memory_mb']))
+    for a_stage, seconds in results['stage_seconds'].items():
+        print("  {0:<15} {1:8.3f}s".format(a_stage, seconds))
+    print("  api calls: {0}".format(results['api_calls']))
+    for operation, latency in results['api_latency_ms'].items():
+        print("  {0:<15} p50 {1:.2f}ms  p99 {2:.2f}ms".format(operation, latency['p50_ms'], latency['p99_ms']))
+
+
+def main(argv = None) -> int:
+    parser = argparse.ArgumentParser(description = 'Benchmark the ECS image scan against a synthetic fleet')
+    parser.add_argument('--profile', choices = PROFILES.keys(), default = 'small')
+    for a_setting in PROFILES['small'].keys():
+        parser.add_argument('--' + a_setting.replace('_', '-'), type = int, help = 'override the profile {0}'.format(a_setting))
+    parser.add_argument('--workers', type = int, default = 8)
+    parser.add_argument('--api-latency-ms', type = float, default = 0.0, help = 'simulated latency per ECS/S3 call')
+    parser.add_argument('--seed', type = int, default = 1)
+    parser.add_argument('--api-rate', type = float, help = 'ECS calls per second allowed by the rate limiter (default unlimited)')
+    parser.add_argument('--mode', choices = ['lists', 'pipeline'], default = 'lists', help = 'build lists between stages or stream through scan_pipeline')
+    parser.add_argument('--save', help = 'save results to benchmarks/results/<name>.json')
+    parser.add_argument('--compare', help = 'results json to compare against, exits 1 on regression')
+    parser.add_argument('--threshold', type = float, default = 0.2, help = 'allowed slowdown before a regression is reported')
+    args = parser.parse_args(argv)
+
+    settings = dict(PROFILES[args.profile])
+    for a_setting in settings:
+        override = getattr(args, a_setting)
+        if override is not None:
+            settings[a_setting] = override
+
+    results = run_benchmark(settings['clusters'], settings['tasks'], settings['containers'], settings['images'],
+        settings['policy_entries'], args.workers, args.api_latency_ms, args.seed, args.mode, args.api_rate)
+    print_results(results)
+
+    if args.save:
+        os.makedirs(RESULTS_DIR, exist_ok = True)
+        path = os.path.join(RESULTS_DIR, args.save + '.json')
+        with open(path, 'w') as results_file:
+            json.dump(results, results_file, indent = 2)
+        print("saved {0}".format(path))
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = compare_results(results, json.load(baseline_file), args.threshold)
+        for a_regression in regressions:
+            print("REGRESSION " + a_regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
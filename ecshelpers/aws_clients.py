@@ -0,0 +1,98 @@
+import os
+import threading
+import boto3
+from botocore.config import Config
+
+'''
+Lazily created boto3 sessions and clients shared across Lambda invocations. Module level state survives warm starts so each
+container only pays for session/client construction (and the TLS handshakes of its connections) once, on first use.
+
+Clients are keyed by service, region and credentials, so every ecsUtils / scan for the same account and region shares one
+thread safe client and its connection pool. The pool is sized for the scan concurrency (SCAN_MAX_WORKERS) so concurrent
+calls reuse kept-alive connections instead of opening new ones.
+'''
+
+# botocore's default pool size
+DEFAULT_MAX_POOL_CONNECTIONS = 10
+DEFAULT_CONNECT_TIMEOUT = 5
+DEFAULT_READ_TIMEOUT = 30
+DEFAULT_MAX_WORKERS = 8
+# assumed role credentials are refreshed every hour, the clients built with old credentials are dropped oldest first
+MAX_CACHED_CLIENTS = 256
+
+_sessions = {}
+_clients = {}
+_lock = threading.Lock()
+
+
+def pool_size_for(max_workers) -> int:
+    # cluster listing threads and describe_tasks workers both run max_workers calls at once on the same client
+    return max(DEFAULT_MAX_POOL_CONNECTIONS, 2 * max(1, max_workers) + 2)
+
+
+def client_config(max_workers: int = None) -> Config:
+    """
+        Base config of every shared client: pool sized for the scan concurrency, TCP keep-alive, explicit timeouts and
+        standard mode retries. Service specific settings (e.g. ECS_CLIENT_CONFIG) are merged on top.
+    """
+    if max_workers is None:
+        max_workers = int(os.getenv('SCAN_MAX_WORKERS', str(DEFAULT_MAX_WORKERS)))
+    return Config(max_pool_connections = pool_size_for(max_workers), connect_timeout = DEFAULT_CONNECT_TIMEOUT,
+        read_timeout = DEFAULT_READ_TIMEOUT, retries = { 'mode': 'standard', 'max_attempts': 3 }, tcp_keepalive = True)
+
+
+def get_session(profile_name = None) -> boto3.Session:
+    with _lock:
+        session = _sessions.get(profile_name)
+        if session is None:
+            session = boto3.Session(profile_name = profile_name) if profile_name else boto3.Session()
+            _sessions[profile_name] = session
+        return session
+
+
+def _credential_key(session):
+    if session is None:
+        return None
+    with _lock:
+        for a_profile_name, a_session in _sessions.items():
+            if a_session is session:
+                # the container's own session is the same credential set as session = None
+                return ('profile', a_profile_name) if a_profile_name else None
+    # the access key tells credential sets (e.g. assumed role sessions) apart without holding on to the session itself
+    credentials = session.get_credentials()
+    return ('credentials', credentials.access_key if credentials else None)
+
+
+def get_client(service_name, region_name = None, config = None, session = None, max_workers: int = None):
+    """
+        Return the shared client for the service, region and credentials (session, default the container's own), creating
+        it on first use. config (botocore Config) is merged over client_config(max_workers) and only used when the client is
+        created. Callers that size their own concurrency (max_workers) get a separate client with a pool to match.
+    """
+    if session is not None and not region_name:
+        region_name = session.region_name
+    cache_key = (service_name, region_name, _credential_key(session), max_workers)
+    client = _clients.get(cache_key)
+    if client:
+        return client
+
+    if session is None:
+        session = get_session()
+    with _lock:
+        client = _clients.get(cache_key)
+        if not client:
+            merged_config = client_config(max_workers).merge(config) if config else client_config(max_workers)
+            client = session.client(service_name, region_name = region_name, config = merged_config)
+            if len(_clients) >= MAX_CACHED_CLIENTS:
+                _clients.pop(next(iter(_clients)))
+            _clients[cache_key] = client
+        return client
+
+
+def reset_clients() -> None:
+    """
+        Drop the cached sessions and clients (used by tests and the startup harness)
+    """
+    with _lock:
+        _sessions.clear()
+        _clients.clear()
@@ -1,16 +1,96 @@
+from concurrent.futures import ThreadPoolExecutor
+import functools
 import json
 import os
+import time
+
+import aws_clients
+from ecs_utils import ecsUtils as ecsUtils, ECS_CLIENT_CONFIG
+from scan_engine import parse_scan_targets
+from scan_coordinator import scanCoordinator, lambdaInvoker, build_shards, shard_findings_key, DEFAULT_SHARD_SIZE
+from ecs_reader import (report_field_names, get_session_pool, create_output_writer, summary_enabled, write_summary, findings_enabled,
+    pull_findings_index)
+from compliance_summary import complianceSummary
+from s3_report_writer import check_report_format
+from scan_metrics import get_metrics
+
+'''
+Coordinator for large fleets. Lists the clusters of every account/region to scan, splits them into shards, invokes the
+ecs_reader function once per shard (asynchronously) and merges the partial reports into RESULT_OUTPUT_KEY. With
+INCLUDE_FINDINGS the Inspector2 findings are pulled once here and passed to the shards as an S3 object.
+'''
+
+
+def init_clients() -> dict:
+    """
+        Create (once per container) the clients the handler needs. Safe to call on every invocation.
+    """
+    return { 's3': aws_clients.get_client('s3'), 'ecs': aws_clients.get_client('ecs', config = ECS_CLIENT_CONFIG),
+        'lambda': aws_clients.get_client('lambda') }
+
+
+def list_clusters_by_target(targets, ecs_client, session_pool = None, max_workers: int = 8) -> tuple:
+    """
+        Returns ({ (account_id, region): [cluster_arn, ...] }, failed_targets). With no targets only the coordinator's own
+        account/region is listed under (None, None). A target that can't be listed is logged and returned in failed_targets
+        so the run can count it instead of silently leaving it out of the report.
+    """
+    if not targets:
+        return { (None, None): ecsUtils(verbose_mode = False, ecs_client = ecs_client).get_cluster_arns() }, []
+
+    def list_target(a_target):
+        try:
+            session = session_pool.get_session(a_target.account_id, a_target.region)
+            return ecsUtils(verbose_mode = False, session = session, account_id = a_target.account_id).get_cluster_arns()
+        except Exception as e:
+            print("Failed to list clusters for {0}/{1}: {2}".format(a_target.account_id, a_target.region, e))
+            return None
+
+    with ThreadPoolExecutor(max_workers = max(1, min(max_workers, len(targets)))) as executor:
+        cluster_arns = list(executor.map(list_target, targets))
+    clusters_by_target = { (a_target.account_id, a_target.region): clusters for a_target, clusters in zip(targets, cluster_arns)
+        if clusters is not None }
+    failed_targets = [a_target for a_target, clusters in zip(targets, cluster_arns) if clusters is None]
+    return clusters_by_target, failed_targets
+
 
 def lambda_handler(event, context):
+    # the merged report is only written after every shard, check REPORT_FORMAT before dispatching them
+    check_report_format(os.getenv('REPORT_FORMAT', 'csv').lower())
+    clients = init_clients()
+
     bucket_name = os.getenv('BUCKET_NAME')
-    base_image_key = os.getenv('VALID_BASE_IMAGES_KEY')
-    message = "hello world from app2 with env: {0} and baseImageKey: {1}".format(bucket_name, base_image_key)
+    result_output_key = os.getenv('RESULT_OUTPUT_KEY')
+    shard_size = int(os.getenv('SHARD_SIZE', str(DEFAULT_SHARD_SIZE)))
+    compress_results = os.getenv('COMPRESS_RESULTS', 'false').lower() == 'true'
+    timeout_seconds = float(os.getenv('SHARD_TIMEOUT_SECONDS', '840'))
+    run_id = getattr(context, 'aws_request_id', None) or time.strftime('%Y%m%dT%H%M%S')
+
+    scan_targets = parse_scan_targets(os.getenv('SCAN_TARGETS', ''))
+    session_pool = get_session_pool(os.getenv('SCAN_ROLE_NAME', 'EcsImageScannerRole')) if scan_targets else None
+    clusters_by_target, failed_targets = list_clusters_by_target(scan_targets, clients['ecs'], session_pool)
+    shards = build_shards(clusters_by_target, shard_size)
+
+    # pull the Inspector2 findings once for the run rather than once per shard
+    findings_key = None
+    if findings_enabled():
+        findings_key = shard_findings_key(result_output_key, run_id)
+        pull_findings_index(aws_clients.get_client('inspector2'), get_metrics()).save_to_s3(clients['s3'], bucket_name, findings_key)
+
+    invoker = lambdaInvoker(os.getenv('ECS_READER_FUNCTION'), clients['lambda'])
+    compliance_summary = complianceSummary() if summary_enabled() else None
+    coordinator = scanCoordinator(invoker, clients['s3'], bucket_name, result_output_key, report_field_names(), compress = compress_results,
+        assume_role = bool(scan_targets), timeout_seconds = timeout_seconds, writer_factory = functools.partial(create_output_writer, run_id = run_id), summary = compliance_summary,
+        findings_key = findings_key)
+    summary = coordinator.run(shards, run_id)
+    summary['scanFailures']['failedTargets'] = summary['scanFailures'].get('failedTargets', 0) + len(failed_targets)
+    summary['complete'] = not any(summary['scanFailures'].values())
+    if not summary['complete']:
+        print("scan is incomplete: {0}".format(summary['scanFailures']))
+    if compliance_summary:
+        write_summary(compliance_summary, clients['s3'], bucket_name, result_output_key, get_metrics(), summary['scanFailures'])
 
     return {
         "statusCode": 200,
-        "body": json.dumps(
-            {
-                "message": message,
-            }
-        ),
+        "body": json.dumps(summary),
     }
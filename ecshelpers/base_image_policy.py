@@ -0,0 +1,97 @@
+from typing import List
+from bisect import bisect_right
+import fnmatch
+import hashlib
+import re
+
+# glob characters that turn a base image entry into a pattern instead of an exact tag
+GLOB_CHARS = ('*', '?', '[')
+# separator for version range entries e.g. "2021.09.25..2021.12.31" (either side may be left open)
+RANGE_SEPARATOR = '..'
+# open ended upper bound, sorts after every real version key. Appended to an upper bound it also takes in every tag that
+# starts with the bound (2021.12.31-slim is within ..2021.12.31)
+_MAX_VERSION_KEY = ((2, ''),)
+_VERSION_TOKEN_RE = re.compile(r'\d+|[A-Za-z]+')
+
+
+def version_key(version_string) -> tuple:
+    """
+        Turn a base tag like "14.17.6_2022.01.13-slim" into a comparable key so numeric parts compare as numbers
+        (e.g. 2021.9.25 < 2021.10.1) and alpha parts compare as text.
+    """
+    return tuple((0, int(a_token)) if a_token.isdigit() else (1, a_token) for a_token in _VERSION_TOKEN_RE.findall(version_string))
+
+
+class baseImagePolicy:
+    ''' Valid base image entries compiled once into an index so each lookup is cheap no matter how many entries there are.
+        Exact tags are a set lookup, prefix/glob entries are compiled into a single regex and version ranges are checked
+        with a binary search.'''
+
+    def __init__(self, entries: List[str], cache_size: int = 10000) -> None:
+        self.entries = list(entries)
+        self.exact_tags = set()
+        patterns = []
+        ranges = []
+
+        for an_entry in self.entries:
+            an_entry = an_entry.strip()
+            if not an_entry:
+                continue
+            if RANGE_SEPARATOR in an_entry:
+                low, _, high = an_entry.partition(RANGE_SEPARATOR)
+                ranges.append((version_key(low) if low else (), version_key(high) + _MAX_VERSION_KEY if high else _MAX_VERSION_KEY))
+            elif any(a_char in an_entry for a_char in GLOB_CHARS):
+                patterns.append(fnmatch.translate(an_entry))
+            else:
+                self.exact_tags.add(an_entry)
+
+        self.pattern_matcher = re.compile('|'.join(patterns)) if patterns else None
+
+        # sort ranges by lower bound and keep a running max of upper bounds so one bisect answers "is key in any range"
+        ranges.sort()
+        self.range_lows = [a_range[0] for a_range in ranges]
+        self.range_max_highs = []
+        max_high = None
+        for _, high in ranges:
+            max_high = high if max_high is None or high > max_high else max_high
+            self.range_max_highs.append(max_high)
+
+        # identifies the policy contents so stored classifications can tell when they need to be redone
+        self.fingerprint = hashlib.sha1('\n'.join(sorted(self.entries)).encode('utf-8')).hexdigest()
+
+        self.cache_size = cache_size
+        self._cache = {}
+
+    def matches(self, base) -> bool:
+        """
+            Return True if the given base tag (e.g. "2021.09.25") satisfies any of the policy entries
+        """
+        if not base:
+            return False
+
+        result = self._cache.get(base)
+        if result is not None:
+            return result
+
+        result = self._matches_uncached(base)
+        if len(self._cache) < self.cache_size:
+            self._cache[base] = result
+        return result
+
+    def _matches_uncached(self, base) -> bool:
+        if base in self.exact_tags:
+            return True
+        if self.pattern_matcher and self.pattern_matcher.match(base):
+            return True
+        if self.range_lows:
+            key = version_key(base)
+            index = bisect_right(self.range_lows, key)
+            if index and self.range_max_highs[index - 1] >= key:
+                return True
+        return False
+
+    def __contains__(self, base) -> bool:
+        return self.matches(base)
+
+    def __len__(self) -> int:
+        return len(self.entries)
@@ -0,0 +1,190 @@
+import datetime
+import hashlib
+import heapq
+import json
+import math
+import os
+
+from docker_image_analyzer import parse_image_reference
+
+'''
+Single pass compliance summary of the scanned container rows. Rows stream through summarize_records on their way to the
+report writer and only small fixed size counters are kept:
+
+    - exact row / non-compliant counts
+    - non-compliant counts per account, cluster, service group and base image (Space-Saving counters, exact until a
+      dimension has more distinct keys than the counter capacity, approximate with a known error bound after that)
+    - the top offending images (Space-Saving)
+    - distinct image counts (HyperLogLog, ~1.6% error in 4KB)
+
+The result is a few KB of JSON written next to the detailed report so dashboards and alerts don't have to read the report.
+'''
+
+DEFAULT_COUNTER_CAPACITY = 1000
+DEFAULT_TOP_K = 20
+# keys reported per dimension (accounts, clusters, ...), the counters track more than that
+DEFAULT_MAX_DIMENSION_KEYS = 100
+DEFAULT_HLL_PRECISION = 12
+SUMMARY_DIMENSIONS = ('account_id', 'cluster', 'group', 'baseImage')
+
+
+class spaceSavingCounter:
+    ''' Space-Saving heavy hitters (Metwally et al.): tracks at most capacity keys. When a new key shows up and the counter
+        is full the smallest key is replaced and the new key inherits its count as the error bound, so a count is never
+        under reported and over reported by at most its error. Exact while no key has been evicted.'''
+
+    def __init__(self, capacity: int = DEFAULT_COUNTER_CAPACITY) -> None:
+        self.capacity = max(1, capacity)
+        self.counts = {}
+        self.errors = {}
+        self.evictions = 0
+        # (count, key) min heap with stale entries, an entry is live when it matches counts[key]
+        self._heap = []
+
+    def add(self, key, count: int = 1) -> None:
+        if key in self.counts:
+            self.counts[key] += count
+        elif len(self.counts) < self.capacity:
+            self.counts[key] = count
+            self.errors[key] = 0
+        else:
+            min_count, min_key = self._pop_min()
+            del self.counts[min_key]
+            del self.errors[min_key]
+            self.counts[key] = min_count + count
+            self.errors[key] = min_count
+            self.evictions += 1
+        heapq.heappush(self._heap, (self.counts[key], key))
+        if len(self._heap) > 4 * self.capacity:
+            self._heap = [(a_count, a_key) for a_key, a_count in self.counts.items()]
+            heapq.heapify(self._heap)
+
+    def _pop_min(self) -> tuple:
+        while True:
+            a_count, a_key = heapq.heappop(self._heap)
+            if self.counts.get(a_key) == a_count:
+                return a_count, a_key
+
+    @property
+    def exact(self) -> bool:
+        return self.evictions == 0
+
+    def top(self, k: int = None) -> list:
+        """
+            [(key, count, error), ...] highest count first
+        """
+        ordered = sorted(self.counts.items(), key = lambda an_item: (-an_item[1], an_item[0]))
+        if k is not None:
+            ordered = ordered[:k]
+        return [(a_key, a_count, self.errors[a_key]) for a_key, a_count in ordered]
+
+
+class hyperLogLog:
+    ''' HyperLogLog distinct counter. 2**precision one byte registers, standard error ~1.04/sqrt(2**precision).'''
+
+    def __init__(self, precision: int = DEFAULT_HLL_PRECISION) -> None:
+        if not 4 <= precision <= 16:
+            raise ValueError("precision must be between 4 and 16")
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, value) -> None:
+        hashed = int.from_bytes(hashlib.blake2b(str(value).encode('utf-8'), digest_size = 8).digest(), 'big')
+        remaining_bits = 64 - self.precision
+        index = hashed >> remaining_bits
+        # position of the first 1 bit in what is left of the hash
+        rank = remaining_bits - (hashed & ((1 << remaining_bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def count(self) -> int:
+        register_count = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / register_count)
+        estimate = alpha * register_count * register_count / sum(2.0 ** -a_register for a_register in self.registers)
+        empty_registers = self.registers.count(0)
+        # linear counting is more accurate for small cardinalities
+        if estimate <= 2.5 * register_count and empty_registers:
+            estimate = register_count * math.log(register_count / empty_registers)
+        return int(round(estimate))
+
+
+def is_non_compliant(row) -> bool:
+    # rows read back from a csv report carry 'False' rather than False
+    return row.get('validBaseImage') in (False, 'False', 'false')
+
+
+def summary_key(report_key) -> str:
+    # dockerImagesSecInfo/scanResults1.csv -> dockerImagesSecInfo/scanResults1-summary.json
+    root, _ = os.path.splitext(report_key)
+    return "{0}-summary.json".format(root)
+
+
+class complianceSummary:
+    ''' Bounded memory aggregation of report rows, feed it with add(row) or summarize_records and read to_dict().'''
+
+    def __init__(self, counter_capacity: int = DEFAULT_COUNTER_CAPACITY, top_k: int = DEFAULT_TOP_K,
+            max_dimension_keys: int = DEFAULT_MAX_DIMENSION_KEYS, hll_precision: int = DEFAULT_HLL_PRECISION) -> None:
+        self.top_k = top_k
+        self.max_dimension_keys = max_dimension_keys
+        self.rows = 0
+        self.non_compliant_rows = 0
+        self.non_compliant = { a_dimension: spaceSavingCounter(counter_capacity) for a_dimension in SUMMARY_DIMENSIONS }
+        self.offending_images = spaceSavingCounter(counter_capacity)
+        self.distinct_images = hyperLogLog(hll_precision)
+        self.distinct_non_compliant_images = hyperLogLog(hll_precision)
+
+    def add(self, row) -> None:
+        image = row.get('image') or ''
+        # the digest identifies what is actually running, fall back to the image reference when it wasn't reported
+        digest = row.get('imageDigest') or ''
+        image_identity = digest if digest.startswith('sha256:') else image
+        self.rows += 1
+        self.distinct_images.add(image_identity)
+        if not is_non_compliant(row):
+            return
+
+        self.non_compliant_rows += 1
+        self.distinct_non_compliant_images.add(image_identity)
+        cluster_arn = row.get('cluster_arn') or ''
+        self.non_compliant['account_id'].add(row.get('account_id') or 'unknown')
+        self.non_compliant['cluster'].add(cluster_arn.rsplit('/', 1)[-1] or 'unknown')
+        self.non_compliant['group'].add(row.get('group') or 'unknown')
+        self.non_compliant['baseImage'].add(parse_image_reference(image).base or 'unknown')
+        self.offending_images.add(image)
+
+    def to_dict(self, generated_at = None, failures = None) -> dict:
+        """
+            failures: optional { count_name: count } of the clusters / task batches the scan skipped (see metricsCollector.failure_counts)
+        """
+        generated_at = generated_at if generated_at else datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        return {
+            'generatedAt': generated_at,
+            'rows': self.rows,
+            'nonCompliantRows': self.non_compliant_rows,
+            'distinctImages': self.distinct_images.count(),
+            'distinctNonCompliantImages': self.distinct_non_compliant_images.count(),
+            'nonCompliant': { a_dimension: { a_key: a_count for a_key, a_count, _ in a_counter.top(self.max_dimension_keys) }
+                for a_dimension, a_counter in self.non_compliant.items() },
+            'topOffendingImages': [{ 'image': an_image, 'count': a_count, 'maxOvercount': an_error }
+                for an_image, a_count, an_error in self.offending_images.top(self.top_k)],
+            # dimensions with more distinct keys than the counters track, their counts are upper bounds
+            'approximate': [a_dimension for a_dimension, a_counter in self.non_compliant.items() if not a_counter.exact]
+                + ([] if self.offending_images.exact else ['topOffendingImages']),
+            'failures': dict(failures) if failures else {},
+            # false when part of the fleet couldn't be scanned, the counts above only cover what was
+            'complete': not any((failures or {}).values()),
+        }
+
+    def save_to_s3(self, s3_client, bucket_name, key, failures = None) -> dict:
+        summary = self.to_dict(failures = failures)
+        s3_client.put_object(Bucket = bucket_name, Key = key, Body = json.dumps(summary).encode('utf-8'), ContentType = 'application/json')
+        return summary
+
+
+def summarize_records(records, summary):
+    """
+        Add each record to the summary as it passes through on its way to the report
+    """
+    for a_record in records:
+        summary.add(a_record)
+        yield a_record
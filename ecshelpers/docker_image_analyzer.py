@@ -1,51 +1,166 @@
-from typing import List
-import boto3
+from functools import lru_cache
+import threading
+import time
+import io
+import botocore
 import csv
 
+import aws_clients
+from base_image_policy import baseImagePolicy
+
+# number of distinct image strings to keep parsed results for
+IMAGE_INFO_CACHE_SIZE = 4096
+# tag docker pulls when a reference has neither a tag nor a digest
+DEFAULT_TAG = 'latest'
+# seconds a cached base image policy is trusted before revalidating it against S3
+DEFAULT_BASE_IMAGE_CACHE_TTL = 300
+
+# process level cache of compiled base image policies keyed by (bucket, key) so warm Lambda invocations can skip the download
+_base_image_cache = {}
+_base_image_cache_lock = threading.Lock()
+
+
+class imageInfo:
+    ''' Immutable parsed docker image reference. Supports image_info['base'] style access for older callers.'''
+
+    __slots__ = ('repo', 'tag', 'base', 'digest', 'registry')
+
+    def __init__(self, repo: str = '', tag: str = '', base: str = '', digest: str = '', registry: str = '') -> None:
+        for a_field, a_value in zip(self.__slots__, (repo, tag, base, digest, registry)):
+            object.__setattr__(self, a_field, a_value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("imageInfo is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("imageInfo is immutable")
+
+    def __getitem__(self, key) -> str:
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def _as_tuple(self) -> tuple:
+        return tuple(getattr(self, a_field) for a_field in self.__slots__)
+
+    def as_dict(self) -> dict:
+        return dict(zip(self.__slots__, self._as_tuple()))
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, imageInfo):
+            return NotImplemented
+        return self._as_tuple() == other._as_tuple()
+
+    def __hash__(self) -> int:
+        return hash(self._as_tuple())
+
+    def __repr__(self) -> str:
+        return "imageInfo({0})".format(", ".join("{0}={1!r}".format(k, v) for k, v in self.as_dict().items()))
+
+
+EMPTY_IMAGE_INFO = imageInfo()
+
+
+@lru_cache(maxsize = IMAGE_INFO_CACHE_SIZE)
+def parse_image_reference(full_image_string) -> imageInfo:
+    """
+        Parse a docker image reference ([registry[:port]/]repo[:tag][@sha256:digest]) into an imageInfo.
+        A reference w/out either a tag or a digest gets docker's default tag (latest), only an empty reference returns an
+        empty imageInfo.
+    """
+    name, _, digest = full_image_string.partition('@')
+
+    # the tag separator is the last colon after the last slash (earlier colons belong to a registry port)
+    tag_index = name.rfind(':')
+    if tag_index > name.rfind('/'):
+        repo, tag = name[:tag_index], name[tag_index + 1:]
+    else:
+        repo, tag = name, ''
+
+    if not repo:
+        return EMPTY_IMAGE_INFO
+    if not tag and not digest:
+        tag = DEFAULT_TAG
+
+    # first path component is a registry if it looks like a host name (has a dot or port or is localhost)
+    registry = ''
+    first_component, slash, _ = repo.partition('/')
+    if slash and ('.' in first_component or ':' in first_component or first_component == 'localhost'):
+        registry = first_component
+
+    # split out tag info
+    base = tag.split("_base-", 1)[1] if "_base-" in tag else ''
+    return imageInfo(repo = repo, tag = tag, base = base, digest = digest, registry = registry)
+
+
+def parse_base_images_csv(csv_text) -> list[str]:
+    """
+        Parse the valid base images csv contents (image_tag,image_type) into a list of image tags
+    """
+    return [row['image_tag'] for row in csv.DictReader(io.StringIO(csv_text))]
+
+
+def clear_base_image_cache() -> None:
+    with _base_image_cache_lock:
+        _base_image_cache.clear()
+
+
+def _is_not_modified(client_error) -> bool:
+    error = client_error.response.get('Error', {})
+    status_code = client_error.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+    return status_code == 304 or error.get('Code') in ('304', 'NotModified')
+
+
 class dockerImageAnalyzer:
     ''' Simple methods for decomposing relevant info for the ECS docker images we need (e.g. image name, base image used, etc.'''
 
     def __init__(self, verbose_mode = False) -> None:
         self.verbose_mode = verbose_mode
 
-    def extract_image_info(self, full_image_string) -> dict[str, str]:
+    def extract_image_info(self, full_image_string) -> 'imageInfo':
         """
             Extract out the different parts of the image we need (e.g. tag, base, repo)
             Our tagging strategy includes base image info w/in it so using the full tag name permits us to know the base image w/out having to inspect dockerfile.
             Right now we only need to know which docker images have CVEs on them but we will need to also compare to what our valid base image names are too to 
             find out which running images need to be rebuilt/patched.
+            Parsing is memoized by image string since the same images repeat across every task replica.
         """
 
         # devImageInfo = "99999999.dkr.ecr.us-east-1.amazonaws.com/pets/dev/pets-ui:feature__feat1-build30-dev01_base-14.17.6_2022.01.13-slim"
         # ecr_repo = "99999999.dkr.ecr.us-east-1.amazonaws.com/pets/dev/pets-ui"
         # imageTag = "feature__feat1-build30-dev01_base-14.17.6_2022.01.13-slim"
         # imageBase = "14.17.6_2022.01.13-slim"
-        image_info = {
-            'tag' : '',
-            'base' : '',
-            'repo' : ''
-        }   
-
-        # split out repo name first
-        repo_splits = full_image_string.split(":", 1)
-        if len(repo_splits) < 2:
-            return image_info
-
-        image_info['repo'] = repo_splits[0]
-        image_info['tag'] = repo_splits[1]
-
-        # split out tag info
-        tag_splits = repo_splits[1].split("_base-", 1)
-        if len(tag_splits) < 2:
-            return image_info
-
-        image_info['base'] = tag_splits[1]
-        return image_info
+        return parse_image_reference(full_image_string)
 
     def image_matches_current_bases(self, full_image_string, valid_base_images) -> bool:
-        # given a full string return if matches valid base image
+        # given a full string return if matches valid base image (valid_base_images can be a list or a compiled baseImagePolicy)
         image_info = self.extract_image_info(full_image_string)
-        return image_info['base'] in valid_base_images
+        return image_info.base in valid_base_images
+
+    def compile_base_images(self, valid_base_images) -> baseImagePolicy:
+        """
+            Compile the list of valid base image entries (exact tags, globs like "2022.*" or ranges like "2021.09.25..2021.12.31")
+            into a baseImagePolicy index. Compile once per scan and pass the result to image_matches_current_bases/classify_images.
+        """
+        if hasattr(valid_base_images, 'matches'):
+            return valid_base_images
+        return baseImagePolicy(valid_base_images)
+
+    def classify_images(self, full_image_strings, valid_base_images) -> list[bool]:
+        """
+            Classify many image strings in one pass, returning a list of match results in the same order.
+            Each distinct image string is only parsed and matched once.
+        """
+        policy = self.compile_base_images(valid_base_images)
+        seen = {}
+        results = []
+        for a_image in full_image_strings:
+            result = seen.get(a_image)
+            if result is None:
+                result = policy.matches(self.extract_image_info(a_image).base)
+                seen[a_image] = result
+            results.append(result)
+        return results
 
     def fetch_base_images_from_s3(self, bucket_name, s3Key, s3_client = None) -> list[str]:
         """
@@ -54,15 +169,43 @@ class dockerImageAnalyzer:
 
         # pull a csv file from s3 and open and return list
         if not s3_client:
-            s3_client = boto3.client('s3')
+            s3_client = aws_clients.get_client('s3')
 
         data = s3_client.get_object(Bucket=bucket_name, Key=s3Key)
         
-        # read the contents of the file and split it into a list of lines
-        lines = data['Body'].read().decode('utf-8').split()      
-        # print(len(lines))
-        images = []
-        for row in csv.DictReader(lines):
-            images.append(row['image_tag'])
-
-        return images
+        # read the contents of the file and parse it as csv (handles quoted values)
+        return parse_base_images_csv(data['Body'].read().decode('utf-8'))
+
+    def get_base_image_policy(self, bucket_name, s3Key, s3_client = None, ttl_seconds = DEFAULT_BASE_IMAGE_CACHE_TTL, clock = time.time) -> baseImagePolicy:
+        """
+            Return the compiled base image policy for the csv in S3, cached for the life of the process.
+            Within ttl_seconds the cached policy is returned w/out touching S3, after that the object is revalidated with a
+            conditional get (IfNoneMatch on the cached ETag) and only downloaded and re-parsed when it has changed.
+        """
+        cache_key = (bucket_name, s3Key)
+        with _base_image_cache_lock:
+            entry = _base_image_cache.get(cache_key)
+            now = clock()
+            if entry and now - entry['checked_at'] < ttl_seconds:
+                return entry['policy']
+
+            if not s3_client:
+                s3_client = aws_clients.get_client('s3')
+
+            get_args = { 'Bucket': bucket_name, 'Key': s3Key }
+            if entry and entry['etag']:
+                get_args['IfNoneMatch'] = entry['etag']
+
+            try:
+                data = s3_client.get_object(**get_args)
+            except botocore.exceptions.ClientError as e:
+                if entry and _is_not_modified(e):
+                    if self.verbose_mode:
+                        print("base images {0} not modified".format(s3Key))
+                    entry['checked_at'] = now
+                    return entry['policy']
+                raise
+
+            policy = self.compile_base_images(parse_base_images_csv(data['Body'].read().decode('utf-8')))
+            _base_image_cache[cache_key] = { 'etag': data.get('ETag'), 'checked_at': now, 'policy': policy }
+            return policy
@@ -0,0 +1,289 @@
+from typing import NamedTuple
+import json
+import threading
+import botocore
+
+from docker_image_analyzer import parse_image_reference
+from scan_metrics import get_metrics
+
+'''
+Manifest based base image detection for ECR images. Instead of trusting the "_base-" tag convention, the layer digests of
+every running image are compared with the layers of the base images: an image built FROM a base image starts with exactly
+that base image's layers. Manifests are fetched in bulk with batch_get_image (no image data is pulled) and cached by
+digest since a digest always names the same manifest. Repositories that can't be read (deleted, no cross account access)
+are logged and counted (manifestErrors), their images fall back to the tag check.
+'''
+
+# batch_get_image accepts at most 100 image ids per call
+BATCH_GET_IMAGE_SIZE = 100
+MANIFEST_MEDIA_TYPES = [
+    'application/vnd.docker.distribution.manifest.v2+json',
+    'application/vnd.oci.image.manifest.v1+json',
+    'application/vnd.docker.distribution.manifest.list.v2+json',
+    'application/vnd.oci.image.index.v1+json',
+]
+# platform picked out of multi-arch manifest lists
+DEFAULT_PLATFORM = ('linux', 'amd64')
+DEFAULT_MANIFEST_CACHE_SIZE = 50000
+# seconds a warm container reuses the base layer index before listing the base repositories again (picks up new base images)
+DEFAULT_BASE_INDEX_TTL = 300
+# marks the node of the last layer of a base image in the baseLayerIndex trie (layer digests are always strings)
+_BASE_ENTRY = None
+
+# digests never change so the manifest layers are cached for the life of the container
+_manifest_layers = {}
+_manifest_layers_lock = threading.Lock()
+
+
+class ecrImage(NamedTuple):
+    ''' An image in an ECR repository, identified by digest when known (otherwise by tag).'''
+    registry_id: str
+    region: str
+    repository: str
+    digest: str
+    tag: str
+
+
+def parse_ecr_image(full_image_string, image_digest = None):
+    """
+        Return an ecrImage for an ECR image reference (<account>.dkr.ecr.<region>.amazonaws.com/repo[:tag][@digest])
+        or None when the image isn't in ECR
+    """
+    image_info = parse_image_reference(full_image_string)
+    registry_parts = image_info.registry.split('.')
+    if len(registry_parts) < 6 or registry_parts[1:3] != ['dkr', 'ecr']:
+        return None
+
+    digest = image_info.digest or (image_digest if image_digest and image_digest.startswith('sha256:') else '')
+    if not digest and not image_info.tag:
+        return None
+    repository = image_info.repo[len(image_info.registry) + 1:]
+    return ecrImage(registry_parts[0], registry_parts[3], repository, digest, image_info.tag)
+
+
+def clear_manifest_cache() -> None:
+    with _manifest_layers_lock:
+        _manifest_layers.clear()
+
+
+def _image_id(an_image) -> dict:
+    return { 'imageDigest': an_image.digest } if an_image.digest else { 'imageTag': an_image.tag }
+
+
+class baseLayerIndex:
+    ''' Layer lists of the known base images in a trie keyed by layer digest. An image is on a base image when the base
+        image's layers are a prefix of its own, each image is checked by walking its layers with one dict lookup per layer.'''
+
+    def __init__(self) -> None:
+        # { layer_digest: { next_layer_digest: {...}, _BASE_ENTRY: [base_reference, is_valid] } }
+        self.root = {}
+        self.base_count = 0
+
+    def add(self, layers, base_reference, is_valid) -> None:
+        """
+            Index a base image. Tags of the same image (same layers) share one entry that is valid if any of its tags is
+            valid, so e.g. "2021.09.25" (valid) and "latest" (not in the policy) on one digest don't depend on list order.
+        """
+        if not layers:
+            return
+        node = self.root
+        for a_digest in layers:
+            node = node.setdefault(a_digest, {})
+        entry = node.get(_BASE_ENTRY)
+        if entry is None:
+            node[_BASE_ENTRY] = [base_reference, is_valid]
+            self.base_count += 1
+        elif is_valid and not entry[1]:
+            # report a valid tag as the base
+            entry[0] = base_reference
+            entry[1] = True
+
+    def match(self, layers):
+        """
+            Return (base_reference, is_valid) for the most specific (longest) base image the layers start with, or None
+        """
+        best = None
+        node = self.root
+        for a_digest in layers:
+            node = node.get(a_digest)
+            if node is None:
+                break
+            entry = node.get(_BASE_ENTRY)
+            if entry:
+                best = (entry[0], entry[1])
+        return best
+
+    def __len__(self) -> int:
+        return self.base_count
+
+
+class ecrManifestAnalyzer:
+    ''' Fetches image layer lists from ECR (batch_get_image, grouped per repository and cached by digest) and builds /
+        queries a baseLayerIndex. client_factory(region) returns the ECR client for a region.'''
+
+    def __init__(self, client_factory, platform = DEFAULT_PLATFORM, cache_size: int = DEFAULT_MANIFEST_CACHE_SIZE,
+            verbose_mode = False, metrics = None) -> None:
+        self.client_factory = client_factory
+        self.platform = platform
+        self.cache_size = cache_size
+        self.verbose_mode = verbose_mode
+        self.batch_calls = 0
+        self.metrics = metrics if metrics else get_metrics()
+
+    def _repository_error(self, action, registry_id, repository, error) -> None:
+        print("Failed to {0} {1}/{2}: {3}".format(action, registry_id, repository, error))
+        self.metrics.add_count('manifestErrors')
+
+    def _cache_layers(self, digest, layers) -> None:
+        with _manifest_layers_lock:
+            if len(_manifest_layers) >= self.cache_size:
+                _manifest_layers.clear()
+            _manifest_layers[digest] = layers
+
+    def _pick_platform(self, manifest_list) -> str:
+        manifests = manifest_list.get('manifests', [])
+        for a_manifest in manifests:
+            platform = a_manifest.get('platform', {})
+            if (platform.get('os'), platform.get('architecture')) == self.platform:
+                return a_manifest['digest']
+        return manifests[0]['digest'] if manifests else ''
+
+    def _batch_get(self, registry_id, region, repository, images) -> list:
+        """
+            batch_get_image for the images (<= 100) of one repository, returns [(image, digest, manifest), ...]. A repository
+            that can't be read returns [] so its images fall back to the tag check.
+        """
+        self.batch_calls += 1
+        try:
+            response = self.client_factory(region).batch_get_image(registryId = registry_id, repositoryName = repository,
+                imageIds = [_image_id(an_image) for an_image in images], acceptedMediaTypes = MANIFEST_MEDIA_TYPES)
+        except botocore.exceptions.ClientError as e:
+            self._repository_error('read the manifests of', registry_id, repository, e)
+            return []
+        if self.verbose_mode:
+            for a_failure in response.get('failures', []):
+                print("batch_get_image failure: {0}".format(a_failure))
+
+        requested = { (an_image.digest or an_image.tag): an_image for an_image in images }
+        results = []
+        for a_result in response.get('images', []):
+            image_id = a_result.get('imageId', {})
+            an_image = requested.get(image_id.get('imageDigest')) or requested.get(image_id.get('imageTag'))
+            if an_image:
+                results.append((an_image, image_id.get('imageDigest', ''), json.loads(a_result['imageManifest'])))
+        return results
+
+    def get_layers(self, images) -> dict:
+        """
+            Return { ecrImage: (layer_digest, ...) } for the images whose manifests could be read. Cached digests cost no
+            API calls, the rest are fetched with one batch_get_image call per repository per 100 images. Multi-arch
+            manifest lists are resolved to the configured platform with a second round of calls.
+        """
+        layers_by_image = {}
+        to_fetch = {}
+        with _manifest_layers_lock:
+            for an_image in set(images):
+                layers = _manifest_layers.get(an_image.digest) if an_image.digest else None
+                if layers is not None:
+                    layers_by_image[an_image] = layers
+                else:
+                    to_fetch.setdefault((an_image.registry_id, an_image.region, an_image.repository), []).append(an_image)
+
+        # image lists (multi-arch) to resolve: { (registry_id, region, repository): { child_digest: [parent image, ...] } }
+        children = {}
+        for (registry_id, region, repository), repository_images in to_fetch.items():
+            for i in range(0, len(repository_images), BATCH_GET_IMAGE_SIZE):
+                for an_image, digest, manifest in self._batch_get(registry_id, region, repository, repository_images[i:i + BATCH_GET_IMAGE_SIZE]):
+                    if 'manifests' in manifest:
+                        child_digest = self._pick_platform(manifest)
+                        if child_digest:
+                            children.setdefault((registry_id, region, repository), {}).setdefault(child_digest, []).append((an_image, digest))
+                        continue
+                    layers = tuple(a_layer['digest'] for a_layer in manifest.get('layers', []))
+                    layers_by_image[an_image] = layers
+                    if digest:
+                        self._cache_layers(digest, layers)
+
+        for (registry_id, region, repository), parents in children.items():
+            child_images = [ecrImage(registry_id, region, repository, child_digest, '') for child_digest in parents]
+            child_layers = self.get_layers(child_images)
+            for a_child, layers in child_layers.items():
+                for an_image, digest in parents[a_child.digest]:
+                    layers_by_image[an_image] = layers
+                    if digest:
+                        self._cache_layers(digest, layers)
+
+        return layers_by_image
+
+    def list_repository_images(self, registry_id, region, repository) -> list:
+        """
+            Every tagged image in a repository as ecrImage(s) (one per tag), follows nextToken. A repository that can't be
+            listed returns [] (it adds nothing to the base index)
+        """
+        ecr_client = self.client_factory(region)
+        images = []
+        list_args = { 'registryId': registry_id, 'repositoryName': repository, 'filter': { 'tagStatus': 'TAGGED' } }
+        while True:
+            try:
+                response = ecr_client.list_images(**list_args)
+            except botocore.exceptions.ClientError as e:
+                self._repository_error('list', registry_id, repository, e)
+                return []
+            images.extend(ecrImage(registry_id, region, repository, an_id.get('imageDigest', ''), an_id.get('imageTag', ''))
+                for an_id in response.get('imageIds', []) if an_id.get('imageTag'))
+            next_token = response.get('nextToken')
+            if not next_token:
+                return images
+            list_args['nextToken'] = next_token
+
+    def build_base_layer_index(self, base_repositories, policy) -> baseLayerIndex:
+        """
+            Index every tagged image of the base image repositories (full ECR repository uris, no tag). Tags the policy
+            accepts are marked valid, the others are kept so images on an outdated base are still recognised.
+        """
+        index = baseLayerIndex()
+        for a_repository_uri in base_repositories:
+            # parse as "<uri>:latest" just to split out the registry parts
+            base_repository = parse_ecr_image(a_repository_uri + ':latest')
+            if not base_repository:
+                print("Skipping base image repository {0}, not an ECR repository".format(a_repository_uri))
+                continue
+            images = self.list_repository_images(base_repository.registry_id, base_repository.region, base_repository.repository)
+            layers_by_digest = { an_image.digest: layers for an_image, layers in self.get_layers(images).items() }
+            for an_image in images:
+                layers = layers_by_digest.get(an_image.digest)
+                if layers:
+                    index.add(layers, "{0}:{1}".format(an_image.repository, an_image.tag), policy.matches(an_image.tag))
+        return index
+
+
+def classify_records_by_manifest(records, manifest_analyzer, base_index, fallback, batch_size: int = 500):
+    """
+        Set validBaseImage from the image layers for ECR images. Records are buffered batch_size at a time so their manifests
+        are fetched together. Images that aren't in ECR, can't be read or don't sit on a known base image are passed to
+        fallback(records) (the tag based classify_records).
+    """
+    batch = []
+
+    def flush():
+        ecr_images = [parse_ecr_image(a_record['image'], a_record.get('imageDigest')) for a_record in batch]
+        layers_by_image = manifest_analyzer.get_layers([an_image for an_image in ecr_images if an_image])
+        unmatched = []
+        for a_record, an_image in zip(batch, ecr_images):
+            match = base_index.match(layers_by_image[an_image]) if an_image in layers_by_image else None
+            if match:
+                a_record['validBaseImage'] = match[1]
+            else:
+                unmatched.append(a_record)
+        # fallback classification is done in place, only drain it
+        for _ in fallback(unmatched):
+            pass
+        return batch
+
+    for a_record in records:
+        batch.append(a_record)
+        if len(batch) >= batch_size:
+            yield from flush()
+            batch = []
+    if batch:
+        yield from flush()
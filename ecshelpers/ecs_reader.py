@@ -1,10 +1,172 @@
 import json
 import os
-import csv
-import boto3 
+import time
 
-from ecs_utils import ecsUtils as ecsUtils
+import aws_clients
+from ecs_utils import ecsUtils as ecsUtils, ECS_CLIENT_CONFIG
 from docker_image_analyzer import dockerImageAnalyzer as dia
+from scan_engine import scanEngine, assumedRoleSessionPool, parse_scan_targets
+from s3_report_writer import (s3ReportWriter, partitionedReportWriter, create_report_writer, report_key_for_format, check_report_format,
+    DEFAULT_MAX_OPEN_PARTITIONS)
+from scan_checkpoint import scanCheckpoint, incrementalScanner
+from service_scanner import serviceScanner, taskDefinitionCache
+from scan_coordinator import write_shard_marker
+from ecr_manifest_analyzer import ecrManifestAnalyzer, classify_records_by_manifest, DEFAULT_BASE_INDEX_TTL
+from inspector_findings import findingsIndex, iter_ecr_findings, join_findings, FINDING_FIELD_NAMES
+from compliance_summary import complianceSummary, summarize_records, summary_key
+from rate_limiter import rate_limiter_stats
+from scan_metrics import reset_metrics, DEFAULT_NAMESPACE
+from scan_pipeline import scan_records, classify_records, run_pipeline, DEFAULT_MAX_RECORDS_IN_FLIGHT
+
+REPORT_FIELD_NAMES = ['account_id', 'name', 'group', 'validBaseImage', 'image', 'imageDigest', 'cluster_arn', 'region']
+DELTA_REPORT_FIELD_NAMES = ['change'] + REPORT_FIELD_NAMES
+SERVICE_REPORT_FIELD_NAMES = REPORT_FIELD_NAMES + ['taskDefinition', 'runningCount']
+DEFAULT_CHECKPOINT_KEY = 'dockerImagesSecInfo/scanCheckpoint.json.gz'
+
+# assumed role credentials are cached for the life of the container so warm invocations don't call sts again
+_session_pools = {}
+# task definition revisions never change so they are cached for the life of the container (and optionally in S3)
+_task_definition_cache = None
+# (base image layer index, built at) keyed by (base repositories, policy fingerprint), rebuilt when either changes or
+# BASE_INDEX_TTL runs out (so newly pushed base images are picked up)
+_base_layer_indexes = {}
+
+
+def init_clients() -> dict:
+    """
+        Create (once per container) the clients the handler needs. Safe to call on every invocation.
+    """
+    return { 's3': aws_clients.get_client('s3'), 'ecs': aws_clients.get_client('ecs', config = ECS_CLIENT_CONFIG) }
+
+
+def get_session_pool(role_name) -> assumedRoleSessionPool:
+    session_pool = _session_pools.get(role_name)
+    if not session_pool:
+        session_pool = assumedRoleSessionPool(role_name, sts_client = aws_clients.get_client('sts'))
+        _session_pools[role_name] = session_pool
+    return session_pool
+
+
+def get_task_definition_cache(s3_client, bucket_name, cache_key) -> taskDefinitionCache:
+    global _task_definition_cache
+    if _task_definition_cache is None:
+        _task_definition_cache = taskDefinitionCache.load_from_s3(s3_client, bucket_name, cache_key) if cache_key else taskDefinitionCache()
+    return _task_definition_cache
+
+
+def get_record_classifier(dia_instance, policy, metrics):
+    """
+        Return classify(records) for ANALYSIS_MODE: 'tag' reads the base image from the "_base-" tag, 'manifest' matches the
+        ECR image layers against the layers of the BASE_IMAGE_REPOSITORIES images (falling back to the tag when it can't)
+    """
+    def classify_by_tag(records):
+        return classify_records(records, dia_instance, policy, metrics)
+
+    if os.getenv('ANALYSIS_MODE', 'tag').lower() != 'manifest':
+        return classify_by_tag
+
+    manifest_analyzer = ecrManifestAnalyzer(lambda region: aws_clients.get_client('ecr', region_name = region), metrics = metrics)
+    base_repositories = tuple(a_repository.strip() for a_repository in os.getenv('BASE_IMAGE_REPOSITORIES', '').split(',') if a_repository.strip())
+    cache_key = (base_repositories, policy.fingerprint)
+    ttl_seconds = int(os.getenv('BASE_INDEX_TTL', str(DEFAULT_BASE_INDEX_TTL)))
+    base_index, built_at = _base_layer_indexes.get(cache_key, (None, 0))
+    if base_index is None or time.time() - built_at >= ttl_seconds:
+        with metrics.stage('baseIndex'):
+            base_index = manifest_analyzer.build_base_layer_index(base_repositories, policy)
+        print("indexed the layers of {0} base images".format(len(base_index)))
+        _base_layer_indexes.clear()
+        _base_layer_indexes[cache_key] = (base_index, time.time())
+
+    def classify_by_manifest(records):
+        return classify_records_by_manifest(records, manifest_analyzer, base_index, classify_by_tag)
+    return classify_by_manifest
+
+
+def pull_findings_index(inspector_client, metrics) -> findingsIndex:
+    """
+        Pull the active Inspector2 ECR findings into a digest index
+    """
+    with metrics.stage('findings'):
+        index = findingsIndex.from_findings(iter_ecr_findings(inspector_client))
+    print("indexed {0} inspector findings for {1} images".format(index.finding_count, len(index)))
+    metrics.add_count('findings', index.finding_count)
+    return index
+
+
+def add_findings_join(classify, index):
+    """
+        Return classify(records) that also joins the finding counts of the findingsIndex onto each record
+    """
+    def classify_and_join(records):
+        return join_findings(classify(records), index)
+    return classify_and_join
+
+
+def findings_enabled() -> bool:
+    # INCLUDE_FINDINGS adds the Inspector2 columns to the task based reports
+    return os.getenv('INCLUDE_FINDINGS', 'false').lower() == 'true'
+
+
+def report_field_names() -> list:
+    if findings_enabled():
+        return REPORT_FIELD_NAMES + FINDING_FIELD_NAMES
+    return REPORT_FIELD_NAMES
+
+
+def summary_enabled() -> bool:
+    # WRITE_SUMMARY writes a small compliance summary json next to the task based reports
+    return os.getenv('WRITE_SUMMARY', 'true').lower() == 'true'
+
+
+def check_scan_mode() -> None:
+    """
+        Reject settings an incremental scan can't honour, it reuses the checkpoint's rows (tag based classification, no
+        finding columns) instead of silently writing a report without them
+    """
+    if os.getenv('SCAN_MODE', 'full').lower() != 'incremental' or os.getenv('SCAN_TARGETS', '').strip():
+        return
+    if os.getenv('ANALYSIS_MODE', 'tag').lower() == 'manifest':
+        raise ValueError("SCAN_MODE=incremental doesn't support ANALYSIS_MODE=manifest, use SCAN_MODE=full")
+    if findings_enabled():
+        raise ValueError("SCAN_MODE=incremental doesn't support INCLUDE_FINDINGS=true, use SCAN_MODE=full")
+
+
+def add_compliance_summary(classify, summary):
+    """
+        Return classify(records) that also feeds every classified record to the compliance summary
+    """
+    def classify_and_summarize(records):
+        return summarize_records(classify(records), summary)
+    return classify_and_summarize
+
+
+def write_summary(summary, s3_client, bucket_name, report_key, metrics, failures = None) -> dict:
+    """
+        Save the summary with the scan's failure counts (failures, default the metrics' own) so a partial scan is visible
+    """
+    key = os.getenv('RESULT_SUMMARY_KEY') or summary_key(report_key)
+    with metrics.stage('summary'):
+        summary_doc = summary.save_to_s3(s3_client, bucket_name, key, failures if failures is not None else metrics.failure_counts())
+    print("wrote summary of {0} rows ({1} non compliant) to {2}".format(summary_doc['rows'], summary_doc['nonCompliantRows'], key))
+    return summary_doc
+
+
+def create_output_writer(s3_client, bucket_name, report_key, field_names, compress = False, run_id = None):
+    """
+        Writer for the main report in REPORT_FORMAT (csv, jsonl or parquet). With REPORT_PARTITIONED the rows are split into
+        dt=/account_id=/cluster= objects under the report key (minus its extension) instead of a single object, named after
+        run_id (the Lambda request id) so concurrent runs don't overwrite each other.
+    """
+    report_format = os.getenv('REPORT_FORMAT', 'csv').lower()
+    # json lines are always gzip'd, they compress very well
+    compress = compress or report_format == 'jsonl'
+    if os.getenv('REPORT_PARTITIONED', 'false').lower() == 'true':
+        prefix, _ = os.path.splitext(report_key)
+        return partitionedReportWriter(bucket_name, prefix, field_names, report_format, s3_client = s3_client, compress = compress,
+            run_id = run_id, max_open_partitions = int(os.getenv('REPORT_MAX_OPEN_PARTITIONS', str(DEFAULT_MAX_OPEN_PARTITIONS))))
+    if report_format != 'csv':
+        report_key = report_key_for_format(report_key, report_format, compress)
+    return create_report_writer(report_format, bucket_name, report_key, field_names, s3_client = s3_client, compress = compress)
 
 
 def lambda_handler(event, context):
@@ -21,8 +183,12 @@ def lambda_handler(event, context):
         Return doc: https://docs.aws.amazon.com/apigateway/latest/developerguide/set-up-lambda-proxy-integrations.html
     """
 
-    sts = boto3.client('sts')
-    print(sts.get_caller_identity())
+    # a bad REPORT_FORMAT / SCAN_MODE combination fails before anything is scanned
+    check_report_format(os.getenv('REPORT_FORMAT', 'csv').lower())
+    check_scan_mode()
+    clients = init_clients()
+    # fresh collector per invocation, emitted as a CloudWatch EMF log line at the end
+    metrics = reset_metrics()
 
     # pull in buckeet and key for base images
     bucket_name = os.getenv('BUCKET_NAME')
@@ -31,48 +197,259 @@ def lambda_handler(event, context):
 
     # fetch base images from S3
     dia_instance = dia(False)
-    base_images = dia_instance.fetch_base_images_from_s3(bucket_name, base_image_key)
+    # cached across warm invocations, only re-downloaded when the ETag changes
+    cache_ttl = int(os.getenv('BASE_IMAGE_CACHE_TTL', '300'))
+    with metrics.stage('policy'):
+        base_images = dia_instance.get_base_image_policy(bucket_name, base_image_key, s3_client = clients['s3'], ttl_seconds = cache_ttl)
     # print(base_images)
+    classify = get_record_classifier(dia_instance, base_images, metrics)
+    field_names = report_field_names()
 
-    print("creating boto session")
-    boto_session = boto3.Session()
-    utils_instance = ecsUtils(verbose_mode = False, session=boto_session)
+    max_workers = int(os.getenv('SCAN_MAX_WORKERS', '8'))
+    compress_results = os.getenv('COMPRESS_RESULTS', 'false').lower() == 'true'
+    scan_targets = parse_scan_targets(os.getenv('SCAN_TARGETS', ''))
+    scan_mode = os.getenv('SCAN_MODE', 'full').lower()
+    max_records_in_flight = int(os.getenv('MAX_RECORDS_IN_FLIGHT', str(DEFAULT_MAX_RECORDS_IN_FLIGHT)))
 
-    print("pulling all ECS related tasks")
-    # get all running image on the cluster
-    task_results = utils_instance.get_image_info_for_tasks('TestCluster1', 'STOPPED')
+    # invoked by the base_image_finder coordinator for one shard of the clusters
+    shard = event.get('shard') if isinstance(event, dict) else None
+    if shard:
+        print("scanning shard {0} ({1} clusters) of run {2}".format(shard['shard_id'], len(shard['clusters']), shard['run_id']))
+        if shard.get('assume_role'):
+            session = get_session_pool(os.getenv('SCAN_ROLE_NAME', 'EcsImageScannerRole')).get_session(shard['account_id'], shard['region'])
+            utils_instance = ecsUtils(verbose_mode = False, session = session, max_workers = max_workers, account_id = shard['account_id'])
+        else:
+            utils_instance = ecsUtils(verbose_mode = False, max_workers = max_workers, ecs_client = clients['ecs'])
+        if findings_enabled():
+            # the coordinator pulls the findings once per run, only pull them here when it didn't
+            if shard.get('findings_key'):
+                with metrics.stage('findings'):
+                    index = findingsIndex.load_from_s3(clients['s3'], bucket_name, shard['findings_key'])
+            else:
+                index = pull_findings_index(aws_clients.get_client('inspector2'), metrics)
+            classify = add_findings_join(classify, index)
+        run_shard_scan(shard, utils_instance, dia_instance, base_images, clients['s3'], bucket_name, max_workers, compress_results,
+            max_records_in_flight, metrics, classify, field_names)
+        emit_metrics(metrics, 'shard')
+        return _response(bucket_name, base_image_key, metrics.failure_counts())
 
-    # decorate task result w/results of matchings to base images
-    for task_result in task_results:
-        result = dia_instance.image_matches_current_bases(task_result['image'], base_images)
-        task_result['validBaseImage'] = result
+    if scan_mode == 'services' and not scan_targets:
+        print("scanning the services of every cluster in the account")
+        utils_instance = ecsUtils(verbose_mode = False, max_workers = max_workers, ecs_client = clients['ecs'])
+        cache_key = os.getenv('TASK_DEFINITION_CACHE_KEY', '')
+        with metrics.stage('checkpoint'):
+            cache = get_task_definition_cache(clients['s3'], bucket_name, cache_key)
+        run_service_scan(utils_instance, dia_instance, base_images, clients['s3'], bucket_name, result_output_key, cache,
+            max_workers, compress_results, metrics, classify)
+        if cache_key and cache.dirty:
+            with metrics.stage('checkpoint'):
+                cache.save_to_s3(clients['s3'], bucket_name, cache_key)
+        print("task definition cache: {0}".format(cache.stats()))
+        emit_metrics(metrics, 'services')
+        return _response(bucket_name, base_image_key, metrics.failure_counts())
 
-    if len(task_results) > 0:
-        write_results_to_s3(task_results, bucket_name, result_output_key)
+    if scan_mode == 'incremental' and not scan_targets:
+        print("running incremental scan of every cluster in the account")
+        utils_instance = ecsUtils(verbose_mode = False, max_workers = max_workers, ecs_client = clients['ecs'])
+        checkpoint_key = os.getenv('CHECKPOINT_KEY', DEFAULT_CHECKPOINT_KEY)
+        delta_key = os.getenv('RESULT_DELTA_KEY') or delta_report_key(result_output_key)
+        summary = complianceSummary() if summary_enabled() else None
+        run_incremental_scan(utils_instance, dia_instance, base_images, clients['s3'], bucket_name, result_output_key, delta_key,
+            checkpoint_key, max_workers, compress_results, metrics, summary)
+        if summary:
+            write_summary(summary, clients['s3'], bucket_name, result_output_key, metrics)
+        emit_metrics(metrics, 'incremental')
+        return _response(bucket_name, base_image_key, metrics.failure_counts())
 
+    if findings_enabled():
+        classify = add_findings_join(classify, pull_findings_index(aws_clients.get_client('inspector2'), metrics))
+    summary = complianceSummary() if summary_enabled() else None
+    if summary:
+        classify = add_compliance_summary(classify, summary)
+    report_writer = create_output_writer(clients['s3'], bucket_name, result_output_key, field_names, compress_results,
+        run_id = getattr(context, 'aws_request_id', None))
+    try:
+        if scan_targets:
+            print("scanning {0} account/region targets".format(len(scan_targets)))
+            session_pool = get_session_pool(os.getenv('SCAN_ROLE_NAME', 'EcsImageScannerRole'))
+            engine = scanEngine(session_pool, 'STOPPED', max_workers = max_workers, metrics = metrics)
+            # stream each cluster's rows to S3 as it finishes
+            for target, cluster_name, cluster_results in engine.iter_scan(scan_targets):
+                print("cluster {0} returned {1} containers".format(cluster_name, len(cluster_results)))
+                cluster_results = list(classify(cluster_results))
+                with metrics.stage('upload'):
+                    report_writer.write_rows(cluster_results)
+                metrics.add_count('rows', len(cluster_results))
+        else:
+            utils_instance = ecsUtils(verbose_mode = False, max_workers = max_workers, ecs_client = clients['ecs'])
+
+            print("streaming all ECS related tasks from every cluster in the account")
+            with metrics.stage('discovery'):
+                cluster_arns = utils_instance.get_cluster_arns()
+            records = scan_records(utils_instance, dia_instance, base_images, cluster_arns, 'STOPPED',
+                max_workers = max_workers, max_records_in_flight = max_records_in_flight, classify = classify)
+            run_pipeline(records, report_writer, metrics)
+    except Exception:
+        report_writer.abort()
+        raise
+
+    with metrics.stage('upload'):
+        finish_report(report_writer)
+    if summary:
+        write_summary(summary, clients['s3'], bucket_name, result_output_key, metrics)
+    emit_metrics(metrics, 'targets' if scan_targets else 'full')
+    return _response(bucket_name, base_image_key, metrics.failure_counts())
+
+def _response(bucket_name, base_image_key, failures = None) -> dict:
     message = "app with env: {0} and baseImageKey: {1}".format(bucket_name, base_image_key)
+    failures = failures if failures else {}
+    if any(failures.values()):
+        print("scan is incomplete: {0}".format(failures))
     return {
         "statusCode": 200,
         "body": json.dumps(
             {
                 "message": message,
+                "failures": failures,
+                "complete": not any(failures.values()),
             }
         ),
     }
 
-def write_results_to_s3(task_results, bucket_name, bucket_key):
-    print(task_results)
+def finish_report(report_writer, keep_empty = False) -> None:
+    # only write the report when something was found (keep_empty writes a header only report instead)
+    if report_writer.rows_written > 0 or keep_empty:
+        report_writer.close()
+    else:
+        report_writer.abort()
+    # the writer's key, the format / partitioning can change it from the configured one
+    print("wrote {0} rows to {1}".format(report_writer.rows_written, report_writer.key))
 
-    field_names = ['account_id', 'name', 'group', 'validBaseImage', 'image', 'imageDigest', 'cluster_arn']
-    with open('/tmp/test1.csv', 'w') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames = field_names)
-        writer.writeheader()
-        writer.writerows(task_results)
+def emit_metrics(metrics, scan_mode) -> dict:
+    """
+        Log the run metrics in CloudWatch EMF (a single line that CloudWatch turns into metrics)
+    """
+    # limiter stats are cumulative for the life of the container
+    print("ECS api calls: {0}".format(rate_limiter_stats()))
+    namespace = os.getenv('METRICS_NAMESPACE', DEFAULT_NAMESPACE)
+    return metrics.emit(namespace, { 'ScanMode': scan_mode })
+
+def delta_report_key(report_key) -> str:
+    # dockerImagesSecInfo/scanResults1.csv -> dockerImagesSecInfo/scanResults1-delta.csv
+    root, extension = os.path.splitext(report_key)
+    return "{0}-delta{1}".format(root, extension)
+
+def run_shard_scan(shard, utils_instance, dia_instance, policy, s3_client, bucket_name, max_workers = 8, compress = False,
+        max_records_in_flight = DEFAULT_MAX_RECORDS_IN_FLIGHT, metrics = None, classify = None, field_names = REPORT_FIELD_NAMES) -> int:
+    """
+        Scan the clusters of one coordinator shard into the shard's partial report, then write its done marker
+        (a failed marker when the scan fails so the coordinator doesn't wait for it)
+    """
+    metrics = metrics if metrics else utils_instance.metrics
+    output_key = shard['output_key']
+    report_writer = s3ReportWriter(bucket_name, output_key, field_names, s3_client = s3_client, compress = compress)
+    try:
+        records = scan_records(utils_instance, dia_instance, policy, shard['clusters'], 'STOPPED',
+            max_workers = max_workers, max_records_in_flight = max_records_in_flight, classify = classify)
+        if shard.get('region'):
+            records = (dict(a_record, region = shard['region']) for a_record in records)
+        run_pipeline(records, report_writer, metrics)
+        with metrics.stage('upload'):
+            finish_report(report_writer)
+    except Exception as e:
+        report_writer.abort()
+        write_shard_marker(s3_client, bucket_name, output_key, 0, e)
+        raise
+
+    write_shard_marker(s3_client, bucket_name, output_key, report_writer.rows_written, failures = metrics.failure_counts())
+    return report_writer.rows_written
+
+def run_service_scan(utils_instance, dia_instance, policy, s3_client, bucket_name, report_key, task_definition_cache = None,
+        max_workers = 8, compress = False, metrics = None, classify = None) -> int:
+    """
+        Report every container of every service deployment (resolved from task definitions instead of describing each task)
+    """
+    metrics = metrics if metrics else utils_instance.metrics
+    scanner = serviceScanner(utils_instance, task_definition_cache)
+    report_writer = s3ReportWriter(bucket_name, report_key, SERVICE_REPORT_FIELD_NAMES, s3_client = s3_client, compress = compress)
+    try:
+        cluster_scans = utils_instance.iter_image_info_for_clusters('RUNNING', max_cluster_workers = max_workers, scan_cluster = scanner.scan_cluster)
+        for cluster_name, cluster_results in cluster_scans:
+            print("cluster {0} has {1} service containers".format(cluster_name, len(cluster_results)))
+            cluster_results = list(classify(cluster_results) if classify else classify_records(cluster_results, dia_instance, policy, metrics))
+            with metrics.stage('upload'):
+                report_writer.write_rows(cluster_results)
+            metrics.add_count('rows', len(cluster_results))
+    except Exception:
+        report_writer.abort()
+        raise
+
+    with metrics.stage('upload'):
+        finish_report(report_writer)
+    return report_writer.rows_written
+
+def run_incremental_scan(utils_instance, dia_instance, policy, s3_client, bucket_name, report_key, delta_key, checkpoint_key,
+        max_workers = 8, compress = False, metrics = None, summary = None) -> scanCheckpoint:
+    """
+        Scan every cluster against the checkpoint from the previous run. Only new tasks are described/classified, the full
+        report and a delta report (rows for added/removed tasks) are written and the new checkpoint is saved. Every row
+        of the full report is added to summary (optional complianceSummary).
+    """
+    metrics = metrics if metrics else utils_instance.metrics
+    with metrics.stage('checkpoint'):
+        previous_checkpoint = scanCheckpoint.load_from_s3(s3_client, bucket_name, checkpoint_key)
+    print("loaded checkpoint with {0} tasks".format(previous_checkpoint.task_count()))
+    scanner = incrementalScanner(utils_instance, dia_instance, policy, previous_checkpoint, 'STOPPED')
+
+    report_writer = s3ReportWriter(bucket_name, report_key, REPORT_FIELD_NAMES, s3_client = s3_client, compress = compress)
+    delta_writer = s3ReportWriter(bucket_name, delta_key, DELTA_REPORT_FIELD_NAMES, s3_client = s3_client, compress = compress)
+    try:
+        with metrics.stage('discovery'):
+            cluster_arns = utils_instance.get_cluster_arns()
+        cluster_scans = utils_instance.iter_image_info_for_clusters('STOPPED', cluster_arns, max_cluster_workers = max_workers,
+            scan_cluster = scanner.scan_cluster)
+        for cluster_name, cluster_result in cluster_scans:
+            if not cluster_result:
+                continue
+            all_rows, added_rows, removed_rows = cluster_result
+            print("cluster {0} has {1} containers ({2} added, {3} removed)".format(cluster_name, len(all_rows), len(added_rows), len(removed_rows)))
+            with metrics.stage('upload'):
+                report_writer.write_rows(summarize_records(all_rows, summary) if summary else all_rows)
+                delta_writer.write_rows(dict(a_row, change = 'added') for a_row in added_rows)
+                delta_writer.write_rows(dict(a_row, change = 'removed') for a_row in removed_rows)
+            metrics.add_count('rows', len(all_rows))
+            metrics.add_count('addedRows', len(added_rows))
+            metrics.add_count('removedRows', len(removed_rows))
+        # clusters deleted since the last run aren't listed any more, every row they had is removed
+        for cluster_name, removed_rows in scanner.removed_clusters(cluster_arns):
+            print("cluster {0} is gone ({1} removed)".format(cluster_name, len(removed_rows)))
+            with metrics.stage('upload'):
+                delta_writer.write_rows(dict(a_row, change = 'removed') for a_row in removed_rows)
+            metrics.add_count('removedRows', len(removed_rows))
+    except Exception:
+        report_writer.abort()
+        delta_writer.abort()
+        raise
 
-    s3 = boto3.resource('s3')
-    bucket_to_upload = s3.Bucket(bucket_name)
+    with metrics.stage('upload'):
+        finish_report(report_writer)
+        # always replace the previous delta, otherwise last run's changes would look like this run's
+        finish_report(delta_writer, keep_empty = True)
+    with metrics.stage('checkpoint'):
+        scanner.next_checkpoint.save_to_s3(s3_client, bucket_name, checkpoint_key)
+    print("saved checkpoint with {0} tasks".format(scanner.next_checkpoint.task_count()))
+    return scanner.next_checkpoint
 
-    bucket_to_upload.upload_file('/tmp/test1.csv', bucket_key)
+def write_results_to_s3(task_results, bucket_name, bucket_key, s3_client = None, compress = False, report_format = 'csv',
+        field_names = REPORT_FIELD_NAMES):
+    """
+        Stream the task results straight to S3 (multipart upload) as csv, jsonl or parquet (csv/jsonl optionally gzip'd)
+    """
+    if not s3_client:
+        s3_client = aws_clients.get_client('s3')
+    with create_report_writer(report_format, bucket_name, bucket_key, field_names, s3_client = s3_client, compress = compress) as report_writer:
+        report_writer.write_rows(task_results)
+    return report_writer.rows_written
 
 def do_echo(a_string):
     return a_string 
\ No newline at end of file
@@ -1,21 +1,96 @@
 from typing import List
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
 import boto3
+from botocore.config import Config
+
+import aws_clients
+from rate_limiter import get_rate_limiter, is_throttling_error
+from scan_metrics import get_metrics
+from result_store import resultStore, account_id_from_arn
+
+# describe_tasks accepts at most 100 task arns per call
+DESCRIBE_TASKS_BATCH_SIZE = 100
+# describe_services accepts at most 10 services per call
+DESCRIBE_SERVICES_BATCH_SIZE = 10
+# retries (throttling, which adapts the rate, and transient 5xx/timeout/connection errors) are handled by the shared rate
+# limiter instead of botocore so a request is never retried by both
+ECS_CLIENT_CONFIG = Config(retries = { 'max_attempts': 0 })
+
+def image_info_from_task(a_task_def) -> list:
+    """
+        The docker image info for each container on a task description (shared by the sync and async backends)
+    """
+    image_infos = []
+    group_info = a_task_def.get('group', 'unknown')
+    cluster_arn = a_task_def.get('clusterArn', 'unknown')
+    account_id = account_id_from_arn(cluster_arn)
+    all_containers = a_task_def.get('containers', [])
+    for a_container in all_containers:
+        image_info = { 
+            'name' : a_container.get('name','N/A'), 
+            'image': a_container.get('image','N/A'), 
+            'imageDigest': a_container.get('imageDigest','N/A'),
+            'group' : group_info,
+            'cluster_arn': cluster_arn,
+            'account_id': account_id
+            }
+        image_infos.append(image_info)
+
+    return image_infos
+
 
 class ecsUtils:
     ''' Simple methods for interacting with ECS tasks w/in an account.'''
 
-    def __init__(self, verbose_mode = False, aws_profile: str = 'default', session: boto3.Session = None) -> None:
-        if not session:
-            session = boto3.Session(profile_name=aws_profile)
+    def __init__(self, verbose_mode = False, aws_profile: str = 'default', session: boto3.Session = None, max_workers: int = 4, ecs_client = None,
+            rate_limiter = None, account_id: str = None, metrics = None) -> None:
+        if not ecs_client:
+            # shared per region/credentials so every ecsUtils for an account reuses one client and its connection pool
+            if not session:
+                session = aws_clients.get_session(aws_profile)
+            ecs_client = aws_clients.get_client('ecs', config = ECS_CLIENT_CONFIG, session = session)
 
-        self.ecs_client = session.client('ecs')
+        self.ecs_client = ecs_client
+        # every ECS call goes through the limiter shared by all ecsUtils for the same account/region
+        if not rate_limiter:
+            region = getattr(getattr(ecs_client, 'meta', None), 'region_name', None)
+            rate_limiter = get_rate_limiter(account_id, region)
+        self.rate_limiter = rate_limiter
+        # API call counts/latency are recorded in the run's metrics collector
+        self.metrics = metrics if metrics else get_metrics()
         self.verbose_mode = verbose_mode
+        # number of describe_tasks batches to run concurrently (boto3 clients are thread safe)
+        self.max_workers = max_workers
+        # a cluster scan running on one of iter_image_info_for_clusters' threads gets its share of max_workers
+        self._cluster_share = threading.local()
+
+    def _ecs_call(self, operation_name, **kwargs) -> dict:
+        operation = getattr(self.ecs_client, operation_name)
+
+        def timed_call():
+            try:
+                with self.metrics.api_call(operation_name):
+                    return operation(**kwargs)
+            except Exception as e:
+                if is_throttling_error(e):
+                    self.metrics.add_count('throttles')
+                raise
+
+        return self.rate_limiter.call(timed_call)
+
+    def describe_workers(self) -> int:
+        """
+            Threads the current cluster scan may use for its describe calls: max_workers, or its share of max_workers while
+            iter_image_info_for_clusters is scanning clusters in parallel (so the two levels don't multiply up to max_workers²)
+        """
+        return getattr(self._cluster_share, 'workers', self.max_workers)
 
     def get_cluster_info(self, cluster_name) -> list:
         """
             Print out cluster info (base boto wrapped call)
         """ 
-        response = self.ecs_client.describe_clusters( clusters = [cluster_name])
+        response = self._ecs_call('describe_clusters', clusters = [cluster_name])
         if self.verbose_mode:
             print("## Cluster Info:")
         
@@ -28,6 +103,79 @@ class ecsUtils:
 
         return results
 
+    def get_cluster_arns(self) -> list:
+        """
+            Retrieve all cluster arns in the account/region (follows nextToken across list_clusters pages)
+        """
+        cluster_arns = []
+        list_args = {}
+        while True:
+            response = self._ecs_call('list_clusters', **list_args)
+            cluster_arns.extend(response.get('clusterArns', []))
+            next_token = response.get('nextToken')
+            if not next_token:
+                break
+            list_args['nextToken'] = next_token
+
+        if self.verbose_mode:
+            print("## Found {0} clusters".format(len(cluster_arns)))
+        return cluster_arns
+
+    def iter_image_info_for_clusters(self, task_status, cluster_names = None, max_cluster_workers: int = 8, scan_cluster = None):
+        """
+            Scan a set of clusters in parallel and yield (cluster_name, image_infos) as each cluster finishes
+            Parameters:
+            task_status: STOPPED, etc..  Must be valid boto3 status
+            cluster_names: clusters to scan, defaults to every cluster in the account (list_clusters)
+            max_cluster_workers: number of clusters to scan at the same time, each cluster's describe calls share max_workers
+                between them (see describe_workers)
+            scan_cluster: optional function(cluster_name, task_status) used to scan each cluster, defaults to get_image_info_for_tasks
+
+            Returns:
+            generator of (cluster_name, list of docker image info). A cluster that fails to scan is logged and yields an empty list
+            so one bad cluster doesn't stop the rest of the account scan.
+        """
+        if cluster_names is None:
+            cluster_names = self.get_cluster_arns()
+
+        if not cluster_names:
+            return
+
+        if not scan_cluster:
+            scan_cluster = self.get_image_info_for_tasks
+
+        cluster_workers = max(1, min(max_cluster_workers, len(cluster_names)))
+        describe_workers = max(1, self.max_workers // cluster_workers)
+
+        def scan_with_share(cluster_name):
+            self._cluster_share.workers = describe_workers
+            try:
+                return scan_cluster(cluster_name, task_status)
+            finally:
+                del self._cluster_share.workers
+
+        with ThreadPoolExecutor(max_workers = cluster_workers) as executor:
+            futures = { executor.submit(scan_with_share, a_cluster): a_cluster for a_cluster in cluster_names }
+            for a_future in as_completed(futures):
+                cluster_name = futures[a_future]
+                try:
+                    cluster_results = a_future.result()
+                except Exception as e:
+                    print("Failed to scan cluster {0}: {1}".format(cluster_name, e))
+                    self.metrics.add_count('failedClusters')
+                    cluster_results = []
+                yield cluster_name, cluster_results
+
+    def get_image_info_for_all_clusters(self, task_status, cluster_names = None, max_cluster_workers: int = 8) -> resultStore:
+        """
+            Retrieve docker image info for every cluster (see iter_image_info_for_clusters) merged into a single resultStore
+            (list like, every row a dict; json.dumps(list(results)) or results.to_dicts() to serialise all of it)
+        """
+        image_infos = resultStore()
+        for _, cluster_results in self.iter_image_info_for_clusters(task_status, cluster_names, max_cluster_workers):
+            image_infos.extend(cluster_results)
+        return image_infos
+
     def get_task_arns(self, cluster_name, task_status) -> list:
         """
             Retrieve all task arns for a given cluster (across all services)
@@ -42,20 +190,34 @@ class ecsUtils:
         if self.verbose_mode:
             print("### Pulling tasks")
 
-        # list out tasks to find for this cluster (STOPPED)
-        ecs_tasks = self.ecs_client.list_tasks(cluster = cluster_name, desiredStatus = task_status)
-        if self.verbose_mode:
-            print(ecs_tasks)
-
         # collect up task arns
-        task_arns = [i for i in ecs_tasks.get('taskArns', [])]
+        task_arns = []
+        for a_page in self.iter_task_arn_pages(cluster_name, task_status):
+            task_arns.extend(a_page)
+
         if self.verbose_mode:
             for a_task_arn in task_arns:
                 print(a_task_arn)
 
         return task_arns
 
-    def get_image_info_for_tasks(self, cluster_name, task_status) -> list:
+    def iter_task_arn_pages(self, cluster_name, task_status):
+        """
+            Yield the task arns for a cluster one list_tasks page (<= 100 arns) at a time, following nextToken lazily
+        """
+        list_args = { 'cluster': cluster_name, 'desiredStatus': task_status }
+        while True:
+            ecs_tasks = self._ecs_call('list_tasks', **list_args)
+            if self.verbose_mode:
+                print(ecs_tasks)
+
+            yield ecs_tasks.get('taskArns', [])
+            next_token = ecs_tasks.get('nextToken')
+            if not next_token:
+                break
+            list_args['nextToken'] = next_token
+
+    def get_image_info_for_tasks(self, cluster_name, task_status) -> resultStore:
         """
             Retrieve docker image info for all task arns for a given cluster (across all services)
             Parameters:
@@ -63,43 +225,108 @@ class ecsUtils:
             task_status: STOPPED, etc..  Must be valid boto3 status
 
             Returns:
-            list of docker image info (Name, digest, image) for the images running w/in the containers on the tasks
+            resultStore (list like, every row a dict) of docker image info (Name, digest, image) for the images running w/in
+            the containers on the tasks
         """
 
         task_arns = self.get_task_arns(cluster_name, task_status)
 
         if not task_arns:
             print("No task ARNs found")
-            return []
+            return resultStore()
+
+        return self.get_image_info_for_task_arns(cluster_name, task_arns)
+
+    def get_image_info_for_task_arns(self, cluster_name, task_arns) -> resultStore:
+        """
+            Retrieve docker image info for the given task arns (see describe_tasks for how the calls are batched)
+            Parameters:
+            cluster_name: the name of the cluster to use
+            task_arns: list of task arns to describe
+
+            Returns:
+            resultStore (list like, every row a dict) of docker image info in the same order as the task batches
+        """
+        return resultStore(image_info for a_task in self.describe_tasks(cluster_name, task_arns) for image_info in self.extract_image_info_from_task(a_task))
+
+    def get_image_info_by_task_arn(self, cluster_name, task_arns) -> dict:
+        """
+            Same as get_image_info_for_task_arns but grouped by task arn ({ task_arn: [docker image info] })
+        """
+        return { a_task.get('taskArn'): self.extract_image_info_from_task(a_task) for a_task in self.describe_tasks(cluster_name, task_arns) }
+
+    def describe_tasks(self, cluster_name, task_arns) -> list:
+        """
+            Describe the given task arns. The arns are split into describe_tasks batches (max 100 per call)
+            which are run concurrently using up to describe_workers() threads.
+
+            Returns:
+            list of task descriptions in the same order as the task batches
+        """
 
         # pull out the details of the tasks related to docker images
         if self.verbose_mode:
             print("### Pulling tasks details to find docker images")
 
-        task_descriptions = self.ecs_client.describe_tasks(cluster = cluster_name, tasks = task_arns)
-        image_infos = []
-
-        for a_task_def in task_descriptions.get('tasks', []):
-            group_info = a_task_def.get('group', 'unknown')
-            cluster_arn = a_task_def.get('clusterArn', 'unknown')
-            account_id = self.extract_account_id_from_cluster_arn(cluster_arn)
-            all_containers = a_task_def.get('containers', [])
-            for a_container in all_containers:
-                image_info = { 
-                    'name' : a_container.get('name','N/A'), 
-                    'image': a_container.get('image','N/A'), 
-                    'imageDigest': a_container.get('imageDigest','N/A'),
-                    'group' : group_info,
-                    'cluster_arn': cluster_arn,
-                    'account_id': account_id
-                    }
-                image_infos.append(image_info)
+        batches = [task_arns[i:i + DESCRIBE_TASKS_BATCH_SIZE] for i in range(0, len(task_arns), DESCRIBE_TASKS_BATCH_SIZE)]
+        max_workers = self.describe_workers()
+        if max_workers <= 1 or len(batches) <= 1:
+            batch_results = [self.describe_task_batch(cluster_name, a_batch) for a_batch in batches]
+        else:
+            with ThreadPoolExecutor(max_workers = min(max_workers, len(batches))) as executor:
+                batch_results = list(executor.map(lambda a_batch: self.describe_task_batch(cluster_name, a_batch), batches))
 
-        return image_infos
+        return [a_task for a_result in batch_results for a_task in a_result]
+
+    def describe_task_batch(self, cluster_name, task_arns) -> list:
+        """
+            Describe a single batch (<= 100) of task arns and return the task descriptions
+        """
+        task_descriptions = self._ecs_call('describe_tasks', cluster = cluster_name, tasks = task_arns)
+        if self.verbose_mode:
+            for a_failure in task_descriptions.get('failures', []):
+                print("describe_tasks failure: {0}".format(a_failure))
+
+        return task_descriptions.get('tasks', [])
+
+    def iter_service_arn_pages(self, cluster_name):
+        """
+            Yield the service arns for a cluster one list_services page at a time, following nextToken lazily
+        """
+        list_args = { 'cluster': cluster_name }
+        while True:
+            response = self._ecs_call('list_services', **list_args)
+            yield response.get('serviceArns', [])
+            next_token = response.get('nextToken')
+            if not next_token:
+                break
+            list_args['nextToken'] = next_token
+
+    def describe_services(self, cluster_name, service_arns) -> list:
+        """
+            Describe the given services in describe_services batches (max 10 per call)
+        """
+        services = []
+        for i in range(0, len(service_arns), DESCRIBE_SERVICES_BATCH_SIZE):
+            response = self._ecs_call('describe_services', cluster = cluster_name, services = service_arns[i:i + DESCRIBE_SERVICES_BATCH_SIZE])
+            if self.verbose_mode:
+                for a_failure in response.get('failures', []):
+                    print("describe_services failure: {0}".format(a_failure))
+            services.extend(response.get('services', []))
+        return services
+
+    def describe_task_definition(self, task_definition_arn) -> dict:
+        """
+            Describe a single task definition (family:revision or full arn)
+        """
+        return self._ecs_call('describe_task_definition', taskDefinition = task_definition_arn).get('taskDefinition', {})
+
+    def extract_image_info_from_task(self, a_task_def) -> list:
+        """
+            Return the docker image info for each container on a task description
+        """
+        return image_info_from_task(a_task_def)
 
     def extract_account_id_from_cluster_arn(self, cluster_arn) -> str:
-        # "arn:aws:ecs:us-east-1:123456789012:cluster/TestCluster1"
-        tokens = cluster_arn.split(":")
-        if len(tokens) > 5:
-            return tokens[4]
-        return "unknown"
\ No newline at end of file
+        # "arn:aws:ecs:us-east-1:123456789012:cluster/TestCluster1", memoized since every task in a cluster has the same arn
+        return account_id_from_arn(cluster_arn)
\ No newline at end of file
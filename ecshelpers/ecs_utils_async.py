@@ -0,0 +1,231 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import inspect
+import boto3
+
+import aws_clients
+from ecs_utils import image_info_from_task, DESCRIBE_TASKS_BATCH_SIZE, ECS_CLIENT_CONFIG
+from docker_image_analyzer import parse_base_images_csv
+from rate_limiter import get_rate_limiter, is_throttling_error
+from result_store import resultStore, account_id_from_arn
+from scan_metrics import get_metrics
+
+try:
+    from aiobotocore.session import get_session as get_aiobotocore_session
+except ImportError:  # aiobotocore is optional, without it the blocking boto3 calls run on a thread pool
+    get_aiobotocore_session = None
+
+'''
+asyncio backend for the ECS scan. asyncEcsUtils has async versions of the ecsUtils calls and returns the same results, but
+every cluster, list_tasks page and describe_tasks batch is a coroutine on one event loop, so thousands of requests can be
+in flight with only max_concurrency of them (an asyncio.Semaphore) actually talking to ECS at once. Calls still go through
+the shared adaptive rate limiter for the account/region.
+
+With an aiobotocore client (see open_aiobotocore_client) the calls are native coroutines. Otherwise the regular boto3
+client is called on a thread pool sized to max_concurrency, which is what the Stubber based tests use.
+'''
+
+DEFAULT_MAX_CONCURRENCY = 64
+
+
+def open_aiobotocore_client(service_name = 'ecs', region_name = None, config = ECS_CLIENT_CONFIG):
+    """
+        Async context manager for a native asyncio client: async with open_aiobotocore_client() as ecs_client: ...
+    """
+    if get_aiobotocore_session is None:
+        raise ImportError("open_aiobotocore_client needs aiobotocore installed")
+    return get_aiobotocore_session().create_client(service_name, region_name = region_name, config = config)
+
+
+async def _read_body(body) -> bytes:
+    # aiobotocore bodies are read with await, boto3 ones aren't
+    data = body.read()
+    if inspect.isawaitable(data):
+        data = await data
+    return data
+
+
+class asyncEcsUtils:
+    ''' asyncio version of ecsUtils (get_cluster_info, get_cluster_arns, get_task_arns, get_image_info_for_tasks, ...).'''
+
+    def __init__(self, verbose_mode = False, aws_profile: str = 'default', session: boto3.Session = None,
+            max_concurrency: int = DEFAULT_MAX_CONCURRENCY, ecs_client = None, rate_limiter = None, account_id: str = None,
+            metrics = None) -> None:
+        max_concurrency = max(1, max_concurrency)
+        if not ecs_client:
+            if not session:
+                session = aws_clients.get_session(aws_profile)
+            # the pool is sized for max_concurrency calls at once rather than SCAN_MAX_WORKERS
+            ecs_client = aws_clients.get_client('ecs', config = ECS_CLIENT_CONFIG, session = session,
+                max_workers = max_concurrency)
+
+        self.ecs_client = ecs_client
+        if not rate_limiter:
+            region = getattr(getattr(ecs_client, 'meta', None), 'region_name', None)
+            rate_limiter = get_rate_limiter(account_id, region)
+        self.rate_limiter = rate_limiter
+        self.metrics = metrics if metrics else get_metrics()
+        self.verbose_mode = verbose_mode
+        self.max_concurrency = max_concurrency
+        self._executor = None
+        # asyncio primitives belong to an event loop, the semaphore is recreated when called from a new loop
+        self._semaphore = None
+        self._semaphore_loop = None
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if self._semaphore_loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._semaphore_loop = loop
+        return self._semaphore
+
+    async def _call_client(self, operation, kwargs) -> dict:
+        if inspect.iscoroutinefunction(operation):
+            return await operation(**kwargs)
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers = self.max_concurrency)
+        return await asyncio.get_running_loop().run_in_executor(self._executor, lambda: operation(**kwargs))
+
+    async def _ecs_call(self, operation_name, **kwargs) -> dict:
+        """
+            One ECS call: waits for a concurrency slot and a rate limiter token, retries throttled and transient failures with backoff
+        """
+        operation = getattr(self.ecs_client, operation_name)
+        attempt = 0
+        while True:
+            async with self._get_semaphore():
+                wait = self.rate_limiter.reserve()
+                if wait:
+                    await asyncio.sleep(wait)
+                try:
+                    with self.metrics.api_call(operation_name):
+                        response = await self._call_client(operation, kwargs)
+                except Exception as e:
+                    if is_throttling_error(e):
+                        self.metrics.add_count('throttles')
+                    backoff = self.rate_limiter.retry_backoff(e, attempt)
+                    if backoff is None:
+                        raise
+                else:
+                    self.rate_limiter.on_success()
+                    return response
+            # the concurrency slot is given back while backing off so other calls aren't held up behind the retry
+            await asyncio.sleep(backoff)
+            attempt += 1
+
+    async def get_cluster_info(self, cluster_name) -> list:
+        """
+            Print out cluster info (base boto wrapped call)
+        """
+        response = await self._ecs_call('describe_clusters', clusters = [cluster_name])
+        results = ['Name: {0} Arn: {1}'.format(a_cluster.get('clusterName', 'N/A'), a_cluster.get('clusterArn', 'N/A'))
+            for a_cluster in response.get('clusters', [])]
+        if self.verbose_mode:
+            print("## Cluster Info:")
+            for cluster_info in results:
+                print(cluster_info)
+        return results
+
+    async def get_cluster_arns(self) -> list:
+        """
+            Retrieve all cluster arns in the account/region (follows nextToken across list_clusters pages)
+        """
+        cluster_arns = []
+        list_args = {}
+        while True:
+            response = await self._ecs_call('list_clusters', **list_args)
+            cluster_arns.extend(response.get('clusterArns', []))
+            next_token = response.get('nextToken')
+            if not next_token:
+                break
+            list_args['nextToken'] = next_token
+
+        if self.verbose_mode:
+            print("## Found {0} clusters".format(len(cluster_arns)))
+        return cluster_arns
+
+    async def get_task_arns(self, cluster_name, task_status) -> list:
+        """
+            Retrieve all task arns for a given cluster (list_tasks pages are sequential, each needs the previous nextToken)
+        """
+        task_arns = []
+        list_args = { 'cluster': cluster_name, 'desiredStatus': task_status }
+        while True:
+            response = await self._ecs_call('list_tasks', **list_args)
+            task_arns.extend(response.get('taskArns', []))
+            next_token = response.get('nextToken')
+            if not next_token:
+                return task_arns
+            list_args['nextToken'] = next_token
+
+    async def describe_task_batch(self, cluster_name, task_arns) -> list:
+        task_descriptions = await self._ecs_call('describe_tasks', cluster = cluster_name, tasks = task_arns)
+        if self.verbose_mode:
+            for a_failure in task_descriptions.get('failures', []):
+                print("describe_tasks failure: {0}".format(a_failure))
+        return task_descriptions.get('tasks', [])
+
+    async def describe_tasks(self, cluster_name, task_arns) -> list:
+        """
+            Describe the task arns in batches of 100, all batches in flight at once (bounded by the semaphore).
+            Returns the task descriptions in batch order.
+        """
+        batches = [task_arns[i:i + DESCRIBE_TASKS_BATCH_SIZE] for i in range(0, len(task_arns), DESCRIBE_TASKS_BATCH_SIZE)]
+        batch_results = await asyncio.gather(*(self.describe_task_batch(cluster_name, a_batch) for a_batch in batches))
+        return [a_task for a_result in batch_results for a_task in a_result]
+
+    async def get_image_info_for_task_arns(self, cluster_name, task_arns) -> resultStore:
+        return resultStore(image_info for a_task in await self.describe_tasks(cluster_name, task_arns) for image_info in image_info_from_task(a_task))
+
+    async def get_image_info_for_tasks(self, cluster_name, task_status) -> resultStore:
+        """
+            Retrieve docker image info for all task arns for a given cluster (across all services) as a resultStore (list
+            like, every row a dict)
+        """
+        task_arns = await self.get_task_arns(cluster_name, task_status)
+        if not task_arns:
+            print("No task ARNs found")
+            return resultStore()
+        return await self.get_image_info_for_task_arns(cluster_name, task_arns)
+
+    async def get_image_info_for_all_clusters(self, task_status, cluster_names = None) -> resultStore:
+        """
+            Scan every cluster concurrently and merge the results into one resultStore. A cluster that fails is logged,
+            counted and skipped.
+        """
+        if cluster_names is None:
+            cluster_names = await self.get_cluster_arns()
+        cluster_results = await asyncio.gather(*(self.get_image_info_for_tasks(a_cluster, task_status) for a_cluster in cluster_names),
+            return_exceptions = True)
+        image_infos = resultStore()
+        for cluster_name, a_result in zip(cluster_names, cluster_results):
+            if isinstance(a_result, Exception):
+                print("Failed to scan cluster {0}: {1}".format(cluster_name, a_result))
+                self.metrics.add_count('failedClusters')
+                continue
+            image_infos.extend(a_result)
+        return image_infos
+
+    def extract_image_info_from_task(self, a_task_def) -> list:
+        return image_info_from_task(a_task_def)
+
+    def extract_account_id_from_cluster_arn(self, cluster_arn) -> str:
+        return account_id_from_arn(cluster_arn)
+
+    def close(self) -> None:
+        if self._executor:
+            self._executor.shutdown(wait = True)
+            self._executor = None
+
+
+async def fetch_base_images_from_s3(bucket_name, s3Key, s3_client = None, executor = None) -> list:
+    """
+        async version of dockerImageAnalyzer.fetch_base_images_from_s3, works with boto3 (run on executor) or aiobotocore clients
+    """
+    if not s3_client:
+        s3_client = aws_clients.get_client('s3')
+    if inspect.iscoroutinefunction(s3_client.get_object):
+        data = await s3_client.get_object(Bucket = bucket_name, Key = s3Key)
+    else:
+        data = await asyncio.get_running_loop().run_in_executor(executor, lambda: s3_client.get_object(Bucket = bucket_name, Key = s3Key))
+    return parse_base_images_csv((await _read_body(data['Body'])).decode('utf-8'))
@@ -0,0 +1,118 @@
+import gzip
+import json
+
+'''
+Joins Amazon Inspector2 vulnerability findings onto the scanned container rows. Every active ECR image finding is pulled
+once (paginated list_findings) and reduced into a hash index of severity counts keyed by image digest, then the rows are
+streamed past the index adding the counts (a hash join: one pass over the findings, one pass over the rows).
+A sharded run pulls the findings once in the coordinator and hands the index to the shards as a gzip'd json S3 object.
+'''
+
+# ordered most to least severe
+SEVERITIES = ('CRITICAL', 'HIGH', 'MEDIUM', 'LOW', 'INFORMATIONAL', 'UNTRIAGED')
+FINDING_FIELD_NAMES = ['cveCount', 'maxSeverity', 'criticalCount', 'highCount', 'mediumCount', 'lowCount']
+ECR_IMAGE_FILTER = {
+    'resourceType': [{ 'comparison': 'EQUALS', 'value': 'AWS_ECR_CONTAINER_IMAGE' }],
+    'findingStatus': [{ 'comparison': 'EQUALS', 'value': 'ACTIVE' }],
+}
+_SEVERITY_INDEX = { a_severity: i for i, a_severity in enumerate(SEVERITIES) }
+
+
+def iter_ecr_findings(inspector_client, filter_criteria = None):
+    """
+        Yield every active ECR container image finding, following nextToken
+    """
+    list_args = { 'filterCriteria': filter_criteria if filter_criteria else ECR_IMAGE_FILTER, 'maxResults': 100 }
+    while True:
+        response = inspector_client.list_findings(**list_args)
+        yield from response.get('findings', [])
+        next_token = response.get('nextToken')
+        if not next_token:
+            return
+        list_args['nextToken'] = next_token
+
+
+class findingsIndex:
+    ''' Per image digest severity counts. Only a small list of counts is kept per digest (not the findings themselves)
+        so hundreds of thousands of findings fit comfortably in a Lambda.'''
+
+    def __init__(self) -> None:
+        # { image_digest: [count per SEVERITIES entry] }
+        self.counts_by_digest = {}
+        self.finding_count = 0
+
+    @classmethod
+    def from_findings(cls, findings) -> 'findingsIndex':
+        index = cls()
+        for a_finding in findings:
+            index.add_finding(a_finding)
+        return index
+
+    def add_finding(self, finding) -> None:
+        severity_index = _SEVERITY_INDEX.get(finding.get('severity'), _SEVERITY_INDEX['UNTRIAGED'])
+        self.finding_count += 1
+        for a_resource in finding.get('resources', []):
+            digest = a_resource.get('details', {}).get('awsEcrContainerImage', {}).get('imageHash')
+            if not digest:
+                continue
+            counts = self.counts_by_digest.get(digest)
+            if counts is None:
+                counts = [0] * len(SEVERITIES)
+                self.counts_by_digest[digest] = counts
+            counts[severity_index] += 1
+
+    def __len__(self) -> int:
+        return len(self.counts_by_digest)
+
+    def to_bytes(self) -> bytes:
+        document = { 'finding_count': self.finding_count, 'counts_by_digest': self.counts_by_digest }
+        return gzip.compress(json.dumps(document, separators = (',', ':')).encode('utf-8'))
+
+    @classmethod
+    def from_bytes(cls, data) -> 'findingsIndex':
+        document = json.loads(gzip.decompress(data).decode('utf-8'))
+        index = cls()
+        index.finding_count = document['finding_count']
+        index.counts_by_digest = document['counts_by_digest']
+        return index
+
+    @classmethod
+    def load_from_s3(cls, s3_client, bucket_name, key) -> 'findingsIndex':
+        return cls.from_bytes(s3_client.get_object(Bucket = bucket_name, Key = key)['Body'].read())
+
+    def save_to_s3(self, s3_client, bucket_name, key) -> None:
+        s3_client.put_object(Bucket = bucket_name, Key = key, Body = self.to_bytes(), ContentType = 'application/json',
+            ContentEncoding = 'gzip')
+
+    def finding_columns(self, image_digest) -> dict:
+        """
+            The report columns for an image digest (blank when the digest isn't known, zeros when it has no findings)
+        """
+        if not image_digest or not image_digest.startswith('sha256:'):
+            return dict.fromkeys(FINDING_FIELD_NAMES, '')
+        counts = self.counts_by_digest.get(image_digest)
+        if not counts:
+            return { 'cveCount': 0, 'maxSeverity': 'NONE', 'criticalCount': 0, 'highCount': 0, 'mediumCount': 0, 'lowCount': 0 }
+        return {
+            'cveCount': sum(counts),
+            'maxSeverity': next(a_severity for a_severity, a_count in zip(SEVERITIES, counts) if a_count),
+            'criticalCount': counts[0],
+            'highCount': counts[1],
+            'mediumCount': counts[2],
+            'lowCount': counts[3]
+        }
+
+
+def join_findings(records, index):
+    """
+        Add the finding columns to each record as it passes through. Columns are computed once per distinct digest.
+    """
+    columns_by_digest = {}
+    for a_record in records:
+        digest = a_record.get('imageDigest')
+        columns = columns_by_digest.get(digest)
+        if columns is None:
+            columns = index.finding_columns(digest)
+            columns_by_digest[digest] = columns
+        a_record.update(columns)
+        yield a_record
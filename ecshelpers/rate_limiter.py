@@ -0,0 +1,177 @@
+import random
+import threading
+import time
+import botocore
+
+'''
+Shared, adaptive rate limiting for AWS API calls. Every ECS call made by ecsUtils goes through the adaptiveRateLimiter for
+its account/region so concurrent scans share one request budget instead of each hammering the API on its own.
+'''
+
+# error codes AWS uses for request rate throttling
+THROTTLING_ERROR_CODES = ('ThrottlingException', 'Throttling', 'TooManyRequestsException', 'RequestLimitExceeded')
+# server side errors worth another try (the ECS client has botocore's own retries turned off, see ECS_CLIENT_CONFIG)
+TRANSIENT_ERROR_CODES = ('ServerException', 'InternalError', 'InternalFailure', 'ServiceUnavailable', 'RequestTimeout',
+    'RequestTimeoutException')
+# ECS control plane APIs default to a 20 requests/second sustained rate (with a larger burst)
+DEFAULT_RATE = 20.0
+DEFAULT_BURST = 50.0
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def is_throttling_error(error) -> bool:
+    return isinstance(error, botocore.exceptions.ClientError) and error.response.get('Error', {}).get('Code') in THROTTLING_ERROR_CODES
+
+
+def is_transient_error(error) -> bool:
+    # dropped connections and connect/read timeouts
+    if isinstance(error, (botocore.exceptions.ConnectionError, botocore.exceptions.HTTPClientError)):
+        return True
+    if not isinstance(error, botocore.exceptions.ClientError):
+        return False
+    status_code = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode') or 0
+    return error.response.get('Error', {}).get('Code') in TRANSIENT_ERROR_CODES or status_code >= 500
+
+
+class adaptiveRateLimiter:
+    ''' Token bucket that adapts to throttling: the rate is cut by decrease_factor whenever a call is throttled and
+        creeps back up by increase_step per successful call (AIMD), between min_rate and max_rate. Throttled calls are
+        retried with jittered exponential backoff, as are transient errors (5xx, timeouts, dropped connections) but those
+        don't change the rate. A rate of None disables limiting but still retries/counts throttles.'''
+
+    def __init__(self, rate = DEFAULT_RATE, burst = DEFAULT_BURST, min_rate: float = 1.0, max_rate = None, increase_step: float = 0.5,
+            decrease_factor: float = 0.5, max_retries: int = 5, base_backoff: float = 0.1, max_backoff: float = 5.0,
+            clock = time.monotonic, sleep = time.sleep) -> None:
+        self.rate = rate
+        self.burst = burst if burst else (rate if rate else 1.0)
+        self.min_rate = min_rate
+        self.max_rate = max_rate if max_rate else rate
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.clock = clock
+        self.sleep = sleep
+        self._tokens = self.burst
+        self._last_refill = clock()
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.throttles = 0
+        self.retries = 0
+        self.wait_seconds = 0.0
+
+    def reserve(self) -> float:
+        """
+            Take a token and return how long the caller has to wait before sending its request (without waiting)
+        """
+        if self.rate is None:
+            return 0.0
+
+        with self._lock:
+            now = self.clock()
+            self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.rate)
+            self._last_refill = now
+            # take the token now (possibly going negative) so concurrent callers queue up behind each other
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            self.wait_seconds += wait
+        return wait
+
+    def acquire(self) -> float:
+        """
+            Block until a request may be sent, returns the time waited
+        """
+        wait = self.reserve()
+        if wait:
+            self.sleep(wait)
+        return wait
+
+    def on_success(self) -> None:
+        with self._lock:
+            self.calls += 1
+            if self.rate is not None and self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.increase_step)
+
+    def on_throttle(self) -> None:
+        with self._lock:
+            self.throttles += 1
+            if self.rate is not None:
+                self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+
+    def backoff_seconds(self, attempt) -> float:
+        # "full jitter" exponential backoff
+        return random.uniform(0, min(self.max_backoff, self.base_backoff * (2 ** attempt)))
+
+    def on_retry(self, backoff) -> None:
+        with self._lock:
+            self.retries += 1
+            self.wait_seconds += backoff
+
+    def retry_backoff(self, error, attempt):
+        """
+            Seconds to back off before retrying a call that failed with error, or None when it shouldn't be retried
+            (not retryable or out of retries). Throttling also cuts the rate.
+        """
+        if is_throttling_error(error):
+            self.on_throttle()
+        elif not is_transient_error(error):
+            return None
+        if attempt >= self.max_retries:
+            return None
+        backoff = self.backoff_seconds(attempt)
+        self.on_retry(backoff)
+        return backoff
+
+    def call(self, fn, *args, **kwargs):
+        """
+            Call fn once a token is available, retrying (with backoff) when AWS throttles the request or fails transiently
+        """
+        attempt = 0
+        while True:
+            self.acquire()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                backoff = self.retry_backoff(e, attempt)
+                if backoff is None:
+                    raise
+                self.sleep(backoff)
+                attempt += 1
+                continue
+            self.on_success()
+            return result
+
+    def stats(self) -> dict:
+        with self._lock:
+            return { 'calls': self.calls, 'throttles': self.throttles, 'retries': self.retries,
+                'wait_seconds': round(self.wait_seconds, 3), 'rate': self.rate }
+
+
+def get_rate_limiter(account_id = None, region = None, **kwargs) -> adaptiveRateLimiter:
+    """
+        Return the shared limiter for an account/region, creating it (with kwargs) on first use
+    """
+    cache_key = (account_id or 'default', region)
+    with _rate_limiters_lock:
+        limiter = _rate_limiters.get(cache_key)
+        if not limiter:
+            limiter = adaptiveRateLimiter(**kwargs)
+            _rate_limiters[cache_key] = limiter
+        return limiter
+
+
+def rate_limiter_stats() -> dict:
+    """
+        Stats for every shared limiter keyed by "account/region"
+    """
+    with _rate_limiters_lock:
+        limiters = list(_rate_limiters.items())
+    return { "{0}/{1}".format(account_id, region): limiter.stats() for (account_id, region), limiter in limiters }
+
+
+def reset_rate_limiters() -> None:
+    with _rate_limiters_lock:
+        _rate_limiters.clear()
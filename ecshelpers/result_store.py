@@ -0,0 +1,181 @@
+from array import array
+from collections.abc import Sequence
+from functools import lru_cache
+
+'''
+Compact storage for container result rows. A fleet scan produces one row per container and almost every value in a row
+(cluster arn, account, group, image) repeats across thousands of rows, so instead of a dict per row the resultStore keeps
+one array of value ids per column and every distinct value once in a value table. Rows are handed out as resultRow dicts
+built on access (mapping access, update, dict(row), csv.DictWriter, json.dumps) whose writes go back to the store, so
+callers don't change. Only the store itself isn't a list: json.dumps(list(store)) or store.to_dicts() for the whole result.
+'''
+
+# cluster arns repeat for every task in a cluster, this covers every cluster of a large organisation
+ACCOUNT_ID_CACHE_SIZE = 8192
+# value id of a field a row doesn't have
+_MISSING = 0
+
+
+@lru_cache(maxsize = ACCOUNT_ID_CACHE_SIZE)
+def account_id_from_arn(arn) -> str:
+    # "arn:aws:ecs:us-east-1:123456789012:cluster/TestCluster1"
+    tokens = arn.split(":")
+    if len(tokens) > 5:
+        return tokens[4]
+    return "unknown"
+
+
+class resultRow(dict):
+    ''' One row of a resultStore, built as a plain dict when it is handed out (so json.dumps, isinstance(row, dict) and
+        dict(row) work) and dropped again once the caller is done with it. Writes also go back to the store.'''
+
+    __slots__ = ('_store', '_index')
+
+    def __init__(self, store, index) -> None:
+        super().__init__(store.row_items(index))
+        self._store = store
+        self._index = index
+
+    def __setitem__(self, field, value) -> None:
+        dict.__setitem__(self, field, value)
+        self._store.set_value(self._index, field, value)
+
+    def __delitem__(self, field) -> None:
+        dict.__delitem__(self, field)
+        self._store.delete_value(self._index, field)
+
+    def update(self, *args, **kwargs) -> None:
+        for a_field, a_value in dict(*args, **kwargs).items():
+            self[a_field] = a_value
+
+    def setdefault(self, field, default = None):
+        if field not in self:
+            self[field] = default
+        return self[field]
+
+    def pop(self, field, *default):
+        if field not in self:
+            return dict.pop(self, field, *default)
+        value = self[field]
+        del self[field]
+        return value
+
+    def popitem(self) -> tuple:
+        field, value = dict.popitem(self)
+        self._store.delete_value(self._index, field)
+        return field, value
+
+    def clear(self) -> None:
+        for a_field in list(self):
+            del self[a_field]
+
+    def to_dict(self) -> dict:
+        # plain dict copy that doesn't write back to the store
+        return dict(self)
+
+
+class resultStore(Sequence):
+    ''' Columnar, interned list of result rows. Each column is an array of 4 byte value ids (0 = the row doesn't have the
+        field) into a value table shared by all the columns, so a repeated string costs 4 bytes per row instead of a dict
+        slot plus its own copy. Unhashable values (lists, dicts) are stored as they are, one slot each. Behaves like a list of
+        dicts: len, indexing, iteration, append/extend and == against lists, every row handed out is a dict (resultRow).'''
+
+    __slots__ = ('_columns', '_values', '_value_ids', '_length')
+
+    def __init__(self, rows = None) -> None:
+        # { field: array of value ids }, insertion ordered so rows keep their key order
+        self._columns = {}
+        self._values = [None]
+        # keyed on (type, value) so True and 1 don't share an id
+        self._value_ids = {}
+        self._length = 0
+        if rows is not None:
+            self.extend(rows)
+
+    def _value_id(self, value) -> int:
+        cache_key = (type(value), value)
+        try:
+            value_id = self._value_ids.get(cache_key)
+        except TypeError:
+            # unhashable (list, dict, ...) values can't be interned, each one gets its own id
+            self._values.append(value)
+            return len(self._values) - 1
+        if value_id is None:
+            value_id = len(self._values)
+            self._values.append(value)
+            self._value_ids[cache_key] = value_id
+        return value_id
+
+    def _column(self, field) -> array:
+        column = self._columns.get(field)
+        if column is None:
+            column = array('I', [_MISSING]) * self._length
+            self._columns[field] = column
+        return column
+
+    def append(self, row) -> None:
+        for a_column in self._columns.values():
+            a_column.append(_MISSING)
+        self._length += 1
+        for a_field, a_value in row.items():
+            self._column(a_field)[-1] = self._value_id(a_value)
+
+    def extend(self, rows) -> None:
+        for a_row in rows:
+            self.append(a_row)
+
+    def _check_index(self, index) -> int:
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError("resultStore index out of range")
+        return index
+
+    def get_value(self, index, field):
+        column = self._columns.get(field)
+        value_id = column[index] if column is not None else _MISSING
+        if value_id == _MISSING:
+            raise KeyError(field)
+        return self._values[value_id]
+
+    def set_value(self, index, field, value) -> None:
+        self._column(field)[index] = self._value_id(value)
+
+    def delete_value(self, index, field) -> None:
+        self.get_value(index, field)
+        self._columns[field][index] = _MISSING
+
+    def row_items(self, index) -> list:
+        return [(a_field, self._values[a_column[index]]) for a_field, a_column in self._columns.items() if a_column[index] != _MISSING]
+
+    @property
+    def field_names(self) -> list:
+        return list(self._columns)
+
+    def distinct_values(self) -> int:
+        return len(self._values) - 1
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [resultRow(self, i) for i in range(*index.indices(self._length))]
+        return resultRow(self, self._check_index(index))
+
+    def __iter__(self):
+        for i in range(self._length):
+            yield resultRow(self, i)
+
+    def to_dicts(self) -> list:
+        return [dict(a_row) for a_row in self]
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, (resultStore, list, tuple)):
+            return len(self) == len(other) and all(a_row == an_other_row for a_row, an_other_row in zip(self, other))
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self) -> str:
+        return "resultStore({0} rows, {1} distinct values)".format(self._length, self.distinct_values())
@@ -0,0 +1,469 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import csv
+import datetime
+import json
+import os
+import uuid
+import zlib
+
+import aws_clients
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # parquet output is optional, the Lambda image only needs pyarrow when REPORT_FORMAT=parquet
+    pyarrow = None
+
+# S3 multipart uploads require every part except the last to be at least 5MB
+MIN_PART_SIZE = 5 * 1024 * 1024
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+REPORT_FORMATS = ('csv', 'jsonl', 'parquet')
+REPORT_EXTENSIONS = { 'csv': '.csv', 'jsonl': '.jsonl', 'parquet': '.parquet' }
+# columns that repeat across most rows, parquet stores them dictionary encoded
+DICTIONARY_COLUMNS = ('account_id', 'cluster_arn', 'image', 'imageDigest', 'group', 'name', 'region', 'taskDefinition', 'maxSeverity')
+BOOLEAN_COLUMNS = ('validBaseImage',)
+INTEGER_COLUMNS = ('runningCount', 'cveCount', 'criticalCount', 'highCount', 'mediumCount', 'lowCount')
+DEFAULT_ROW_GROUP_SIZE = 50000
+# hive style partitions so athena only reads the slice a query asks for
+PARTITION_FIELDS = ('account_id', 'cluster')
+# each open partition buffers up to a multipart part (or a parquet row group), this bounds the memory of a partitioned report
+DEFAULT_MAX_OPEN_PARTITIONS = 16
+
+
+class s3MultipartWriter:
+    ''' File like writer that streams bytes to an S3 object using a multipart upload (optionally gzip compressed).
+        Full parts are uploaded on a background thread while the caller keeps producing data, with at most
+        max_pending_parts parts buffered in memory at once. Small outputs that never fill a part are sent with a
+        single put_object call.'''
+
+    def __init__(self, bucket_name, key, s3_client = None, compress = False, part_size: int = DEFAULT_PART_SIZE,
+            max_pending_parts: int = 2, content_type: str = 'text/csv') -> None:
+        if part_size < MIN_PART_SIZE:
+            raise ValueError("part_size must be at least {0} bytes".format(MIN_PART_SIZE))
+
+        self.bucket_name = bucket_name
+        self.key = key
+        self.s3_client = s3_client if s3_client else aws_clients.get_client('s3')
+        self.part_size = part_size
+        self.max_pending_parts = max(1, max_pending_parts)
+        self.content_type = content_type
+        self.compress = compress
+        # wbits=31 writes a gzip header/trailer
+        self._compressor = zlib.compressobj(wbits = 31) if compress else None
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._executor = None
+        self._pending = []
+        self._parts = []
+        self._closed = False
+        self.bytes_written = 0
+
+    def _object_args(self) -> dict:
+        args = { 'Bucket': self.bucket_name, 'Key': self.key, 'ContentType': self.content_type }
+        if self.compress:
+            args['ContentEncoding'] = 'gzip'
+        return args
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def tell(self) -> int:
+        return self.bytes_written
+
+    def flush(self) -> None:
+        pass
+
+    def write(self, data) -> None:
+        if self._closed:
+            raise ValueError("write to closed s3MultipartWriter")
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.bytes_written += len(data)
+        if self._compressor:
+            data = self._compressor.compress(data)
+        self._buffer += data
+        if len(self._buffer) >= self.part_size:
+            self._flush_part()
+
+    def _flush_part(self) -> None:
+        if self._upload_id is None:
+            self._upload_id = self.s3_client.create_multipart_upload(**self._object_args())['UploadId']
+            self._executor = ThreadPoolExecutor(max_workers = self.max_pending_parts)
+
+        # backpressure: wait for the oldest upload before buffering another part
+        while len(self._pending) >= self.max_pending_parts:
+            self._parts.append(self._pending.pop(0).result())
+
+        part_number = len(self._parts) + len(self._pending) + 1
+        body = bytes(self._buffer)
+        self._buffer = bytearray()
+        self._pending.append(self._executor.submit(self._upload_part, part_number, body))
+
+    def _upload_part(self, part_number, body) -> dict:
+        response = self.s3_client.upload_part(Bucket = self.bucket_name, Key = self.key, UploadId = self._upload_id,
+            PartNumber = part_number, Body = body)
+        return { 'PartNumber': part_number, 'ETag': response['ETag'] }
+
+    def close(self) -> None:
+        """
+            Flush whatever is buffered and finish the upload. Aborts the multipart upload if anything fails.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            if self._compressor:
+                self._buffer += self._compressor.flush()
+
+            if self._upload_id is None:
+                self.s3_client.put_object(Body = bytes(self._buffer), **self._object_args())
+                return
+
+            if self._buffer:
+                self._flush_part()
+            while self._pending:
+                self._parts.append(self._pending.pop(0).result())
+            self.s3_client.complete_multipart_upload(Bucket = self.bucket_name, Key = self.key, UploadId = self._upload_id,
+                MultipartUpload = { 'Parts': self._parts })
+            # finished, nothing left to abort
+            self._upload_id = None
+        except Exception:
+            self._abort_upload()
+            raise
+        finally:
+            self._shutdown()
+
+    def abort(self) -> None:
+        """
+            Discard the output, nothing is written to S3
+        """
+        self._closed = True
+        self._abort_upload()
+        self._shutdown()
+
+    def _abort_upload(self) -> None:
+        if self._upload_id is None:
+            return
+        for a_future in self._pending:
+            a_future.cancel()
+        self._pending = []
+        self.s3_client.abort_multipart_upload(Bucket = self.bucket_name, Key = self.key, UploadId = self._upload_id)
+        self._upload_id = None
+
+    def _shutdown(self) -> None:
+        self._buffer = bytearray()
+        if self._executor:
+            self._executor.shutdown(wait = True)
+            self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type:
+            self.abort()
+        else:
+            self.close()
+
+
+class s3ReportWriter:
+    ''' Streams report rows (dicts) as CSV straight to S3 through an s3MultipartWriter so the report is never held in memory
+        or written to /tmp.'''
+
+    def __init__(self, bucket_name, key, field_names, s3_client = None, compress = False, part_size: int = DEFAULT_PART_SIZE) -> None:
+        self.output = s3MultipartWriter(bucket_name, key, s3_client = s3_client, compress = compress, part_size = part_size)
+        self.field_names = field_names
+        self.writer = csv.DictWriter(self.output, fieldnames = field_names, extrasaction = 'ignore')
+        self.writer.writeheader()
+        self.rows_written = 0
+
+    @property
+    def key(self) -> str:
+        return self.output.key
+
+    def write_row(self, row) -> None:
+        self.writer.writerow(row)
+        self.rows_written += 1
+
+    def write_rows(self, rows) -> None:
+        for a_row in rows:
+            self.write_row(a_row)
+
+    def close(self) -> None:
+        self.output.close()
+
+    def abort(self) -> None:
+        self.output.abort()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type:
+            self.abort()
+        else:
+            self.close()
+
+
+class s3JsonLinesWriter:
+    ''' Streams report rows to S3 as JSON Lines (one object per row, only the report fields), gzip'd by default.'''
+
+    def __init__(self, bucket_name, key, field_names, s3_client = None, compress = True, part_size: int = DEFAULT_PART_SIZE) -> None:
+        self.output = s3MultipartWriter(bucket_name, key, s3_client = s3_client, compress = compress, part_size = part_size,
+            content_type = 'application/x-ndjson')
+        self.field_names = field_names
+        self.rows_written = 0
+
+    @property
+    def key(self) -> str:
+        return self.output.key
+
+    def write_row(self, row) -> None:
+        self.output.write(json.dumps({ a_field: row.get(a_field) for a_field in self.field_names }, separators = (',', ':'), default = str) + '\n')
+        self.rows_written += 1
+
+    def write_rows(self, rows) -> None:
+        for a_row in rows:
+            self.write_row(a_row)
+
+    def close(self) -> None:
+        self.output.close()
+
+    def abort(self) -> None:
+        self.output.abort()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type:
+            self.abort()
+        else:
+            self.close()
+
+
+def _parquet_type(field_name):
+    if field_name in BOOLEAN_COLUMNS:
+        return pyarrow.bool_()
+    if field_name in INTEGER_COLUMNS:
+        return pyarrow.int64()
+    return pyarrow.string()
+
+
+def _parquet_value(field_name, value):
+    if value is None or value == '':
+        return None
+    if field_name in BOOLEAN_COLUMNS:
+        return value if isinstance(value, bool) else str(value).lower() == 'true'
+    if field_name in INTEGER_COLUMNS:
+        return int(value)
+    return str(value)
+
+
+class s3ParquetWriter:
+    ''' Streams report rows to S3 as Parquet (snappy compressed, repetitive columns dictionary encoded). Rows are buffered
+        column wise and written a row group at a time so memory is bounded by row_group_size. Needs pyarrow.'''
+
+    def __init__(self, bucket_name, key, field_names, s3_client = None, row_group_size: int = DEFAULT_ROW_GROUP_SIZE,
+            part_size: int = DEFAULT_PART_SIZE) -> None:
+        if pyarrow is None:
+            raise ImportError("parquet reports need pyarrow installed")
+        self.output = s3MultipartWriter(bucket_name, key, s3_client = s3_client, part_size = part_size,
+            content_type = 'application/vnd.apache.parquet')
+        self.field_names = list(field_names)
+        self.schema = pyarrow.schema([(a_field, _parquet_type(a_field)) for a_field in self.field_names])
+        self.row_group_size = max(1, row_group_size)
+        self._columns = { a_field: [] for a_field in self.field_names }
+        self._buffered = 0
+        self._sink = pyarrow.PythonFile(self.output, mode = 'w')
+        self._writer = pyarrow.parquet.ParquetWriter(self._sink, self.schema, compression = 'snappy',
+            use_dictionary = [a_field for a_field in self.field_names if a_field in DICTIONARY_COLUMNS])
+        self.rows_written = 0
+
+    @property
+    def key(self) -> str:
+        return self.output.key
+
+    def write_row(self, row) -> None:
+        for a_field in self.field_names:
+            self._columns[a_field].append(_parquet_value(a_field, row.get(a_field)))
+        self._buffered += 1
+        self.rows_written += 1
+        if self._buffered >= self.row_group_size:
+            self._flush_row_group()
+
+    def write_rows(self, rows) -> None:
+        for a_row in rows:
+            self.write_row(a_row)
+
+    def _flush_row_group(self) -> None:
+        if not self._buffered:
+            return
+        self._writer.write_table(pyarrow.Table.from_pydict(self._columns, schema = self.schema))
+        self._columns = { a_field: [] for a_field in self.field_names }
+        self._buffered = 0
+
+    def close(self) -> None:
+        try:
+            self._flush_row_group()
+            self._writer.close()
+        except Exception:
+            self.output.abort()
+            raise
+        self.output.close()
+
+    def abort(self) -> None:
+        self._columns = { a_field: [] for a_field in self.field_names }
+        self._buffered = 0
+        self.output.abort()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type:
+            self.abort()
+        else:
+            self.close()
+
+
+def report_extension(report_format, compress = False) -> str:
+    # parquet compresses internally so it never gets a .gz suffix
+    extension = REPORT_EXTENSIONS[report_format]
+    if compress and report_format != 'parquet':
+        extension += '.gz'
+    return extension
+
+
+def report_key_for_format(key, report_format, compress = False) -> str:
+    """
+        Swap the extension of the configured report key for the format (e.g. scanResults1.csv -> scanResults1.jsonl.gz)
+    """
+    root, _ = os.path.splitext(key)
+    return root + report_extension(report_format, compress)
+
+
+def check_report_format(report_format) -> None:
+    """
+        Fail fast (before anything is scanned) on an unknown format or a parquet report without pyarrow in the image
+    """
+    if report_format not in REPORT_FORMATS:
+        raise ValueError("Unknown report format '{0}', expected one of {1}".format(report_format, ', '.join(REPORT_FORMATS)))
+    if report_format == 'parquet' and pyarrow is None:
+        raise ImportError("REPORT_FORMAT=parquet needs pyarrow, which isn't installed (add it to ecshelpers/requirements.txt)")
+
+
+def create_report_writer(report_format, bucket_name, key, field_names, s3_client = None, compress = False):
+    """
+        Writer for one report object in the given format ('csv', 'jsonl' or 'parquet'). Every writer has the
+        write_row/write_rows/close/abort/rows_written interface of s3ReportWriter.
+    """
+    check_report_format(report_format)
+    if report_format == 'csv':
+        return s3ReportWriter(bucket_name, key, field_names, s3_client = s3_client, compress = compress)
+    if report_format == 'jsonl':
+        return s3JsonLinesWriter(bucket_name, key, field_names, s3_client = s3_client, compress = compress)
+    return s3ParquetWriter(bucket_name, key, field_names, s3_client = s3_client)
+
+
+def partition_path(row, run_date) -> str:
+    cluster_arn = row.get('cluster_arn') or 'unknown'
+    partition_values = { 'account_id': row.get('account_id') or 'unknown', 'cluster': cluster_arn.rsplit('/', 1)[-1] }
+    return '/'.join(["dt={0}".format(run_date)] + ["{0}={1}".format(a_field, partition_values[a_field]) for a_field in PARTITION_FIELDS])
+
+
+class partitionedReportWriter:
+    ''' Splits report rows into one object per dt/account_id/cluster partition under a prefix:
+            <prefix>/dt=2022-03-01/account_id=123456789012/cluster=TestCluster1/<run_id>.parquet
+        A writer is opened per partition the first time a row for it shows up. At most max_open_partitions writers are
+        open at once, the least recently written one is closed to make room and a later row for its partition starts a
+        new part object (<run_id>-00001.parquet, ...). Each run writes its own files so runs never overwrite each other.'''
+
+    def __init__(self, bucket_name, prefix, field_names, report_format = 'csv', s3_client = None, compress = False, run_id = None,
+            run_date = None, max_open_partitions: int = DEFAULT_MAX_OPEN_PARTITIONS) -> None:
+        # partition writers are only created as rows arrive, check the format up front
+        check_report_format(report_format)
+        self.bucket_name = bucket_name
+        self.prefix = prefix.rstrip('/')
+        self.key = self.prefix + '/'
+        self.field_names = field_names
+        self.report_format = report_format
+        self.s3_client = s3_client if s3_client else aws_clients.get_client('s3')
+        self.compress = compress
+        now = datetime.datetime.now(datetime.timezone.utc)
+        self.run_date = run_date if run_date else now.strftime('%Y-%m-%d')
+        # the timestamp keeps the files in run order, the random suffix keeps two runs in the same second apart
+        self.run_id = run_id if run_id else "{0}-{1}".format(now.strftime('%Y%m%dT%H%M%S'), uuid.uuid4().hex[:8])
+        self.max_open_partitions = max(1, max_open_partitions)
+        # { partition: writer }, least recently written first
+        self.writers = OrderedDict()
+        # { partition: number of part objects started }
+        self.part_counts = {}
+        # part objects already closed (uploaded), deleted again when the report is aborted
+        self.closed_keys = []
+        self.rows_written = 0
+
+    def partition_key(self, partition, part_number = 0) -> str:
+        run_name = self.run_id if part_number == 0 else "{0}-{1:05d}".format(self.run_id, part_number)
+        return "{0}/{1}/{2}{3}".format(self.prefix, partition, run_name, report_extension(self.report_format, self.compress))
+
+    def _close_writer(self, partition) -> None:
+        # the writer stays in writers (and is aborted) if its close fails, its key is recorded as soon as it's uploaded
+        self.writers[partition].close()
+        del self.writers[partition]
+        self.closed_keys.append(self.partition_key(partition, self.part_counts[partition] - 1))
+
+    def _open_writer(self, partition):
+        while len(self.writers) >= self.max_open_partitions:
+            self._close_writer(next(iter(self.writers)))
+        part_number = self.part_counts.get(partition, 0)
+        self.part_counts[partition] = part_number + 1
+        writer = create_report_writer(self.report_format, self.bucket_name, self.partition_key(partition, part_number), self.field_names,
+            s3_client = self.s3_client, compress = self.compress)
+        self.writers[partition] = writer
+        return writer
+
+    def write_row(self, row) -> None:
+        partition = partition_path(row, self.run_date)
+        writer = self.writers.get(partition)
+        if writer is None:
+            writer = self._open_writer(partition)
+        else:
+            self.writers.move_to_end(partition)
+        writer.write_row(row)
+        self.rows_written += 1
+
+    def write_rows(self, rows) -> None:
+        for a_row in rows:
+            self.write_row(a_row)
+
+    def close(self) -> None:
+        try:
+            for a_partition in list(self.writers):
+                self._close_writer(a_partition)
+        except Exception:
+            self.abort()
+            raise
+
+    def abort(self) -> None:
+        for a_writer in self.writers.values():
+            try:
+                a_writer.abort()
+            except Exception as e:
+                print("Failed to abort partition upload: {0}".format(e))
+        for a_key in self.closed_keys:
+            try:
+                self.s3_client.delete_object(Bucket = self.bucket_name, Key = a_key)
+            except Exception as e:
+                print("Failed to delete partition object {0}: {1}".format(a_key, e))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type:
+            self.abort()
+        else:
+            self.close()
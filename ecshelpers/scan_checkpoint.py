@@ -0,0 +1,145 @@
+import gzip
+import json
+import botocore
+
+'''
+Incremental scanning support. A scanCheckpoint remembers, per cluster, the container rows (image, digest, classification)
+of every task seen on the last run so the next run only has to describe and classify tasks that are new.
+'''
+
+CHECKPOINT_VERSION = 1
+# row fields kept in the checkpoint (everything a report row needs)
+CHECKPOINT_FIELDS = ('name', 'image', 'imageDigest', 'group', 'cluster_arn', 'account_id', 'validBaseImage')
+
+
+class scanCheckpoint:
+    ''' Task arns and their container rows from a previous scan, stored in S3 as gzip'd json. Repeated values (images,
+        cluster arns, groups) are written once to a value table and referenced by index to keep the object small.'''
+
+    def __init__(self, clusters = None, policy_fingerprint = None) -> None:
+        # { cluster_name: { task_arn: [row, ...] } }
+        self.clusters = clusters if clusters is not None else {}
+        self.policy_fingerprint = policy_fingerprint
+
+    def task_count(self) -> int:
+        return sum(len(tasks) for tasks in self.clusters.values())
+
+    def to_bytes(self) -> bytes:
+        values = []
+        value_indexes = {}
+
+        def value_index(a_value):
+            # key on the type too so True and 1 don't collide
+            cache_key = (type(a_value).__name__, a_value)
+            index = value_indexes.get(cache_key)
+            if index is None:
+                index = len(values)
+                values.append(a_value)
+                value_indexes[cache_key] = index
+            return index
+
+        clusters = {}
+        for cluster_name, tasks in self.clusters.items():
+            clusters[cluster_name] = { task_arn: [[value_index(a_row.get(a_field)) for a_field in CHECKPOINT_FIELDS] for a_row in rows]
+                for task_arn, rows in tasks.items() }
+
+        document = { 'version': CHECKPOINT_VERSION, 'policy_fingerprint': self.policy_fingerprint, 'fields': CHECKPOINT_FIELDS,
+            'values': values, 'clusters': clusters }
+        return gzip.compress(json.dumps(document, separators = (',', ':')).encode('utf-8'))
+
+    @classmethod
+    def from_bytes(cls, data) -> 'scanCheckpoint':
+        document = json.loads(gzip.decompress(data).decode('utf-8'))
+        if document.get('version') != CHECKPOINT_VERSION:
+            return cls()
+
+        fields = document['fields']
+        values = document['values']
+        clusters = {}
+        for cluster_name, tasks in document['clusters'].items():
+            clusters[cluster_name] = { task_arn: [{ a_field: values[an_index] for a_field, an_index in zip(fields, a_row) } for a_row in rows]
+                for task_arn, rows in tasks.items() }
+        return cls(clusters, document.get('policy_fingerprint'))
+
+    @classmethod
+    def load_from_s3(cls, s3_client, bucket_name, key) -> 'scanCheckpoint':
+        """
+            Load the checkpoint from S3, an empty checkpoint is returned when there isn't one yet
+        """
+        try:
+            data = s3_client.get_object(Bucket = bucket_name, Key = key)
+        except botocore.exceptions.ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+                return cls()
+            raise
+        return cls.from_bytes(data['Body'].read())
+
+    def save_to_s3(self, s3_client, bucket_name, key) -> None:
+        s3_client.put_object(Bucket = bucket_name, Key = key, Body = self.to_bytes(), ContentType = 'application/json',
+            ContentEncoding = 'gzip')
+
+
+class incrementalScanner:
+    ''' Scans clusters against a previous checkpoint. Only task arns that weren't in the checkpoint are described and
+        classified, rows for known tasks are reused (and reclassified w/out any API calls if the policy changed).
+        The rows for the next checkpoint are collected in next_checkpoint as clusters are scanned.'''
+
+    def __init__(self, utils_instance, analyzer, policy, previous_checkpoint = None, task_status: str = 'STOPPED') -> None:
+        self.utils_instance = utils_instance
+        self.analyzer = analyzer
+        self.policy = policy
+        self.task_status = task_status
+        self.previous_checkpoint = previous_checkpoint if previous_checkpoint else scanCheckpoint()
+        self.next_checkpoint = scanCheckpoint(policy_fingerprint = policy.fingerprint)
+        self.policy_changed = self.previous_checkpoint.policy_fingerprint != policy.fingerprint
+
+    def _classify(self, rows) -> None:
+        results = self.analyzer.classify_images((a_row['image'] for a_row in rows), self.policy)
+        for a_row, result in zip(rows, results):
+            a_row['validBaseImage'] = result
+
+    def scan_cluster(self, cluster_name, task_status = None) -> tuple:
+        """
+            Scan one cluster, returns (all_rows, added_rows, removed_rows). When the cluster can't be scanned its previous
+            rows are carried forward (and no changes reported) so a transient failure doesn't force a full rescan, it is
+            counted as a failedCluster so the run isn't reported as complete.
+        """
+        previous_tasks = self.previous_checkpoint.clusters.get(cluster_name, {})
+        try:
+            task_arns = self.utils_instance.get_task_arns(cluster_name, task_status or self.task_status)
+            new_task_arns = [a_task_arn for a_task_arn in task_arns if a_task_arn not in previous_tasks]
+            described_tasks = self.utils_instance.get_image_info_by_task_arn(cluster_name, new_task_arns) if new_task_arns else {}
+        except Exception as e:
+            print("Failed to scan cluster {0}, keeping previous results: {1}".format(cluster_name, e))
+            self.utils_instance.metrics.add_count('failedClusters')
+            self.next_checkpoint.clusters[cluster_name] = previous_tasks
+            return [a_row for rows in previous_tasks.values() for a_row in rows], [], []
+
+        added_rows = [a_row for rows in described_tasks.values() for a_row in rows]
+        self._classify(added_rows)
+
+        current_tasks = {}
+        for a_task_arn in task_arns:
+            if a_task_arn in previous_tasks:
+                current_tasks[a_task_arn] = previous_tasks[a_task_arn]
+            elif a_task_arn in described_tasks:
+                current_tasks[a_task_arn] = described_tasks[a_task_arn]
+
+        all_rows = [a_row for rows in current_tasks.values() for a_row in rows]
+        if self.policy_changed:
+            self._classify([a_row for a_task_arn, rows in current_tasks.items() if a_task_arn in previous_tasks for a_row in rows])
+
+        current_arns = set(task_arns)
+        removed_rows = [a_row for a_task_arn, rows in previous_tasks.items() if a_task_arn not in current_arns for a_row in rows]
+
+        self.next_checkpoint.clusters[cluster_name] = current_tasks
+        return all_rows, added_rows, removed_rows
+
+    def removed_clusters(self, cluster_names) -> list:
+        """
+            [(cluster_name, rows)] for the clusters of the previous checkpoint that aren't in cluster_names (deleted since the
+            last run). All their rows are reported as removed and they're left out of the next checkpoint.
+        """
+        current_clusters = set(cluster_names)
+        return [(cluster_name, [a_row for rows in tasks.values() for a_row in rows])
+            for cluster_name, tasks in self.previous_checkpoint.clusters.items() if cluster_name not in current_clusters]
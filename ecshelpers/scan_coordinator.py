@@ -0,0 +1,237 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, NamedTuple
+import csv
+import gzip
+import io
+import json
+import os
+import time
+
+from s3_report_writer import s3ReportWriter
+from compliance_summary import summarize_records
+
+'''
+Scatter/gather scanning across Lambda invocations. The coordinator (base_image_finder) splits the clusters to scan into
+shards and invokes ecs_reader asynchronously once per shard. Each shard writes its rows to a partial report plus a small
+".done" marker, the coordinator polls for the markers and then merges the partial reports into the final one.
+
+Invokers are pluggable: lambdaInvoker calls the real function, localInvoker runs a handler in process so the whole flow
+can be exercised offline.
+'''
+
+DEFAULT_SHARD_SIZE = 25
+SHARD_MARKER_SUFFIX = '.done'
+
+
+class scanShard(NamedTuple):
+    ''' A slice of the clusters in one account/region. account_id/region are None for the coordinator's own account.'''
+    shard_id: int
+    account_id: str
+    region: str
+    clusters: List[str]
+
+    def to_event(self, run_id, output_key, assume_role = False, findings_key = None) -> dict:
+        event = { 'shard': { 'shard_id': self.shard_id, 'run_id': run_id, 'account_id': self.account_id, 'region': self.region,
+            'clusters': list(self.clusters), 'output_key': output_key, 'assume_role': assume_role } }
+        if findings_key:
+            event['shard']['findings_key'] = findings_key
+        return event
+
+
+def build_shards(clusters_by_target, shard_size: int = DEFAULT_SHARD_SIZE) -> List[scanShard]:
+    """
+        Split { (account_id, region): [cluster_arn, ...] } into shards of at most shard_size clusters (a shard never spans targets)
+    """
+    shard_size = max(1, shard_size)
+    shards = []
+    for (account_id, region), cluster_arns in clusters_by_target.items():
+        for i in range(0, len(cluster_arns), shard_size):
+            shards.append(scanShard(len(shards), account_id, region, cluster_arns[i:i + shard_size]))
+    return shards
+
+
+def shard_prefix(report_key, run_id) -> str:
+    # dockerImagesSecInfo/scanResults1.csv -> dockerImagesSecInfo/scanResults1-shards/<run_id>/
+    root, _ = os.path.splitext(report_key)
+    return "{0}-shards/{1}/".format(root, run_id)
+
+
+def shard_output_key(report_key, run_id, shard_id) -> str:
+    _, extension = os.path.splitext(report_key)
+    return "{0}shard-{1:05d}{2}".format(shard_prefix(report_key, run_id), shard_id, extension)
+
+
+def shard_findings_key(report_key, run_id) -> str:
+    # the findings index pulled once by the coordinator and read by every shard
+    return "{0}findings.json.gz".format(shard_prefix(report_key, run_id))
+
+
+def write_shard_marker(s3_client, bucket_name, output_key, rows, error = None, failures = None) -> None:
+    """
+        Called by the shard (ecs_reader) when it finishes, the coordinator waits for one marker per shard.
+        failures are the shard's counts of clusters / task batches it had to skip.
+    """
+    marker = { 'status': 'failed' if error else 'ok', 'rows': rows }
+    if failures:
+        marker['failures'] = failures
+    if error:
+        marker['error'] = str(error)
+    s3_client.put_object(Bucket = bucket_name, Key = output_key + SHARD_MARKER_SUFFIX, Body = json.dumps(marker).encode('utf-8'),
+        ContentType = 'application/json')
+
+
+class lambdaInvoker:
+    ''' Fire and forget (InvocationType Event) invocations of a Lambda function.'''
+
+    def __init__(self, function_name, lambda_client) -> None:
+        self.function_name = function_name
+        self.lambda_client = lambda_client
+
+    def invoke(self, event) -> None:
+        self.lambda_client.invoke(FunctionName = self.function_name, InvocationType = 'Event', Payload = json.dumps(event).encode('utf-8'))
+
+    def close(self) -> None:
+        pass
+
+
+class localInvoker:
+    ''' Runs handler(event, None) on a local thread pool, standing in for asynchronous Lambda invocations.'''
+
+    def __init__(self, handler, max_workers: int = 4) -> None:
+        self.handler = handler
+        self._executor = ThreadPoolExecutor(max_workers = max(1, max_workers))
+        self.futures = []
+
+    def invoke(self, event) -> None:
+        self.futures.append(self._executor.submit(self.handler, event, None))
+
+    def close(self) -> None:
+        self._executor.shutdown(wait = True)
+
+
+class scanCoordinator:
+    ''' Dispatches shards through an invoker, waits for their markers and merges the partial reports.'''
+
+    def __init__(self, invoker, s3_client, bucket_name, report_key, field_names, compress = False, assume_role = False,
+            poll_seconds: float = 2.0, timeout_seconds: float = 840.0, clock = time.monotonic, sleep = time.sleep, writer_factory = None,
+            summary = None, findings_key = None) -> None:
+        self.invoker = invoker
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.report_key = report_key
+        self.field_names = field_names
+        self.compress = compress
+        self.assume_role = assume_role
+        self.poll_seconds = poll_seconds
+        self.timeout_seconds = timeout_seconds
+        self.clock = clock
+        self.sleep = sleep
+        # writer_factory(s3_client, bucket_name, key, field_names, compress) creates the merged report writer (csv by default)
+        self.writer_factory = writer_factory
+        # optional complianceSummary fed with every merged row
+        self.summary = summary
+        # optional S3 key of the findingsIndex the shards join onto their rows (instead of each pulling the findings)
+        self.findings_key = findings_key
+
+    def dispatch(self, shards, run_id) -> dict:
+        """
+            Invoke every shard, returns { shard_id: partial report key }
+        """
+        output_keys = {}
+        for a_shard in shards:
+            output_key = shard_output_key(self.report_key, run_id, a_shard.shard_id)
+            self.invoker.invoke(a_shard.to_event(run_id, output_key, self.assume_role, self.findings_key))
+            output_keys[a_shard.shard_id] = output_key
+        return output_keys
+
+    def _list_keys(self, prefix) -> set:
+        keys = set()
+        list_args = { 'Bucket': self.bucket_name, 'Prefix': prefix }
+        while True:
+            response = self.s3_client.list_objects_v2(**list_args)
+            keys.update(an_object['Key'] for an_object in response.get('Contents', []))
+            if not response.get('IsTruncated'):
+                return keys
+            list_args['ContinuationToken'] = response['NextContinuationToken']
+
+    def wait_for_shards(self, output_keys, run_id) -> dict:
+        """
+            Poll for the shard markers until every shard reported or the timeout passes, returns { shard_id: marker }
+            (shards that never reported are missing from the result)
+        """
+        prefix = shard_prefix(self.report_key, run_id)
+        deadline = self.clock() + self.timeout_seconds
+        markers = {}
+        while True:
+            existing = self._list_keys(prefix)
+            for shard_id, output_key in output_keys.items():
+                marker_key = output_key + SHARD_MARKER_SUFFIX
+                if shard_id not in markers and marker_key in existing:
+                    response = self.s3_client.get_object(Bucket = self.bucket_name, Key = marker_key)
+                    markers[shard_id] = json.loads(response['Body'].read())
+            if len(markers) == len(output_keys) or self.clock() >= deadline:
+                return markers
+            self.sleep(self.poll_seconds)
+
+    def _read_rows(self, key):
+        response = self.s3_client.get_object(Bucket = self.bucket_name, Key = key)
+        body = response['Body']
+        if response.get('ContentEncoding') == 'gzip':
+            body = gzip.GzipFile(fileobj = body)
+        yield from csv.DictReader(io.TextIOWrapper(body, encoding = 'utf-8', newline = ''))
+
+    def merge(self, output_keys, markers) -> int:
+        """
+            Stream the partial reports of the successful shards into the final report, returns rows written
+        """
+        if self.writer_factory:
+            report_writer = self.writer_factory(self.s3_client, self.bucket_name, self.report_key, self.field_names, self.compress)
+        else:
+            report_writer = s3ReportWriter(self.bucket_name, self.report_key, self.field_names, s3_client = self.s3_client, compress = self.compress)
+        try:
+            for shard_id in sorted(output_keys):
+                marker = markers.get(shard_id)
+                if marker and marker['status'] == 'ok' and marker['rows']:
+                    rows = self._read_rows(output_keys[shard_id])
+                    if self.summary:
+                        rows = summarize_records(rows, self.summary)
+                    report_writer.write_rows(rows)
+        except Exception:
+            report_writer.abort()
+            raise
+
+        if report_writer.rows_written > 0:
+            report_writer.close()
+        else:
+            report_writer.abort()
+        return report_writer.rows_written
+
+    def run(self, shards, run_id) -> dict:
+        """
+            Scatter the shards, gather and merge their results. Returns a summary of the run, scanFailures adds up the
+            shards' failure counts plus the failedShards/missingShards whose rows aren't in the report.
+        """
+        output_keys = self.dispatch(shards, run_id)
+        print("dispatched {0} shards for run {1}".format(len(output_keys), run_id))
+        markers = self.wait_for_shards(output_keys, run_id)
+        failed = sorted(shard_id for shard_id, marker in markers.items() if marker['status'] != 'ok')
+        missing = sorted(shard_id for shard_id in output_keys if shard_id not in markers)
+        for shard_id in failed:
+            print("shard {0} failed: {1}".format(shard_id, markers[shard_id].get('error')))
+        if missing:
+            print("shards {0} did not finish in {1}s".format(missing, self.timeout_seconds))
+
+        scan_failures = {}
+        for a_marker in markers.values():
+            for count_name, value in a_marker.get('failures', {}).items():
+                scan_failures[count_name] = scan_failures.get(count_name, 0) + value
+        if any(scan_failures.values()):
+            print("shards skipped part of the fleet: {0}".format(scan_failures))
+        # the rows of failed/missing shards aren't in the merged report either
+        scan_failures['failedShards'] = len(failed)
+        scan_failures['missingShards'] = len(missing)
+
+        rows = self.merge(output_keys, markers)
+        print("merged {0} rows from {1} shards into {2}".format(rows, len(markers) - len(failed), self.report_key))
+        return { 'run_id': run_id, 'shards': len(output_keys), 'rows': rows, 'failed': failed, 'missing': missing,
+            'scanFailures': scan_failures }
@@ -0,0 +1,163 @@
+from typing import List, NamedTuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import threading
+import time
+import boto3
+
+import aws_clients
+from ecs_utils import ecsUtils as ecsUtils
+from scan_metrics import get_metrics
+
+
+class scanTarget(NamedTuple):
+    ''' A single account/region pair to scan.'''
+    account_id: str
+    region: str
+
+
+def parse_scan_targets(targets_string) -> List[scanTarget]:
+    """
+        Parse a comma separated list of account:region pairs (e.g. "123456789012:us-east-1,210987654321:us-west-2")
+    """
+    targets = []
+    for a_target in (targets_string or '').split(','):
+        a_target = a_target.strip()
+        if not a_target:
+            continue
+        account_id, _, region = a_target.partition(':')
+        if not account_id or not region:
+            raise ValueError("Invalid scan target '{0}', expected account_id:region".format(a_target))
+        targets.append(scanTarget(account_id.strip(), region.strip()))
+    return targets
+
+
+class assumedRoleSessionPool:
+    ''' Hands out boto3 sessions for target accounts by assuming a role in each one. Credentials are cached per account
+        and refreshed once they get within refresh_margin_seconds of expiring.'''
+
+    def __init__(self, role_name, sts_client = None, session_name: str = 'ecs-image-scanner', duration_seconds: int = 3600,
+            refresh_margin_seconds: int = 300, session_factory = boto3.Session, clock = time.time) -> None:
+        self.role_name = role_name
+        self.sts_client = sts_client if sts_client else aws_clients.get_client('sts')
+        self.session_name = session_name
+        self.duration_seconds = duration_seconds
+        self.refresh_margin_seconds = refresh_margin_seconds
+        self.session_factory = session_factory
+        self.clock = clock
+        self._credentials = {}
+        # { (account_id, region): (credentials, session) }
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def role_arn(self, account_id) -> str:
+        return "arn:aws:iam::{0}:role/{1}".format(account_id, self.role_name)
+
+    def get_credentials(self, account_id) -> dict:
+        """
+            Return cached credentials for the account, assuming the role again when missing or close to expiry
+        """
+        with self._lock:
+            cached = self._credentials.get(account_id)
+            if cached and cached['expires_at'] - self.refresh_margin_seconds > self.clock():
+                return cached
+
+            response = self.sts_client.assume_role(RoleArn = self.role_arn(account_id), RoleSessionName = self.session_name,
+                DurationSeconds = self.duration_seconds)
+            credentials = response['Credentials']
+            cached = {
+                'aws_access_key_id': credentials['AccessKeyId'],
+                'aws_secret_access_key': credentials['SecretAccessKey'],
+                'aws_session_token': credentials['SessionToken'],
+                'expires_at': credentials['Expiration'].timestamp()
+            }
+            self._credentials[account_id] = cached
+            return cached
+
+    def get_session(self, account_id, region):
+        """
+            Return the session for the account/region, reused until the credentials it was built with are refreshed
+        """
+        credentials = self.get_credentials(account_id)
+        with self._lock:
+            cached = self._sessions.get((account_id, region))
+            if cached and cached[0] is credentials:
+                return cached[1]
+            session = self.session_factory(aws_access_key_id = credentials['aws_access_key_id'],
+                aws_secret_access_key = credentials['aws_secret_access_key'],
+                aws_session_token = credentials['aws_session_token'],
+                region_name = region)
+            self._sessions[(account_id, region)] = (credentials, session)
+            return session
+
+
+class scanEngine:
+    ''' Scans ECS clusters across many account/region targets. Cluster discovery and the per cluster scans all share one
+        bounded worker pool, and every returned container row is tagged with the account and region it came from.'''
+
+    def __init__(self, session_pool, task_status: str = 'STOPPED', max_workers: int = 8, describe_workers: int = 1,
+            utils_factory = None, verbose_mode = False, metrics = None) -> None:
+        self.session_pool = session_pool
+        self.task_status = task_status
+        self.max_workers = max_workers
+        self.describe_workers = describe_workers
+        self.verbose_mode = verbose_mode
+        self.utils_factory = utils_factory if utils_factory else self._create_utils
+        # targets / clusters that fail are counted here so the run isn't reported as complete
+        self.metrics = metrics if metrics else get_metrics()
+
+    def _create_utils(self, session, target):
+        return ecsUtils(verbose_mode = self.verbose_mode, session = session, max_workers = self.describe_workers, account_id = target.account_id,
+            metrics = self.metrics)
+
+    def _discover(self, target):
+        session = self.session_pool.get_session(target.account_id, target.region)
+        utils_instance = self.utils_factory(session, target)
+        return utils_instance, utils_instance.get_cluster_arns()
+
+    def _scan_cluster(self, utils_instance, target, cluster_name):
+        results = utils_instance.get_image_info_for_tasks(cluster_name, self.task_status)
+        for a_result in results:
+            a_result['account_id'] = target.account_id
+            a_result['region'] = target.region
+        return results
+
+    def iter_scan(self, targets):
+        """
+            Scan every target and yield (target, cluster_name, image_infos) as each cluster finishes.
+            Targets or clusters that fail are logged, counted (failedTargets / failedClusters) and skipped so they don't hold
+            up the rest of the scan.
+        """
+        if not targets:
+            return
+
+        with ThreadPoolExecutor(max_workers = max(1, self.max_workers)) as executor:
+            pending = {}
+            for a_target in targets:
+                pending[executor.submit(self._discover, a_target)] = (a_target, None)
+
+            while pending:
+                done, _ = wait(pending, return_when = FIRST_COMPLETED)
+                for a_future in done:
+                    a_target, cluster_name = pending.pop(a_future)
+                    try:
+                        result = a_future.result()
+                    except Exception as e:
+                        print("Failed to scan {0}/{1} {2}: {3}".format(a_target.account_id, a_target.region, cluster_name or 'clusters', e))
+                        self.metrics.add_count('failedTargets' if cluster_name is None else 'failedClusters')
+                        continue
+
+                    if cluster_name is None:
+                        # discovery finished, fan the clusters out onto the same pool
+                        utils_instance, cluster_names = result
+                        if self.verbose_mode:
+                            print("{0}/{1} has {2} clusters".format(a_target.account_id, a_target.region, len(cluster_names)))
+                        for a_cluster in cluster_names:
+                            pending[executor.submit(self._scan_cluster, utils_instance, a_target, a_cluster)] = (a_target, a_cluster)
+                    else:
+                        yield a_target, cluster_name, result
+
+    def scan(self, targets) -> list:
+        image_infos = []
+        for _, _, cluster_results in self.iter_scan(targets):
+            image_infos.extend(cluster_results)
+        return image_infos
@@ -0,0 +1,248 @@
+from collections import defaultdict
+from contextlib import contextmanager
+import json
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # not available on windows
+    resource = None
+
+'''
+In process instrumentation for a scan: time per stage, per API operation call counts/latency, row counts and peak memory
+(per run where the memory high-water mark can be reset, otherwise only the process lifetime peak).
+The collector is emitted at the end of a run as a single CloudWatch Embedded Metric Format (EMF) log line, which
+CloudWatch turns into metrics without any extra API calls. Tests read the same numbers straight from summary().
+
+Stage times are cumulative, when a stage runs on several threads at once (listing, describing) the time of every thread is
+added up, so compare them with each other rather than with the wall clock total.
+'''
+
+DEFAULT_NAMESPACE = 'EcsImageScanner'
+LATENCY_PERCENTILES = (50, 90, 99)
+# counts of the work a scan had to skip (logged and left out of the report)
+FAILURE_COUNTS = ('failedTargets', 'failedClusters', 'failedTaskBatches', 'failedTasks')
+_EXHAUSTED = object()
+PROC_CLEAR_REFS = '/proc/self/clear_refs'
+PROC_STATUS = '/proc/self/status'
+
+_collector = None
+_collector_lock = threading.Lock()
+
+
+def percentile(sorted_values, percent) -> float:
+    """
+        Nearest rank percentile of an already sorted list (0.0 when empty)
+    """
+    if not sorted_values:
+        return 0.0
+    rank = max(1, -(-len(sorted_values) * percent // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def process_peak_memory_mb() -> float:
+    """
+        Peak resident memory over the life of the process (0.0 where the resource module isn't available). On a warm Lambda
+        container this includes earlier invocations and never goes down.
+    """
+    if resource is None:
+        return 0.0
+    # ru_maxrss is reported in KB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def reset_peak_memory() -> bool:
+    """
+        Reset the kernel's resident memory high-water mark (VmHWM) for this process so peak_memory_mb() only covers what
+        runs from now on. False where it can't be reset (not linux, or /proc isn't writable)
+    """
+    try:
+        with open(PROC_CLEAR_REFS, 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        return False
+    return peak_memory_mb() is not None
+
+
+def peak_memory_mb():
+    """
+        Resident memory high-water mark since the last reset_peak_memory() (None when /proc/self/status isn't available)
+    """
+    try:
+        with open(PROC_STATUS) as status:
+            for a_line in status:
+                if a_line.startswith('VmHWM:'):
+                    # "VmHWM:    8904 kB"
+                    return int(a_line.split()[1]) / 1024.0
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+class metricsCollector:
+    ''' Thread safe accumulator for stage timings, API call latencies and counters.'''
+
+    def __init__(self, clock = time.perf_counter, track_peak_memory = False) -> None:
+        self.clock = clock
+        # only when the high-water mark was reset for this collector is it a per run peak
+        self.track_peak_memory = track_peak_memory
+        self.stage_seconds = defaultdict(float)
+        self.api_latencies = defaultdict(list)
+        self.api_errors = defaultdict(int)
+        self.counts = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def add_stage_time(self, stage_name, seconds) -> None:
+        with self._lock:
+            self.stage_seconds[stage_name] += seconds
+
+    @contextmanager
+    def stage(self, stage_name):
+        """
+            Time the enclosed block and add it to the stage total
+        """
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.add_stage_time(stage_name, self.clock() - start)
+
+    def timed_iter(self, stage_name, iterable):
+        """
+            Yield from iterable, adding only the time spent producing each item to the stage (not the time the consumer holds it)
+        """
+        iterator = iter(iterable)
+        while True:
+            start = self.clock()
+            an_item = next(iterator, _EXHAUSTED)
+            self.add_stage_time(stage_name, self.clock() - start)
+            if an_item is _EXHAUSTED:
+                return
+            yield an_item
+
+    def record_api_call(self, operation_name, seconds, failed = False) -> None:
+        with self._lock:
+            self.api_latencies[operation_name].append(seconds)
+            if failed:
+                self.api_errors[operation_name] += 1
+
+    @contextmanager
+    def api_call(self, operation_name):
+        """
+            Time a single API request (each retry of a throttled call is recorded separately, as a failure)
+        """
+        start = self.clock()
+        failed = True
+        try:
+            yield
+            failed = False
+        finally:
+            self.record_api_call(operation_name, self.clock() - start, failed)
+
+    def add_count(self, count_name, value = 1) -> None:
+        with self._lock:
+            self.counts[count_name] += value
+
+    def failure_counts(self) -> dict:
+        """
+            { count_name: count } of the clusters / task batches that couldn't be scanned, the report is partial when any is > 0
+        """
+        with self._lock:
+            return { a_count_name: self.counts.get(a_count_name, 0) for a_count_name in FAILURE_COUNTS }
+
+    def api_call_summary(self) -> dict:
+        """
+            { operation: { count, errors, p50_ms, p90_ms, p99_ms, max_ms } }
+        """
+        with self._lock:
+            latencies = { operation: sorted(values) for operation, values in self.api_latencies.items() }
+            errors = dict(self.api_errors)
+
+        summary = {}
+        for operation, values in latencies.items():
+            operation_summary = { 'count': len(values), 'errors': errors.get(operation, 0) }
+            for a_percent in LATENCY_PERCENTILES:
+                operation_summary['p{0}_ms'.format(a_percent)] = round(percentile(values, a_percent) * 1000, 3)
+            operation_summary['max_ms'] = round(values[-1] * 1000, 3) if values else 0.0
+            summary[operation] = operation_summary
+        return summary
+
+    def summary(self) -> dict:
+        with self._lock:
+            stage_seconds = { stage_name: round(seconds, 6) for stage_name, seconds in self.stage_seconds.items() }
+            counts = dict(self.counts)
+        peak_memory = peak_memory_mb() if self.track_peak_memory else None
+        return { 'stage_seconds': stage_seconds, 'api_calls': self.api_call_summary(), 'counts': counts,
+            'peak_memory_mb': round(peak_memory, 1) if peak_memory is not None else None,
+            'process_peak_memory_mb': round(process_peak_memory_mb(), 1) }
+
+    def to_emf(self, namespace = DEFAULT_NAMESPACE, dimensions = None, timestamp = None) -> dict:
+        """
+            Build a CloudWatch Embedded Metric Format document for everything collected so far
+        """
+        summary = self.summary()
+        dimensions = dict(dimensions or {})
+        values = {}
+        units = {}
+
+        def add(metric_name, value, unit):
+            values[metric_name] = value
+            units[metric_name] = unit
+
+        for stage_name, seconds in summary['stage_seconds'].items():
+            add('{0}Seconds'.format(stage_name), seconds, 'Seconds')
+        for operation, operation_summary in summary['api_calls'].items():
+            add('{0}.Calls'.format(operation), operation_summary['count'], 'Count')
+            add('{0}.Errors'.format(operation), operation_summary['errors'], 'Count')
+            for a_percent in LATENCY_PERCENTILES:
+                add('{0}.P{1}Latency'.format(operation, a_percent), operation_summary['p{0}_ms'.format(a_percent)], 'Milliseconds')
+        for count_name, value in summary['counts'].items():
+            add(count_name, value, 'Count')
+        if summary['peak_memory_mb'] is not None:
+            add('PeakMemory', summary['peak_memory_mb'], 'Megabytes')
+        add('ProcessPeakMemory', summary['process_peak_memory_mb'], 'Megabytes')
+
+        document = {
+            '_aws': {
+                'Timestamp': int((timestamp if timestamp is not None else time.time()) * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': namespace,
+                    'Dimensions': [list(dimensions.keys())],
+                    'Metrics': [{ 'Name': metric_name, 'Unit': units[metric_name] } for metric_name in values]
+                }]
+            }
+        }
+        document.update(dimensions)
+        document.update(values)
+        return document
+
+    def emit(self, namespace = DEFAULT_NAMESPACE, dimensions = None, print_fn = print) -> dict:
+        """
+            Write the EMF document as a single log line (Lambda ships stdout to CloudWatch logs)
+        """
+        document = self.to_emf(namespace, dimensions)
+        print_fn(json.dumps(document, separators = (',', ':')))
+        return document
+
+
+def get_metrics() -> metricsCollector:
+    """
+        The collector for the current run, shared by everything that isn't handed one explicitly
+    """
+    global _collector
+    with _collector_lock:
+        if _collector is None:
+            _collector = metricsCollector()
+        return _collector
+
+
+def reset_metrics() -> metricsCollector:
+    """
+        Start a fresh collector (called at the start of each invocation so warm starts don't carry numbers over), the memory
+        high-water mark is reset too so PeakMemory is this invocation's peak
+    """
+    global _collector
+    with _collector_lock:
+        _collector = metricsCollector(track_peak_memory = reset_peak_memory())
+        return _collector
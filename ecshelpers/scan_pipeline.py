@@ -0,0 +1,200 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import queue
+import threading
+import time
+
+from ecs_utils import DESCRIBE_TASKS_BATCH_SIZE
+from scan_metrics import get_metrics
+
+'''
+Streaming scan pipeline. Each stage is a generator feeding the next one:
+
+    iter_task_batches -> iter_container_records -> classify_records -> sink (write_row)
+
+Nothing holds the whole fleet in memory. Describing stops once max_records_in_flight container records are described
+but not yet consumed, and listing runs ahead of it by at most half that many task arns. After that they block until the
+sink catches up (backpressure), so memory stays flat no matter how big the fleet is.
+
+Time spent in each stage (listing, describing, classification, upload) is added to the ecsUtils / run metrics collector.
+'''
+
+DEFAULT_MAX_RECORDS_IN_FLIGHT = 2000
+_WORKER_DONE = object()
+
+
+def _batch_window(max_records_in_flight) -> int:
+    # listed task batches waiting to be described, half of the in flight budget in task arns
+    return max(1, max_records_in_flight // DESCRIBE_TASKS_BATCH_SIZE // 2)
+
+
+def iter_task_batches(utils_instance, cluster_names, task_status, max_cluster_workers: int = 4,
+        max_records_in_flight: int = DEFAULT_MAX_RECORDS_IN_FLIGHT):
+    """
+        Yield (cluster_name, [task_arn, ...]) batches (one list_tasks page each) for every cluster. Clusters are listed by
+        up to max_cluster_workers threads which block once the bounded queue is full.
+    """
+    cluster_iter = iter(cluster_names)
+    cluster_lock = threading.Lock()
+    batches = queue.Queue(maxsize = _batch_window(max_records_in_flight))
+    stopped = threading.Event()
+
+    def put(item) -> bool:
+        while not stopped.is_set():
+            try:
+                batches.put(item, timeout = 0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def list_clusters():
+        try:
+            while not stopped.is_set():
+                with cluster_lock:
+                    cluster_name = next(cluster_iter, None)
+                if cluster_name is None:
+                    return
+                try:
+                    pages = utils_instance.metrics.timed_iter('listing', utils_instance.iter_task_arn_pages(cluster_name, task_status))
+                    for a_page in pages:
+                        if a_page and not put((cluster_name, a_page)):
+                            return
+                except Exception as e:
+                    print("Failed to list tasks for cluster {0}: {1}".format(cluster_name, e))
+                    utils_instance.metrics.add_count('failedClusters')
+        finally:
+            put(_WORKER_DONE)
+
+    workers = [threading.Thread(target = list_clusters, daemon = True) for _ in range(max(1, max_cluster_workers))]
+    for a_worker in workers:
+        a_worker.start()
+
+    try:
+        running = len(workers)
+        while running:
+            item = batches.get()
+            if item is _WORKER_DONE:
+                running -= 1
+                continue
+            yield item
+    finally:
+        stopped.set()
+
+
+def bounded_map(fn, items, max_workers: int, max_pending: int):
+    """
+        Like executor.map but only pulls up to max_pending items from the input at a time. Results are yielded in input order.
+    """
+    with ThreadPoolExecutor(max_workers = max(1, max_workers)) as executor:
+        pending = deque()
+        for an_item in items:
+            pending.append(executor.submit(fn, an_item))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def iter_container_records(utils_instance, task_batches, max_workers: int = 4, max_records_in_flight: int = DEFAULT_MAX_RECORDS_IN_FLIGHT):
+    """
+        Describe the task batches concurrently and yield one docker image info record per container, in batch order. A batch
+        that can't be described is logged, counted (failedTaskBatches / failedTasks) and skipped.
+
+        Records are counted against max_records_in_flight from the moment their batch is sent until they are consumed. A
+        batch still being described counts as its task count times the containers per task seen so far (the first batch
+        goes out on its own to find that out), and a new batch is only sent when it fits. One batch is always allowed so a
+        budget smaller than a batch still makes progress.
+    """
+    def describe(a_batch) -> list:
+        cluster_name, task_arns = a_batch
+        try:
+            with utils_instance.metrics.stage('describing'):
+                return [a_record for a_task in utils_instance.describe_task_batch(cluster_name, task_arns)
+                    for a_record in utils_instance.extract_image_info_from_task(a_task)]
+        except Exception as e:
+            print("Failed to describe {0} tasks in cluster {1}: {2}".format(len(task_arns), cluster_name, e))
+            utils_instance.metrics.add_count('failedTaskBatches')
+            utils_instance.metrics.add_count('failedTasks', len(task_arns))
+            return []
+
+    described = { 'tasks': 0, 'records': 0 }
+    in_flight = 0
+
+    def expected_records(task_count) -> int:
+        if not described['tasks']:
+            return task_count
+        return max(1, -(-task_count * described['records'] // described['tasks']))
+
+    with ThreadPoolExecutor(max_workers = max(1, max_workers)) as executor:
+        pending = deque()
+
+        def drain_one():
+            nonlocal in_flight
+            a_future, task_count, charged = pending.popleft()
+            records = a_future.result()
+            described['tasks'] += task_count
+            described['records'] += len(records)
+            # the estimate is swapped for the real count until the consumer has taken the batch
+            in_flight += len(records) - charged
+            yield from records
+            in_flight -= len(records)
+
+        for a_batch in task_batches:
+            charge = expected_records(len(a_batch[1]))
+            # nothing to estimate from until the first batch is back
+            while pending and (not described['tasks'] or in_flight + charge > max_records_in_flight):
+                yield from drain_one()
+            pending.append((executor.submit(describe, a_batch), len(a_batch[1]), charge))
+            in_flight += charge
+        while pending:
+            yield from drain_one()
+
+
+def classify_records(records, analyzer, policy, metrics = None):
+    """
+        Add validBaseImage to each record as it passes through (image parsing and policy matching are both memoized)
+    """
+    metrics = metrics if metrics else get_metrics()
+    elapsed = 0.0
+    try:
+        for a_record in records:
+            start = time.perf_counter()
+            a_record['validBaseImage'] = policy.matches(analyzer.extract_image_info(a_record['image']).base)
+            elapsed += time.perf_counter() - start
+            yield a_record
+    finally:
+        # one update at the end, a lock per record would cost more than the classification itself
+        metrics.add_stage_time('classification', elapsed)
+
+
+def scan_records(utils_instance, analyzer, policy, cluster_names, task_status, max_workers: int = 4,
+        max_records_in_flight: int = DEFAULT_MAX_RECORDS_IN_FLIGHT, classify = None):
+    """
+        The whole pipeline: classified container records for every cluster, streamed.
+        classify(records) replaces the tag based classify_records stage when given.
+    """
+    task_batches = iter_task_batches(utils_instance, cluster_names, task_status, max_workers, max_records_in_flight)
+    records = iter_container_records(utils_instance, task_batches, max_workers, max_records_in_flight)
+    if classify:
+        return classify(records)
+    return classify_records(records, analyzer, policy, utils_instance.metrics)
+
+
+def run_pipeline(records, sink, metrics = None) -> int:
+    """
+        Drain records into a sink (anything with write_row), returns the number of records written
+    """
+    metrics = metrics if metrics else get_metrics()
+    count = 0
+    elapsed = 0.0
+    try:
+        for a_record in records:
+            start = time.perf_counter()
+            sink.write_row(a_record)
+            elapsed += time.perf_counter() - start
+            count += 1
+    finally:
+        metrics.add_stage_time('upload', elapsed)
+        metrics.add_count('rows', count)
+    return count
@@ -0,0 +1,239 @@
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import argparse
+import csv
+import gzip
+import json
+import os
+import sys
+import time
+
+import aws_clients
+from ecs_utils import ecsUtils
+from docker_image_analyzer import dockerImageAnalyzer, parse_base_images_csv
+from rate_limiter import adaptiveRateLimiter
+from scan_metrics import metricsCollector
+from scan_pipeline import scan_records
+from compliance_summary import complianceSummary
+from ecs_reader import REPORT_FIELD_NAMES
+
+'''
+Offline snapshots of an account's ECS tasks. record_snapshot saves the list_tasks pages and describe_tasks results of every
+cluster (plus the valid base image csv) into gzip'd json shard files, replay_snapshot serves them back to ecsUtils through
+snapshotEcsClient and runs the normal scan pipeline over them, one shard per process. Classification can be re-run with a
+new policy file over a whole historical snapshot without touching AWS, and a snapshot makes a realistic test fixture.
+
+Usage:
+    python ecshelpers/scan_snapshot.py record --bucket my-bucket --policy-key dockerImagesSecInfo/validBaseImages.csv snapshots/2022-03-01
+    python ecshelpers/scan_snapshot.py replay snapshots/2022-03-01 --policy newBaseImages.csv --output scanResults.csv
+'''
+
+SNAPSHOT_VERSION = 1
+MANIFEST_NAME = 'manifest.json'
+POLICY_NAME = 'validBaseImages.csv.gz'
+DEFAULT_SNAPSHOT_SHARD_SIZE = 50
+LIST_PAGE_SIZE = 100
+
+
+def _write_json_gz(path, document) -> None:
+    # task descriptions carry datetimes (createdAt, stoppedAt, ...), they are kept as strings
+    with gzip.open(path, 'wt', encoding = 'utf-8') as snapshot_file:
+        json.dump(document, snapshot_file, separators = (',', ':'), default = str)
+
+
+def _read_json_gz(path) -> dict:
+    with gzip.open(path, 'rt', encoding = 'utf-8') as snapshot_file:
+        return json.load(snapshot_file)
+
+
+def shard_file_name(shard_id) -> str:
+    return "shard-{0:05d}.json.gz".format(shard_id)
+
+
+def record_cluster(utils_instance, cluster_arn, task_status) -> dict:
+    """
+        The list_tasks pages and describe_tasks results of one cluster as { 'task_arn_pages': [[arn, ...]], 'tasks': [task] }
+    """
+    task_arn_pages = []
+    tasks = []
+    for a_page in utils_instance.iter_task_arn_pages(cluster_arn, task_status):
+        task_arn_pages.append(a_page)
+        if a_page:
+            tasks.extend(utils_instance.describe_task_batch(cluster_arn, a_page))
+    return { 'task_arn_pages': task_arn_pages, 'tasks': tasks }
+
+
+def record_snapshot(utils_instance, snapshot_dir, task_status = 'STOPPED', cluster_arns = None, base_images_csv = None,
+        shard_size: int = DEFAULT_SNAPSHOT_SHARD_SIZE, max_workers: int = 4) -> dict:
+    """
+        Record every cluster (default all clusters in the account) into snapshot_dir, shard_size clusters per shard file.
+        Returns the manifest.
+    """
+    if cluster_arns is None:
+        cluster_arns = utils_instance.get_cluster_arns()
+    os.makedirs(snapshot_dir, exist_ok = True)
+    shard_size = max(1, shard_size)
+
+    shards = []
+    with ThreadPoolExecutor(max_workers = max(1, max_workers)) as executor:
+        for i in range(0, len(cluster_arns), shard_size):
+            shard_clusters = cluster_arns[i:i + shard_size]
+            recorded = executor.map(lambda a_cluster_arn: record_cluster(utils_instance, a_cluster_arn, task_status), shard_clusters)
+            file_name = shard_file_name(len(shards))
+            _write_json_gz(os.path.join(snapshot_dir, file_name), { 'clusters': dict(zip(shard_clusters, recorded)) })
+            shards.append(file_name)
+
+    manifest = { 'version': SNAPSHOT_VERSION, 'recorded_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()), 'task_status': task_status,
+        'clusters': len(cluster_arns), 'shards': shards, 'policy': None }
+    if base_images_csv is not None:
+        with gzip.open(os.path.join(snapshot_dir, POLICY_NAME), 'wt', encoding = 'utf-8') as policy_file:
+            policy_file.write(base_images_csv)
+        manifest['policy'] = POLICY_NAME
+    with open(os.path.join(snapshot_dir, MANIFEST_NAME), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent = 2)
+    return manifest
+
+
+def load_manifest(snapshot_dir) -> dict:
+    with open(os.path.join(snapshot_dir, MANIFEST_NAME)) as manifest_file:
+        manifest = json.load(manifest_file)
+    if manifest.get('version') != SNAPSHOT_VERSION:
+        raise ValueError("unsupported snapshot version {0}".format(manifest.get('version')))
+    return manifest
+
+
+def load_snapshot_policy(snapshot_dir, manifest) -> str:
+    if not manifest.get('policy'):
+        raise ValueError("snapshot {0} has no base image csv, pass one to replay with".format(snapshot_dir))
+    with gzip.open(os.path.join(snapshot_dir, manifest['policy']), 'rt', encoding = 'utf-8') as policy_file:
+        return policy_file.read()
+
+
+class snapshotEcsClient:
+    ''' Serves recorded clusters ({ cluster_arn: { 'task_arn_pages', 'tasks' } }) with the ECS client calls ecsUtils makes.'''
+
+    def __init__(self, clusters) -> None:
+        self.clusters = clusters
+        self.cluster_arns = list(clusters)
+        self.cluster_names = { a_cluster_arn.rsplit('/', 1)[-1]: a_cluster_arn for a_cluster_arn in self.cluster_arns }
+        self.tasks_by_arn = { a_task['taskArn']: a_task for a_cluster in clusters.values() for a_task in a_cluster['tasks'] }
+
+    def _cluster(self, cluster) -> dict:
+        return self.clusters.get(self.cluster_names.get(cluster, cluster), { 'task_arn_pages': [], 'tasks': [] })
+
+    def list_clusters(self, nextToken = None, **kwargs) -> dict:
+        start = int(nextToken) if nextToken else 0
+        response = { 'clusterArns': self.cluster_arns[start:start + LIST_PAGE_SIZE] }
+        if start + LIST_PAGE_SIZE < len(self.cluster_arns):
+            response['nextToken'] = str(start + LIST_PAGE_SIZE)
+        return response
+
+    def list_tasks(self, cluster, nextToken = None, **kwargs) -> dict:
+        pages = self._cluster(cluster)['task_arn_pages']
+        page_index = int(nextToken) if nextToken else 0
+        response = { 'taskArns': pages[page_index] if page_index < len(pages) else [] }
+        if page_index + 1 < len(pages):
+            response['nextToken'] = str(page_index + 1)
+        return response
+
+    def describe_tasks(self, cluster, tasks, **kwargs) -> dict:
+        return { 'tasks': [self.tasks_by_arn[a_task_arn] for a_task_arn in tasks if a_task_arn in self.tasks_by_arn],
+            'failures': [{ 'arn': a_task_arn, 'reason': 'MISSING' } for a_task_arn in tasks if a_task_arn not in self.tasks_by_arn] }
+
+
+def replay_shard(shard_path, base_images_csv, task_status, output_path, max_workers: int = 4) -> dict:
+    """
+        Run the scan pipeline over one shard file and write its rows to output_path (csv, no header). Runs in a worker process.
+    """
+    clusters = _read_json_gz(shard_path)['clusters']
+    metrics = metricsCollector()
+    utils_instance = ecsUtils(False, ecs_client = snapshotEcsClient(clusters), rate_limiter = adaptiveRateLimiter(rate = None),
+        metrics = metrics, max_workers = max_workers)
+    analyzer = dockerImageAnalyzer(False)
+    policy = analyzer.compile_base_images(parse_base_images_csv(base_images_csv))
+
+    rows = 0
+    with open(output_path, 'w', newline = '') as output_file:
+        writer = csv.DictWriter(output_file, REPORT_FIELD_NAMES, extrasaction = 'ignore')
+        for a_record in scan_records(utils_instance, analyzer, policy, list(clusters), task_status, max_workers = max_workers):
+            writer.writerow(a_record)
+            rows += 1
+    return { 'shard': os.path.basename(shard_path), 'rows': rows, 'stages': metrics.summary()['stage_seconds'] }
+
+
+def replay_snapshot(snapshot_dir, output_path, base_images_csv = None, processes: int = None, max_workers: int = 4) -> dict:
+    """
+        Replay every shard of a snapshot on a process pool and merge the rows into one csv report at output_path.
+        base_images_csv replaces the policy recorded with the snapshot. Returns the compliance summary of the replay.
+    """
+    start = time.perf_counter()
+    manifest = load_manifest(snapshot_dir)
+    if base_images_csv is None:
+        base_images_csv = load_snapshot_policy(snapshot_dir, manifest)
+
+    part_paths = ["{0}.part{1:05d}".format(output_path, i) for i in range(len(manifest['shards']))]
+    with ProcessPoolExecutor(max_workers = processes) as executor:
+        futures = [executor.submit(replay_shard, os.path.join(snapshot_dir, a_shard), base_images_csv, manifest['task_status'], a_part_path,
+            max_workers) for a_shard, a_part_path in zip(manifest['shards'], part_paths)]
+        shard_results = [a_future.result() for a_future in futures]
+
+    # merge the shard parts in shard order, summarising as the rows go by
+    summary = complianceSummary()
+    with open(output_path, 'w', newline = '') as output_file:
+        writer = csv.DictWriter(output_file, REPORT_FIELD_NAMES)
+        writer.writeheader()
+        for a_part_path in part_paths:
+            with open(a_part_path, newline = '') as part_file:
+                for a_row in csv.DictReader(part_file, REPORT_FIELD_NAMES):
+                    summary.add(a_row)
+                    writer.writerow(a_row)
+            os.remove(a_part_path)
+
+    result = summary.to_dict()
+    result['shards'] = shard_results
+    result['seconds'] = round(time.perf_counter() - start, 3)
+    return result
+
+
+def main(argv = None) -> int:
+    parser = argparse.ArgumentParser(description = "Record ECS scans to local snapshots and replay them offline")
+    commands = parser.add_subparsers(dest = 'command', required = True)
+
+    record_parser = commands.add_parser('record', help = "record every cluster in the account/region (live AWS calls)")
+    record_parser.add_argument('snapshot_dir')
+    record_parser.add_argument('--profile', default = 'default')
+    record_parser.add_argument('--task-status', default = 'STOPPED')
+    record_parser.add_argument('--bucket', help = "bucket of the valid base image csv to record with the snapshot")
+    record_parser.add_argument('--policy-key', help = "key of the valid base image csv to record with the snapshot")
+    record_parser.add_argument('--shard-size', type = int, default = DEFAULT_SNAPSHOT_SHARD_SIZE)
+    record_parser.add_argument('--workers', type = int, default = 4)
+
+    replay_parser = commands.add_parser('replay', help = "classify a recorded snapshot locally")
+    replay_parser.add_argument('snapshot_dir')
+    replay_parser.add_argument('--policy', help = "valid base image csv to classify with (defaults to the one recorded)")
+    replay_parser.add_argument('--output', default = 'scanResults.csv')
+    replay_parser.add_argument('--processes', type = int, default = None)
+    replay_parser.add_argument('--workers', type = int, default = 4)
+    args = parser.parse_args(argv)
+
+    if args.command == 'record':
+        utils_instance = ecsUtils(False, aws_profile = args.profile, max_workers = args.workers)
+        base_images_csv = None
+        if args.bucket and args.policy_key:
+            s3_client = aws_clients.get_client('s3', session = aws_clients.get_session(args.profile))
+            base_images_csv = s3_client.get_object(Bucket = args.bucket, Key = args.policy_key)['Body'].read().decode('utf-8')
+        manifest = record_snapshot(utils_instance, args.snapshot_dir, args.task_status, base_images_csv = base_images_csv,
+            shard_size = args.shard_size, max_workers = args.workers)
+        print("recorded {0} clusters into {1} shards in {2}".format(manifest['clusters'], len(manifest['shards']), args.snapshot_dir))
+        return 0
+
+    base_images_csv = None
+    if args.policy:
+        with open(args.policy) as policy_file:
+            base_images_csv = policy_file.read()
+    result = replay_snapshot(args.snapshot_dir, args.output, base_images_csv, processes = args.processes, max_workers = args.workers)
+    print(json.dumps(result, indent = 2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,165 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+import gzip
+import json
+import re
+import threading
+import botocore
+
+'''
+Service based scanning. Instead of describing every running task (one row per replica), walk the services in each cluster
+and resolve the task definition of each deployment. A service with 200 replicas costs one describe_task_definition call
+instead of two describe_tasks pages, and task definitions shared between services (or runs) are only described once.
+
+Rows come from the task definition so imageDigest isn't known (the image is as written in the task definition).
+'''
+
+TASK_DEFINITION_CACHE_VERSION = 1
+# task definition revisions are immutable, only arns that pin a revision (family:revision) can be cached
+_REVISION_PATTERN = re.compile(r':\d+$')
+
+
+class taskDefinitionCache:
+    ''' Container (name, image) lists keyed by task definition arn. Concurrent lookups of the same arn share a single
+        describe_task_definition call. Can be stored in S3 (gzip'd json) so revisions are described once across runs.'''
+
+    def __init__(self, entries = None) -> None:
+        # { task_definition_arn: [(container_name, image), ...] }
+        self.entries = entries if entries is not None else {}
+        self.hits = 0
+        self.misses = 0
+        # set when entries were added since the cache was loaded/saved
+        self.dirty = False
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get_containers(self, task_definition_arn, describe) -> list:
+        """
+            Return [(container_name, image), ...] for the task definition, calling describe(task_definition_arn) on a miss
+        """
+        if not _REVISION_PATTERN.search(task_definition_arn):
+            return _containers(describe(task_definition_arn))
+
+        with self._lock:
+            containers = self.entries.get(task_definition_arn)
+            if containers is not None:
+                self.hits += 1
+                return containers
+            pending = self._in_flight.get(task_definition_arn)
+            is_owner = pending is None
+            if is_owner:
+                pending = Future()
+                self._in_flight[task_definition_arn] = pending
+            else:
+                self.hits += 1
+
+        if not is_owner:
+            return pending.result()
+
+        try:
+            containers = _containers(describe(task_definition_arn))
+        except Exception as e:
+            with self._lock:
+                del self._in_flight[task_definition_arn]
+            pending.set_exception(e)
+            raise
+
+        with self._lock:
+            self.entries[task_definition_arn] = containers
+            self.misses += 1
+            self.dirty = True
+            del self._in_flight[task_definition_arn]
+        pending.set_result(containers)
+        return containers
+
+    def to_bytes(self) -> bytes:
+        with self._lock:
+            entries = { task_definition_arn: [list(a_container) for a_container in containers]
+                for task_definition_arn, containers in self.entries.items() }
+        document = { 'version': TASK_DEFINITION_CACHE_VERSION, 'task_definitions': entries }
+        return gzip.compress(json.dumps(document, separators = (',', ':')).encode('utf-8'))
+
+    @classmethod
+    def from_bytes(cls, data) -> 'taskDefinitionCache':
+        document = json.loads(gzip.decompress(data).decode('utf-8'))
+        if document.get('version') != TASK_DEFINITION_CACHE_VERSION:
+            return cls()
+        return cls({ task_definition_arn: [tuple(a_container) for a_container in containers]
+            for task_definition_arn, containers in document['task_definitions'].items() })
+
+    @classmethod
+    def load_from_s3(cls, s3_client, bucket_name, key) -> 'taskDefinitionCache':
+        """
+            Load the cache from S3, an empty cache is returned when there isn't one yet
+        """
+        try:
+            data = s3_client.get_object(Bucket = bucket_name, Key = key)
+        except botocore.exceptions.ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+                return cls()
+            raise
+        return cls.from_bytes(data['Body'].read())
+
+    def save_to_s3(self, s3_client, bucket_name, key) -> None:
+        s3_client.put_object(Bucket = bucket_name, Key = key, Body = self.to_bytes(), ContentType = 'application/json',
+            ContentEncoding = 'gzip')
+        self.dirty = False
+
+    def stats(self) -> dict:
+        with self._lock:
+            return { 'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses }
+
+
+def _containers(task_definition) -> list:
+    return [(a_container.get('name', 'N/A'), a_container.get('image', 'N/A')) for a_container in task_definition.get('containerDefinitions', [])]
+
+
+class serviceScanner:
+    ''' Builds report rows for a cluster from its services' deployments (one row per deployment container). scan_cluster
+        has the same signature as ecsUtils.get_image_info_for_tasks so it plugs into iter_image_info_for_clusters.'''
+
+    def __init__(self, utils_instance, task_definition_cache = None) -> None:
+        self.utils_instance = utils_instance
+        self.task_definition_cache = task_definition_cache if task_definition_cache is not None else taskDefinitionCache()
+
+    def _get_containers(self, task_definition_arn) -> list:
+        return self.task_definition_cache.get_containers(task_definition_arn, self.utils_instance.describe_task_definition)
+
+    def scan_cluster(self, cluster_name, task_status = None) -> list:
+        """
+            Rows for every deployment of every service in the cluster (task_status is ignored, services only have running tasks)
+        """
+        service_arns = [a_service_arn for a_page in self.utils_instance.iter_service_arn_pages(cluster_name) for a_service_arn in a_page]
+        if not service_arns:
+            return []
+
+        deployments = [(a_service, a_deployment) for a_service in self.utils_instance.describe_services(cluster_name, service_arns)
+            for a_deployment in a_service.get('deployments', [])]
+        task_definition_arns = list(dict.fromkeys(a_deployment['taskDefinition'] for _, a_deployment in deployments))
+
+        # its share of max_workers when iter_image_info_for_clusters is scanning other clusters at the same time
+        max_workers = self.utils_instance.describe_workers()
+        if max_workers <= 1 or len(task_definition_arns) <= 1:
+            resolved = [self._get_containers(an_arn) for an_arn in task_definition_arns]
+        else:
+            with ThreadPoolExecutor(max_workers = min(max_workers, len(task_definition_arns))) as executor:
+                resolved = list(executor.map(self._get_containers, task_definition_arns))
+        containers_by_arn = dict(zip(task_definition_arns, resolved))
+
+        rows = []
+        for a_service, a_deployment in deployments:
+            cluster_arn = a_service.get('clusterArn', 'unknown')
+            for container_name, image in containers_by_arn[a_deployment['taskDefinition']]:
+                rows.append({
+                    'name': container_name,
+                    'image': image,
+                    'imageDigest': 'N/A',
+                    'group': 'service:{0}'.format(a_service.get('serviceName', 'unknown')),
+                    'cluster_arn': cluster_arn,
+                    'account_id': self.utils_instance.extract_account_id_from_cluster_arn(cluster_arn),
+                    'taskDefinition': a_deployment['taskDefinition'],
+                    'runningCount': a_deployment.get('runningCount', 0)
+                })
+        return rows
@@ -5,6 +5,8 @@ from unittest import TestCase
 import sys, os
 myPath = os.path.dirname(os.path.abspath(__file__))
 sys.path.insert(0, myPath + '/../ecshelpers/')
+# the synthetic fleet and in memory ECS/S3 stand-ins (fleet_generator, local_endpoints) live with the benchmarks
+sys.path.insert(0, myPath + '/../benchmarks/')
 print(sys.path)
 
 
@@ -0,0 +1,46 @@
+import pytest
+import boto3
+from ecshelpers import aws_clients
+from ecshelpers.ecs_utils import ECS_CLIENT_CONFIG
+
+
+@pytest.fixture(autouse=True)
+def reset_clients():
+    aws_clients.reset_clients()
+    yield
+    aws_clients.reset_clients()
+
+def test_get_client_reuses_clients(assertions):
+    first_client = aws_clients.get_client('s3')
+    assertions.assertIs(first_client, aws_clients.get_client('s3'))
+    assertions.assertIsNot(first_client, aws_clients.get_client('s3', 'us-west-2'))
+
+def test_get_session_is_created_once(assertions):
+    assertions.assertIs(aws_clients.get_session(), aws_clients.get_session())
+
+def _session(access_key, region = 'us-east-1'):
+    return boto3.Session(aws_access_key_id = access_key, aws_secret_access_key = 'secret', region_name = region)
+
+def test_clients_are_shared_per_credentials_and_region(assertions):
+    first_client = aws_clients.get_client('ecs', session = _session('AKIDFIRST1234567'))
+    assertions.assertIs(first_client, aws_clients.get_client('ecs', session = _session('AKIDFIRST1234567')))
+    assertions.assertIsNot(first_client, aws_clients.get_client('ecs', session = _session('AKIDSECOND123456')))
+    assertions.assertIsNot(first_client, aws_clients.get_client('ecs', session = _session('AKIDFIRST1234567', 'us-west-2')))
+    assertions.assertEqual('us-east-1', first_client.meta.region_name)
+
+def test_client_config_is_tuned_for_the_scan_concurrency(assertions, monkeypatch):
+    monkeypatch.setenv('SCAN_MAX_WORKERS', '16')
+    client_config = aws_clients.get_client('ecs', 'us-east-1', config = ECS_CLIENT_CONFIG).meta.config
+    assertions.assertEqual(34, client_config.max_pool_connections)
+    assertions.assertTrue(client_config.tcp_keepalive)
+    assertions.assertEqual(aws_clients.DEFAULT_READ_TIMEOUT, client_config.read_timeout)
+    # service specific settings win over the defaults
+    assertions.assertEqual(1, client_config.retries['total_max_attempts'])
+    assertions.assertEqual(10, aws_clients.pool_size_for(1))
+
+def test_oldest_clients_are_dropped_once_the_cache_is_full(assertions, monkeypatch):
+    monkeypatch.setattr(aws_clients, 'MAX_CACHED_CLIENTS', 2)
+    first_client = aws_clients.get_client('s3', 'us-east-1')
+    aws_clients.get_client('s3', 'us-east-2')
+    aws_clients.get_client('s3', 'us-west-1')
+    assertions.assertIsNot(first_client, aws_clients.get_client('s3', 'us-east-1'))
@@ -0,0 +1,27 @@
+import pytest
+from ecshelpers.base_image_policy import baseImagePolicy, version_key
+
+
+@pytest.fixture
+def policy():
+    return baseImagePolicy([ "14.17.6_2022.01.13-slim", "2021.09.25", "2022.02.*", "3.9-*-slim", "2021.10.01..2021.12.31", "2023.06.01.." ])
+
+@pytest.mark.parametrize("base", [ "14.17.6_2022.01.13-slim", "2021.09.25", "2022.02.14", "3.9-bullseye-slim", "2021.10.01", "2021.11.5", "2021.12.31",
+    "2021.12.31-slim", "2024.01.01" ])
+def test_policy_matches_valid_bases(base, policy):
+    assert policy.matches(base)
+
+@pytest.mark.parametrize("base", [ "", "14.17.6_2022.01.11-slim", "2021.09.24", "2022.03.01", "3.9-bullseye", "2021.09.30", "2022.01.01",
+    "2022.01.01-slim", "2023.05.31" ])
+def test_policy_rejects_invalid_bases(base, policy):
+    assert not policy.matches(base)
+
+def test_policy_supports_in_operator(assertions, policy):
+    assertions.assertIn("2021.09.25", policy)
+    assertions.assertNotIn("2021.09.26", policy)
+
+def test_version_key_compares_numbers_numerically(assertions):
+    assertions.assertLess(version_key("2021.9.25"), version_key("2021.10.1"))
+
+def test_policy_with_no_entries_matches_nothing(assertions):
+    assertions.assertFalse(baseImagePolicy([]).matches("2021.09.25"))
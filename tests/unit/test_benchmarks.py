@@ -0,0 +1,26 @@
+from run_benchmarks import run_benchmark, compare_results
+from fleet_generator import generate_fleet
+
+
+def test_generate_fleet_is_deterministic(assertions):
+    assertions.assertEqual(generate_fleet(5, 50, seed = 3), generate_fleet(5, 50, seed = 3))
+
+def test_run_benchmark_scans_whole_fleet(assertions):
+    fleet = generate_fleet(5, 250, 2, 20)
+    results = run_benchmark(5, 250, 2, 20, 20, workers = 4)
+    expected_rows = sum(len(a_task['containers']) for tasks in fleet.values() for a_task in tasks)
+    assertions.assertEqual(expected_rows, results['rows'])
+    assertions.assertIn('classification', results['stage_seconds'])
+
+def test_run_benchmark_pipeline_mode_scans_whole_fleet(assertions):
+    fleet = generate_fleet(5, 250, 2, 20)
+    results = run_benchmark(5, 250, 2, 20, 20, workers = 4, mode = 'pipeline')
+    expected_rows = sum(len(a_task['containers']) for tasks in fleet.values() for a_task in tasks)
+    assertions.assertEqual(expected_rows, results['rows'])
+
+def test_compare_results_reports_regressions(assertions):
+    baseline = { 'total_seconds': 1.0, 'peak_memory_mb': 10.0, 'stage_seconds': { 'scan': 0.5 } }
+    current = { 'total_seconds': 1.1, 'peak_memory_mb': 20.0, 'stage_seconds': { 'scan': 0.5 } }
+    regressions = compare_results(current, baseline)
+    assertions.assertEqual(1, len(regressions))
+    assertions.assertIn('peak_memory_mb', regressions[0])
@@ -0,0 +1,76 @@
+import json
+import pytest
+from ecshelpers.compliance_summary import spaceSavingCounter, hyperLogLog, complianceSummary, summarize_records, summary_key
+
+CLUSTER_1 = 'arn:aws:ecs:us-east-1:123456789012:cluster/TestCluster1'
+CLUSTER_2 = 'arn:aws:ecs:us-east-1:123456789012:cluster/TestCluster2'
+
+
+def _row(image, valid, cluster_arn = CLUSTER_1, group = 'service:pets-ui', digest = ''):
+    return { 'account_id': '123456789012', 'name': 'container1', 'group': group, 'validBaseImage': valid, 'image': image,
+        'imageDigest': digest, 'cluster_arn': cluster_arn }
+
+def test_space_saving_is_exact_below_capacity(assertions):
+    counter = spaceSavingCounter(capacity = 3)
+    for a_key in ['a', 'b', 'a', 'c', 'a', 'b']:
+        counter.add(a_key)
+    assertions.assertTrue(counter.exact)
+    assertions.assertEqual([('a', 3, 0), ('b', 2, 0), ('c', 1, 0)], counter.top())
+
+def test_space_saving_keeps_heavy_hitters_when_full(assertions):
+    counter = spaceSavingCounter(capacity = 2)
+    for a_key in ['a'] * 5 + ['b', 'c', 'd', 'e'] + ['a']:
+        counter.add(a_key)
+    top = counter.top()
+    assertions.assertFalse(counter.exact)
+    assertions.assertEqual(2, len(counter.counts))
+    assertions.assertEqual(('a', 6, 0), top[0])
+    # the newest key inherits the evicted count as its error bound
+    assertions.assertEqual(('e', 4, 3), top[1])
+
+def test_hyperloglog_estimates_distinct_count(assertions):
+    hll = hyperLogLog()
+    for i in range(20000):
+        hll.add("image{0}".format(i % 5000))
+    assertions.assertAlmostEqual(5000, hll.count(), delta = 5000 * 0.05)
+
+def test_hyperloglog_rejects_bad_precision():
+    with pytest.raises(ValueError):
+        hyperLogLog(precision = 20)
+
+def test_summary_counts_non_compliant_rows_per_dimension(assertions):
+    summary = complianceSummary()
+    rows = [
+        _row('repo/pets-ui:build1_base-2021.09.25', False),
+        _row('repo/pets-ui:build1_base-2021.09.25', 'False', cluster_arn = CLUSTER_2),
+        _row('repo/pets-api:build7_base-2022.01.13', True, group = 'service:pets-api'),
+        _row('repo/pets-api:build6_base-2021.10.22', False, group = 'family:pets-api', digest = 'sha256:' + '1' * 64),
+    ]
+    streamed = list(summarize_records(rows, summary))
+    result = summary.to_dict(generated_at = '2022-03-01T00:00:00Z')
+
+    assertions.assertEqual(rows, streamed)
+    assertions.assertEqual(4, result['rows'])
+    assertions.assertEqual(3, result['nonCompliantRows'])
+    assertions.assertEqual(3, result['distinctImages'])
+    assertions.assertEqual(2, result['distinctNonCompliantImages'])
+    assertions.assertEqual({ '123456789012': 3 }, result['nonCompliant']['account_id'])
+    assertions.assertEqual({ 'TestCluster1': 2, 'TestCluster2': 1 }, result['nonCompliant']['cluster'])
+    assertions.assertEqual({ 'service:pets-ui': 2, 'family:pets-api': 1 }, result['nonCompliant']['group'])
+    assertions.assertEqual({ '2021.09.25': 2, '2021.10.22': 1 }, result['nonCompliant']['baseImage'])
+    assertions.assertEqual({ 'image': 'repo/pets-ui:build1_base-2021.09.25', 'count': 2, 'maxOvercount': 0 }, result['topOffendingImages'][0])
+    assertions.assertEqual([], result['approximate'])
+
+def test_summary_is_saved_next_to_the_report(assertions):
+    class recordingS3Client:
+        def put_object(self, **kwargs):
+            self.put_args = kwargs
+
+    s3_client = recordingS3Client()
+    summary = complianceSummary()
+    summary.add(_row('repo/pets-ui:build1_base-2021.09.25', False))
+    key = summary_key('dockerImagesSecInfo/scanResults1.csv')
+    summary.save_to_s3(s3_client, 'bucket1', key)
+
+    assertions.assertEqual('dockerImagesSecInfo/scanResults1-summary.json', s3_client.put_args['Key'])
+    assertions.assertEqual(1, json.loads(s3_client.put_args['Body'])['nonCompliantRows'])
@@ -1,8 +1,10 @@
 import pytest
-from ecshelpers.docker_image_analyzer import dockerImageAnalyzer
+from ecshelpers.docker_image_analyzer import dockerImageAnalyzer, imageInfo, parse_image_reference, clear_base_image_cache
+import io
 import botocore
 import boto3
 from botocore.stub import Stubber
+from botocore.response import StreamingBody
 
 
 # define some fixtures to make code cleaner
@@ -14,65 +16,110 @@ def analyzer_instance():
 def ecr_repo_base_ref():
     return "99999999.dkr.ecr.us-east-1.amazonaws.com/"
 
-def test_extract_image_info_dev_ui_image_feature_branch(assertions, analyzer_instance, ecr_repo_base_ref):
+@pytest.fixture
+def ecr_registry():
+    return "99999999.dkr.ecr.us-east-1.amazonaws.com"
+
+def test_extract_image_info_dev_ui_image_feature_branch(assertions, analyzer_instance, ecr_repo_base_ref, ecr_registry):
     dev_image_info = ecr_repo_base_ref + "pets/dev/pets-ui:feature__feat1-build30-dev01_base-14.17.6_2022.01.13-slim"
     ecr_repo = ecr_repo_base_ref + "pets/dev/pets-ui"
     image_tag = "feature__feat1-build30-dev01_base-14.17.6_2022.01.13-slim"
     image_base = "14.17.6_2022.01.13-slim"
     result = analyzer_instance.extract_image_info(dev_image_info)
-    expected_result = { 'tag' : image_tag, 'base' : image_base, 'repo' : ecr_repo }
+    expected_result = imageInfo(tag = image_tag, base = image_base, repo = ecr_repo, registry = ecr_registry)
     assertions.assertEqual(result, expected_result) 
 
-def test_extract_image_info_dev_ui_image_dev_branch(assertions, analyzer_instance, ecr_repo_base_ref):
+def test_extract_image_info_dev_ui_image_dev_branch(assertions, analyzer_instance, ecr_repo_base_ref, ecr_registry):
     dev_image_info = ecr_repo_base_ref + "pets/dev/pets-ui:develop-build30-dev01_base-14.17.6_2022.01.13-slim"
     ecr_repo = ecr_repo_base_ref + "pets/dev/pets-ui"
     image_tag = "develop-build30-dev01_base-14.17.6_2022.01.13-slim"
     image_base = "14.17.6_2022.01.13-slim"
     result = analyzer_instance.extract_image_info(dev_image_info)
-    expected_result = { 'tag' : image_tag, 'base' : image_base, 'repo' : ecr_repo }
+    expected_result = imageInfo(tag = image_tag, base = image_base, repo = ecr_repo, registry = ecr_registry)
     assertions.assertEqual(result, expected_result) 
 
-def test_extract_image_info_dev_svc_image_dev_branch(assertions, analyzer_instance, ecr_repo_base_ref):
+def test_extract_image_info_dev_svc_image_dev_branch(assertions, analyzer_instance, ecr_repo_base_ref, ecr_registry):
     dev_svc_image = ecr_repo_base_ref + "pets/dev/pets-svc:develop-build30-dev01_base-2021.09.25"
     ecr_repo = ecr_repo_base_ref + "pets/dev/pets-svc"
     image_tag = "develop-build30-dev01_base-2021.09.25"
     image_base = "2021.09.25"
     result = analyzer_instance.extract_image_info(dev_svc_image)
-    expected_result = { 'tag' : image_tag, 'base' : image_base, 'repo' : ecr_repo }
+    expected_result = imageInfo(tag = image_tag, base = image_base, repo = ecr_repo, registry = ecr_registry)
     assertions.assertEqual(result, expected_result) 
 
-def test_extract_image_info_rel_ui_image(assertions, analyzer_instance, ecr_repo_base_ref):
+def test_extract_image_info_rel_ui_image(assertions, analyzer_instance, ecr_repo_base_ref, ecr_registry):
     rel_ui_image = ecr_repo_base_ref + "pets/rel/pets-ui:1.1.1_base-14.17.6_2022.01.13-slim"
     ecr_repo = ecr_repo_base_ref + "pets/rel/pets-ui"
     image_tag = "1.1.1_base-14.17.6_2022.01.13-slim"
     image_base = "14.17.6_2022.01.13-slim"
     result = analyzer_instance.extract_image_info(rel_ui_image)
-    expected_result = { 'tag' : image_tag, 'base' : image_base, 'repo' : ecr_repo }
+    expected_result = imageInfo(tag = image_tag, base = image_base, repo = ecr_repo, registry = ecr_registry)
     assertions.assertEqual(result, expected_result) 
 
-def test_extract_image_info_rel_svc_image(assertions, analyzer_instance, ecr_repo_base_ref):
+def test_extract_image_info_rel_svc_image(assertions, analyzer_instance, ecr_repo_base_ref, ecr_registry):
     rel_image_info = ecr_repo_base_ref + "pets/rel/pets-svc:1.1.1_base-2021.09.25"
     ecr_repo = ecr_repo_base_ref + "pets/rel/pets-svc"
     image_tag = "1.1.1_base-2021.09.25"
     image_base = "2021.09.25"
     result = analyzer_instance.extract_image_info(rel_image_info)
-    expected_result = { 'tag' : image_tag, 'base' : image_base, 'repo' : ecr_repo }
+    expected_result = imageInfo(tag = image_tag, base = image_base, repo = ecr_repo, registry = ecr_registry)
     assertions.assertEqual(result, expected_result)
 
-def test_extract_image_info_returns_empty_info_when_no_repo_found(assertions, analyzer_instance):
+def test_extract_image_info_treats_a_bare_name_as_an_untagged_repo(assertions, analyzer_instance):
+    # w/out a colon this is a repo name (like "nginx"), so there is no base image info to find
     dev_image_info = "feature__feat1-build30-dev01_base-14.17.6_2022.01.13-slim"
     result = analyzer_instance.extract_image_info(dev_image_info)
-    expected_result = { 'tag' : '', 'base' : '', 'repo' : '' }
-    assertions.assertEqual(result, expected_result) 
+    expected_result = imageInfo(repo = dev_image_info, tag = "latest")
+    assertions.assertEqual(result, expected_result)
+    assertions.assertEqual('', result.base)
 
-def test_extract_image_info_returns_partial_info_when_no_base_image_found(assertions, analyzer_instance, ecr_repo_base_ref):
+def test_extract_image_info_returns_partial_info_when_no_base_image_found(assertions, analyzer_instance, ecr_repo_base_ref, ecr_registry):
     rel_image_info = ecr_repo_base_ref + "pets/rel/pets-svc:1.1.1-2021.09.25"
     ecr_repo = ecr_repo_base_ref + "pets/rel/pets-svc"
     image_tag = "1.1.1-2021.09.25"
     result = analyzer_instance.extract_image_info(rel_image_info)
-    expected_result = { 'tag' : image_tag, 'base' : '', 'repo' : ecr_repo }
+    expected_result = imageInfo(tag = image_tag, base = '', repo = ecr_repo, registry = ecr_registry)
     assertions.assertEqual(result, expected_result) 
 
+def test_extract_image_info_handles_registry_port_and_digest(assertions, analyzer_instance):
+    result = analyzer_instance.extract_image_info("localhost:5000/pets/pets-svc:1.1.1_base-2021.09.25@sha256:d5e4")
+    expected_result = imageInfo(repo = "localhost:5000/pets/pets-svc", tag = "1.1.1_base-2021.09.25", base = "2021.09.25", digest = "sha256:d5e4", registry = "localhost:5000")
+    assertions.assertEqual(expected_result, result)
+
+def test_extract_image_info_handles_digest_without_tag(assertions, analyzer_instance, ecr_repo_base_ref, ecr_registry):
+    result = analyzer_instance.extract_image_info(ecr_repo_base_ref + "pets/rel/pets-svc@sha256:d5e4")
+    expected_result = imageInfo(repo = ecr_repo_base_ref + "pets/rel/pets-svc", digest = "sha256:d5e4", registry = ecr_registry)
+    assertions.assertEqual(expected_result, result)
+
+def test_extract_image_info_does_not_treat_registry_port_as_tag(assertions, analyzer_instance):
+    result = analyzer_instance.extract_image_info("registry.local:5000/pets/pets-svc")
+    assertions.assertEqual(imageInfo(repo = "registry.local:5000/pets/pets-svc", tag = "latest", registry = "registry.local:5000"), result)
+
+@pytest.mark.parametrize("image_str, expected_result", [
+    ("nginx", imageInfo(repo = "nginx", tag = "latest")),
+    ("docker.io/library/nginx", imageInfo(repo = "docker.io/library/nginx", tag = "latest", registry = "docker.io")),
+    ("", imageInfo()) ])
+def test_extract_image_info_defaults_missing_tag_to_latest(image_str, expected_result, assertions, analyzer_instance):
+    assertions.assertEqual(expected_result, analyzer_instance.extract_image_info(image_str))
+
+@pytest.mark.parametrize("image_str, expected_result", [
+    ("nginx@sha256:d5e4", imageInfo(repo = "nginx", digest = "sha256:d5e4")),
+    ("registry.local:5000/pets/pets-svc:1.1.1_base-2021.09.25", imageInfo(repo = "registry.local:5000/pets/pets-svc",
+        tag = "1.1.1_base-2021.09.25", base = "2021.09.25", registry = "registry.local:5000")),
+    ("registry.local:5000/pets/pets-svc@sha256:d5e4", imageInfo(repo = "registry.local:5000/pets/pets-svc", digest = "sha256:d5e4",
+        registry = "registry.local:5000")),
+    ("pets/pets-svc", imageInfo(repo = "pets/pets-svc", tag = "latest")) ])
+def test_parse_image_reference(image_str, expected_result, assertions):
+    assertions.assertEqual(expected_result, parse_image_reference(image_str))
+
+def test_extract_image_info_is_memoized_and_immutable(assertions, analyzer_instance, ecr_repo_base_ref):
+    image = ecr_repo_base_ref + "pets/rel/pets-svc:1.1.1_base-2021.09.25"
+    result = analyzer_instance.extract_image_info(image)
+    assertions.assertIs(result, analyzer_instance.extract_image_info(image))
+    assertions.assertEqual("2021.09.25", result['base'])
+    with pytest.raises(AttributeError):
+        result.base = "changed"
+
 @pytest.mark.parametrize("image_str", [ "pets/rel/pets-svc:1.1.1_base-2021.09.25", "pets/rel/pets-ui:1.1.1_base-14.17.6_2022.01.13-slim"])
 def test_image_matches_bases_returns_true_for_matching_image(image_str, assertions, analyzer_instance, ecr_repo_base_ref):
     valid_base_images = [ "14.17.6_2022.01.13-slim", "2021.09.25" ]
@@ -133,3 +180,71 @@ def test_fetch_base_images_from_s3_throws_error_with_bad_bucket_using_mock(analy
     stubber.deactivate()
     assertions.assertEqual(exec_info.typename, "NoSuchBucket")
 
+
+def test_classify_images_returns_results_in_order(assertions, analyzer_instance, ecr_repo_base_ref):
+    images = [
+        ecr_repo_base_ref + "pets/rel/pets-svc:1.1.1_base-2021.09.25",
+        ecr_repo_base_ref + "pets/rel/pets-svc:1.1.1_base-2021.08.22",
+        ecr_repo_base_ref + "pets/rel/pets-ui:1.1.1_base-14.17.6_2022.02.01-slim",
+        ecr_repo_base_ref + "pets/rel/pets-svc:1.1.1_base-2021.09.25",
+        "no_tag_image"
+    ]
+    valid_base_images = analyzer_instance.compile_base_images([ "2021.09.25", "14.17.6_2022.02.*" ])
+    results = analyzer_instance.classify_images(images, valid_base_images)
+    assertions.assertEqual([True, False, True, True, False], results)
+
+def test_image_matches_bases_accepts_compiled_policy(assertions, analyzer_instance, ecr_repo_base_ref):
+    valid_base_images = analyzer_instance.compile_base_images([ "2021.09.01..2021.09.30" ])
+    result = analyzer_instance.image_matches_current_bases(ecr_repo_base_ref + "pets/rel/pets-svc:1.1.1_base-2021.09.25", valid_base_images)
+    assertions.assertEqual(True, result)
+
+def _csv_body(csv_text):
+    return StreamingBody(io.BytesIO(csv_text.encode('utf-8')), len(csv_text))
+
+class fakeClock:
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+def test_fetch_base_images_from_s3_handles_quoted_values(assertions, analyzer_instance):
+    s3_client = boto3.client('s3')
+    stubber = Stubber(s3_client)
+    csv_text = 'image_tag,image_type\n"14.17.6_2022.01.13-slim","node JS"\n"2021.09.25","tomcat, java"\n'
+    stubber.add_response("get_object", { 'Body': _csv_body(csv_text) }, { 'Bucket': 'bucket1', 'Key': 'object_key' })
+    stubber.activate()
+    base_images = analyzer_instance.fetch_base_images_from_s3("bucket1", "object_key", s3_client)
+    stubber.deactivate()
+    assertions.assertEqual([ "14.17.6_2022.01.13-slim", "2021.09.25" ], base_images)
+
+def test_get_base_image_policy_is_cached_and_revalidated_with_etag(assertions, analyzer_instance):
+    clear_base_image_cache()
+    clock = fakeClock(1000)
+    s3_client = boto3.client('s3')
+    stubber = Stubber(s3_client)
+    stubber.add_response("get_object", { 'Body': _csv_body('image_tag,image_type\n"2021.09.25","tomcat"\n'), 'ETag': '"etag1"' },
+        { 'Bucket': 'bucket1', 'Key': 'object_key' })
+    stubber.add_client_error("get_object", service_error_code = "304", http_status_code = 304,
+        expected_params = { 'Bucket': 'bucket1', 'Key': 'object_key', 'IfNoneMatch': '"etag1"' })
+    stubber.add_response("get_object", { 'Body': _csv_body('image_tag,image_type\n"2021.10.22","python"\n'), 'ETag': '"etag2"' },
+        { 'Bucket': 'bucket1', 'Key': 'object_key', 'IfNoneMatch': '"etag1"' })
+    stubber.activate()
+
+    first_policy = analyzer_instance.get_base_image_policy("bucket1", "object_key", s3_client, ttl_seconds = 60, clock = clock)
+    # within the ttl no s3 call is made
+    clock.now += 30
+    assertions.assertIs(first_policy, analyzer_instance.get_base_image_policy("bucket1", "object_key", s3_client, ttl_seconds = 60, clock = clock))
+    # after the ttl an unchanged object keeps the cached policy
+    clock.now += 60
+    assertions.assertIs(first_policy, analyzer_instance.get_base_image_policy("bucket1", "object_key", s3_client, ttl_seconds = 60, clock = clock))
+    # a changed object is downloaded and recompiled
+    clock.now += 61
+    changed_policy = analyzer_instance.get_base_image_policy("bucket1", "object_key", s3_client, ttl_seconds = 60, clock = clock)
+    stubber.assert_no_pending_responses()
+    stubber.deactivate()
+    clear_base_image_cache()
+
+    assertions.assertTrue(first_policy.matches("2021.09.25"))
+    assertions.assertFalse(changed_policy.matches("2021.09.25"))
+    assertions.assertTrue(changed_policy.matches("2021.10.22"))
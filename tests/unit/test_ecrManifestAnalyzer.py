@@ -0,0 +1,135 @@
+import json
+import pytest
+import boto3
+from botocore.stub import Stubber, ANY
+from ecshelpers.base_image_policy import baseImagePolicy
+from ecshelpers.scan_metrics import metricsCollector
+from ecshelpers.ecr_manifest_analyzer import (ecrManifestAnalyzer, ecrImage, baseLayerIndex, parse_ecr_image, clear_manifest_cache,
+    classify_records_by_manifest)
+
+REGISTRY = "99999999.dkr.ecr.us-east-1.amazonaws.com"
+APP_DIGEST = "sha256:" + "a" * 64
+
+
+def _manifest(layers) -> str:
+    return json.dumps({ 'schemaVersion': 2, 'mediaType': 'application/vnd.docker.distribution.manifest.v2+json',
+        'layers': [{ 'digest': a_layer } for a_layer in layers] })
+
+@pytest.fixture(autouse = True)
+def empty_manifest_cache():
+    clear_manifest_cache()
+    yield
+    clear_manifest_cache()
+
+@pytest.fixture
+def ecr_client():
+    return boto3.client('ecr', region_name = 'us-east-1')
+
+@pytest.fixture
+def analyzer(ecr_client):
+    return ecrManifestAnalyzer(lambda region: ecr_client)
+
+def test_parse_ecr_image(assertions):
+    assertions.assertEqual(ecrImage('99999999', 'us-east-1', 'pets/pets-ui', APP_DIGEST, '1.0'),
+        parse_ecr_image(REGISTRY + "/pets/pets-ui:1.0", APP_DIGEST))
+    assertions.assertEqual(ecrImage('99999999', 'us-east-1', 'pets/pets-ui', '', '1.0'), parse_ecr_image(REGISTRY + "/pets/pets-ui:1.0", 'N/A'))
+    assertions.assertIsNone(parse_ecr_image("docker.io/library/python:3.9"))
+
+def test_base_layer_index_matches_longest_prefix(assertions):
+    index = baseLayerIndex()
+    index.add(('l1',), 'base/os:2021.01.01', False)
+    index.add(('l1', 'l2'), 'base/python:2021.09.25', True)
+    assertions.assertEqual(('base/python:2021.09.25', True), index.match(('l1', 'l2', 'app')))
+    assertions.assertEqual(('base/os:2021.01.01', False), index.match(('l1', 'other', 'app')))
+    assertions.assertIsNone(index.match(('l2', 'app')))
+
+@pytest.mark.parametrize("tags", [ ['2021.09.25', 'latest'], ['latest', '2021.09.25'] ])
+def test_digest_with_a_valid_and_an_invalid_tag_is_valid(assertions, analyzer, ecr_client, tags):
+    stubber = Stubber(ecr_client)
+    stubber.add_response('list_images', { 'imageIds': [ { 'imageDigest': 'sha256:base1', 'imageTag': a_tag } for a_tag in tags ] })
+    stubber.add_response('batch_get_image', { 'images': [
+        { 'imageId': { 'imageDigest': 'sha256:base1' }, 'imageManifest': _manifest(['l1', 'l2']) }] })
+    stubber.activate()
+    index = analyzer.build_base_layer_index([REGISTRY + "/base/python"], baseImagePolicy(['2021.09.25']))
+    stubber.deactivate()
+    assertions.assertEqual(1, len(index))
+    assertions.assertEqual(('base/python:2021.09.25', True), index.match(('l1', 'l2', 'app')))
+
+def test_get_layers_batches_per_repository_and_caches_by_digest(assertions, analyzer, ecr_client):
+    an_image = ecrImage('99999999', 'us-east-1', 'pets/pets-ui', APP_DIGEST, '1.0')
+    stubber = Stubber(ecr_client)
+    stubber.add_response('batch_get_image', { 'images': [{ 'imageId': { 'imageDigest': APP_DIGEST }, 'imageManifest': _manifest(['l1', 'l2']) }] },
+        { 'registryId': '99999999', 'repositoryName': 'pets/pets-ui', 'imageIds': [{ 'imageDigest': APP_DIGEST }], 'acceptedMediaTypes': ANY })
+    stubber.activate()
+    first = analyzer.get_layers([an_image, an_image])
+    # second lookup is served from the cache, the stubber would fail on another call
+    second = analyzer.get_layers([an_image])
+    stubber.deactivate()
+
+    assertions.assertEqual({ an_image: ('l1', 'l2') }, first)
+    assertions.assertEqual(first, second)
+    assertions.assertEqual(1, analyzer.batch_calls)
+
+def test_get_layers_resolves_manifest_lists(assertions, analyzer, ecr_client):
+    child_digest = "sha256:" + "b" * 64
+    manifest_list = json.dumps({ 'manifests': [
+        { 'digest': "sha256:" + "c" * 64, 'platform': { 'os': 'linux', 'architecture': 'arm64' } },
+        { 'digest': child_digest, 'platform': { 'os': 'linux', 'architecture': 'amd64' } }] })
+    stubber = Stubber(ecr_client)
+    stubber.add_response('batch_get_image', { 'images': [{ 'imageId': { 'imageDigest': APP_DIGEST }, 'imageManifest': manifest_list }] })
+    stubber.add_response('batch_get_image', { 'images': [{ 'imageId': { 'imageDigest': child_digest }, 'imageManifest': _manifest(['l1']) }] },
+        { 'registryId': '99999999', 'repositoryName': 'pets/pets-ui', 'imageIds': [{ 'imageDigest': child_digest }], 'acceptedMediaTypes': ANY })
+    stubber.activate()
+    an_image = ecrImage('99999999', 'us-east-1', 'pets/pets-ui', APP_DIGEST, '')
+    layers = analyzer.get_layers([an_image])
+    stubber.deactivate()
+    assertions.assertEqual({ an_image: ('l1',) }, layers)
+
+def test_retagged_images_are_classified_by_layers(assertions, analyzer, ecr_client):
+    stubber = Stubber(ecr_client)
+    stubber.add_response('list_images', { 'imageIds': [
+        { 'imageDigest': 'sha256:base1', 'imageTag': '2021.09.25' }, { 'imageDigest': 'sha256:base2', 'imageTag': '2020.01.01' }] })
+    stubber.add_response('batch_get_image', { 'images': [
+        { 'imageId': { 'imageDigest': 'sha256:base1' }, 'imageManifest': _manifest(['l1', 'l2']) },
+        { 'imageId': { 'imageDigest': 'sha256:base2' }, 'imageManifest': _manifest(['l1', 'old']) }] })
+    stubber.add_response('batch_get_image', { 'images': [
+        { 'imageId': { 'imageDigest': APP_DIGEST }, 'imageManifest': _manifest(['l1', 'old', 'app']) }] })
+    stubber.activate()
+    index = analyzer.build_base_layer_index([REGISTRY + "/base/python"], baseImagePolicy(['2021.09.25']))
+    # the tag claims a valid base but the layers say otherwise
+    records = [{ 'image': REGISTRY + "/pets/pets-ui:1.0_base-2021.09.25", 'imageDigest': APP_DIGEST },
+        { 'image': "docker.io/library/python:3.9", 'imageDigest': 'N/A' }]
+
+    def fallback(unmatched):
+        for a_record in unmatched:
+            a_record['validBaseImage'] = 'tag'
+            yield a_record
+
+    results = list(classify_records_by_manifest(records, analyzer, index, fallback))
+    stubber.deactivate()
+
+    assertions.assertEqual(2, len(index))
+    assertions.assertEqual([False, 'tag'], [a_record['validBaseImage'] for a_record in results])
+
+def test_unreadable_repositories_fall_back_to_the_tag_check(assertions, ecr_client):
+    metrics = metricsCollector()
+    analyzer = ecrManifestAnalyzer(lambda region: ecr_client, metrics = metrics)
+    stubber = Stubber(ecr_client)
+    stubber.add_client_error('list_images', service_error_code = 'RepositoryNotFoundException')
+    stubber.add_client_error('batch_get_image', service_error_code = 'AccessDeniedException')
+    stubber.activate()
+    index = analyzer.build_base_layer_index([REGISTRY + "/base/deleted"], baseImagePolicy(['2021.09.25']))
+    records = [{ 'image': REGISTRY + "/pets/pets-ui:1.0_base-2021.09.25", 'imageDigest': APP_DIGEST }]
+
+    def fallback(unmatched):
+        for a_record in unmatched:
+            a_record['validBaseImage'] = 'tag'
+            yield a_record
+
+    results = list(classify_records_by_manifest(records, analyzer, index, fallback))
+    stubber.assert_no_pending_responses()
+    stubber.deactivate()
+
+    assertions.assertEqual(0, len(index))
+    assertions.assertEqual(['tag'], [a_record['validBaseImage'] for a_record in results])
+    assertions.assertEqual(2, metrics.summary()['counts']['manifestErrors'])
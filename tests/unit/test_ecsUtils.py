@@ -1,11 +1,58 @@
+import asyncio
+import inspect
+import io
 import pytest
+import time
+from botocore.exceptions import ClientError
 from botocore.stub import Stubber
 from ecshelpers.ecs_utils import ecsUtils
+from ecshelpers.ecs_utils_async import asyncEcsUtils, fetch_base_images_from_s3
+from ecshelpers.rate_limiter import adaptiveRateLimiter
+import aws_clients
 import boto3
+import threading
 
 # define some fixtures to make code cleaner
+@pytest.fixture(autouse=True)
+def reset_clients():
+    # ecsUtils instances share one ecs client, don't let one test's stubs leak into the next
+    aws_clients.reset_clients()
+    yield
+    aws_clients.reset_clients()
+
+class syncAdapter:
+    ''' Runs the asyncio backend's coroutines to completion so the same Stubber tests drive both backends.'''
+
+    def __init__(self, async_utils) -> None:
+        self._async_utils = async_utils
+
+    def __getattr__(self, name):
+        attribute = getattr(self._async_utils, name)
+        if inspect.iscoroutinefunction(attribute):
+            return lambda *args, **kwargs: asyncio.run(attribute(*args, **kwargs))
+        return attribute
+
+@pytest.fixture(params = ['sync', 'async'])
+def make_utils(request):
+    created = []
+
+    def factory(max_workers = 4):
+        if request.param == 'sync':
+            return ecsUtils(False, max_workers = max_workers)
+        async_utils = asyncEcsUtils(False, max_concurrency = max_workers)
+        created.append(async_utils)
+        return syncAdapter(async_utils)
+
+    yield factory
+    for a_utils in created:
+        a_utils.close()
+
 @pytest.fixture
-def utils_instance():
+def utils_instance(make_utils):
+    return make_utils()
+
+@pytest.fixture
+def sync_utils_instance():
     return ecsUtils(False)
 
 def test_get_cluster_info_validates_args(assertions, utils_instance):
@@ -112,6 +159,180 @@ def test_get_image_info_for_tasks_invokes_apis_correctly(assertions, utils_insta
     assertions.assertEqual(expected_info, results[0])
 
 
+def test_get_task_arns_follows_next_token(assertions, utils_instance):
+    stubber = Stubber(utils_instance.ecs_client)
+    stubber.add_response('list_tasks',
+        { 'taskArns': [ "arn:aws:ecs:us-west-2:123456789012:task/task1" ], 'nextToken': 'token1' },
+        { 'cluster': 'clusterName1', 'desiredStatus': 'STOPPED' })
+    stubber.add_response('list_tasks',
+        { 'taskArns': [ "arn:aws:ecs:us-west-2:123456789012:task/task2" ] },
+        { 'cluster': 'clusterName1', 'desiredStatus': 'STOPPED', 'nextToken': 'token1' })
+    stubber.activate()
+    results = utils_instance.get_task_arns('clusterName1', "STOPPED")
+    stubber.deactivate()
+    assertions.assertEqual(["arn:aws:ecs:us-west-2:123456789012:task/task1", "arn:aws:ecs:us-west-2:123456789012:task/task2"], results)
+
+def _stub_task_description(task_arn):
+    return {
+        'taskArn': task_arn,
+        'group' : 'service:GtwServiceDef',
+        'clusterArn': 'arn:aws:ecs:us-east-1:123456789012:cluster/TestCluster1',
+        'containers': [ { 'name': task_arn, 'image': 'dockerImage1', 'imageDigest': 'sha256:d5e4' } ]
+    }
+
+def test_get_image_info_for_task_arns_splits_describe_calls_into_batches(assertions, make_utils):
+    utils_instance = make_utils(max_workers = 1)
+    task_arns = ["arn:aws:ecs:us-west-2:123456789012:task/task{0}".format(i) for i in range(150)]
+    stubber = Stubber(utils_instance.ecs_client)
+    stubber.add_response('describe_tasks', { 'tasks': [ _stub_task_description(task_arns[0]) ] }, { 'cluster': 'TestCluster1', 'tasks': task_arns[:100] })
+    stubber.add_response('describe_tasks', { 'tasks': [ _stub_task_description(task_arns[100]) ] }, { 'cluster': 'TestCluster1', 'tasks': task_arns[100:] })
+    stubber.activate()
+    results = utils_instance.get_image_info_for_task_arns('TestCluster1', task_arns)
+    stubber.assert_no_pending_responses()
+    stubber.deactivate()
+    assertions.assertEqual([task_arns[0], task_arns[100]], [a_result['name'] for a_result in results])
+
+def test_get_image_info_for_task_arns_runs_batches_concurrently(assertions, make_utils):
+    utils_instance = make_utils(max_workers = 4)
+    task_arns = ["arn:aws:ecs:us-west-2:123456789012:task/task{0}".format(i) for i in range(350)]
+    stubber = Stubber(utils_instance.ecs_client)
+    for batch_start in range(0, 350, 100):
+        stubber.add_response('describe_tasks', { 'tasks': [ _stub_task_description(task_arns[batch_start]) ] })
+    stubber.activate()
+    results = utils_instance.get_image_info_for_task_arns('TestCluster1', task_arns)
+    stubber.assert_no_pending_responses()
+    stubber.deactivate()
+    assertions.assertEqual(4, len(results))
+
+
+def test_get_cluster_arns_follows_next_token(assertions, utils_instance):
+    stubber = Stubber(utils_instance.ecs_client)
+    stubber.add_response('list_clusters', { 'clusterArns': [ 'arn:aws:ecs:us-east-1:123456789012:cluster/Cluster1' ], 'nextToken': 'token1' }, {})
+    stubber.add_response('list_clusters', { 'clusterArns': [ 'arn:aws:ecs:us-east-1:123456789012:cluster/Cluster2' ] }, { 'nextToken': 'token1' })
+    stubber.activate()
+    results = utils_instance.get_cluster_arns()
+    stubber.deactivate()
+    assertions.assertEqual(['arn:aws:ecs:us-east-1:123456789012:cluster/Cluster1', 'arn:aws:ecs:us-east-1:123456789012:cluster/Cluster2'], results)
+
+def test_iter_image_info_for_clusters_yields_fast_clusters_before_slow_ones(assertions, sync_utils_instance, monkeypatch):
+    utils_instance = sync_utils_instance
+    slow_cluster_released = threading.Event()
+
+    def fake_get_image_info_for_tasks(cluster_name, task_status):
+        if cluster_name == 'SlowCluster':
+            slow_cluster_released.wait(5)
+        return [ { 'name': cluster_name } ]
+
+    monkeypatch.setattr(utils_instance, 'get_image_info_for_tasks', fake_get_image_info_for_tasks)
+    results = utils_instance.iter_image_info_for_clusters('STOPPED', ['SlowCluster', 'FastCluster'])
+    assertions.assertEqual('FastCluster', next(results)[0])
+    slow_cluster_released.set()
+    assertions.assertEqual(('SlowCluster', [ { 'name': 'SlowCluster' } ]), next(results))
+
+def test_get_image_info_for_all_clusters_skips_failed_clusters(assertions, sync_utils_instance, monkeypatch):
+    utils_instance = sync_utils_instance
+    def fake_get_image_info_for_tasks(cluster_name, task_status):
+        if cluster_name == 'BadCluster':
+            raise RuntimeError("boom")
+        return [ { 'name': cluster_name } ]
+
+    monkeypatch.setattr(utils_instance, 'get_image_info_for_tasks', fake_get_image_info_for_tasks)
+    results = utils_instance.get_image_info_for_all_clusters('STOPPED', ['BadCluster', 'GoodCluster'])
+    assertions.assertEqual([ { 'name': 'GoodCluster' } ], results)
+
+def test_async_get_image_info_for_all_clusters_skips_failed_clusters(assertions, monkeypatch):
+    utils_instance = asyncEcsUtils(False)
+
+    async def fake_get_image_info_for_tasks(cluster_name, task_status):
+        if cluster_name == 'BadCluster':
+            raise RuntimeError("boom")
+        return [ { 'name': cluster_name } ]
+
+    monkeypatch.setattr(utils_instance, 'get_image_info_for_tasks', fake_get_image_info_for_tasks)
+    results = asyncio.run(utils_instance.get_image_info_for_all_clusters('STOPPED', ['BadCluster', 'GoodCluster', 'OtherCluster']))
+    assertions.assertEqual([ { 'name': 'GoodCluster' }, { 'name': 'OtherCluster' } ], results)
+
+class slowEcsClient:
+    ''' describe_tasks takes a while and records how many calls were in flight at once'''
+
+    def __init__(self) -> None:
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def describe_tasks(self, cluster, tasks):
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(0.01)
+        with self._lock:
+            self.in_flight -= 1
+        return { 'tasks': [ _stub_task_description(a_task) for a_task in tasks ] }
+
+def test_async_describe_tasks_is_bounded_by_max_concurrency(assertions):
+    client = slowEcsClient()
+    utils_instance = asyncEcsUtils(False, ecs_client = client, max_concurrency = 3, rate_limiter = adaptiveRateLimiter(rate = None))
+    task_arns = ["arn:aws:ecs:us-west-2:123456789012:task/task{0}".format(i) for i in range(2000)]
+    results = asyncio.run(utils_instance.get_image_info_for_task_arns('TestCluster1', task_arns))
+    utils_instance.close()
+    assertions.assertEqual(task_arns, [a_result['name'] for a_result in results])
+    assertions.assertEqual(3, client.max_in_flight)
+
+def test_parallel_cluster_scans_share_max_workers(assertions, monkeypatch):
+    client = slowEcsClient()
+    utils_instance = ecsUtils(False, ecs_client = client, max_workers = 4, rate_limiter = adaptiveRateLimiter(rate = None))
+    task_arns = ["arn:aws:ecs:us-west-2:123456789012:task/task{0}".format(i) for i in range(400)]
+    monkeypatch.setattr(utils_instance, 'get_image_info_for_tasks',
+        lambda cluster_name, task_status: utils_instance.get_image_info_for_task_arns(cluster_name, task_arns))
+    results = list(utils_instance.iter_image_info_for_clusters('STOPPED', ['Cluster1', 'Cluster2'], max_cluster_workers = 2))
+    assertions.assertEqual([400, 400], [len(cluster_results) for _, cluster_results in results])
+    # 2 clusters at a time with 2 describe threads each, not 2 x 4
+    assertions.assertLessEqual(client.max_in_flight, 4)
+    assertions.assertEqual(4, utils_instance.describe_workers())
+
+class throttlingOnceEcsClient:
+    ''' native coroutine describe_tasks that throttles the first call and records the batches in the order they're sent'''
+
+    def __init__(self) -> None:
+        self.calls = []
+
+    async def describe_tasks(self, cluster, tasks):
+        self.calls.append(tasks[0])
+        if len(self.calls) == 1:
+            raise ClientError({ 'Error': { 'Code': 'ThrottlingException', 'Message': 'Rate exceeded' } }, 'DescribeTasks')
+        return { 'tasks': [ _stub_task_description(a_task) for a_task in tasks ] }
+
+class fixedBackoffRateLimiter(adaptiveRateLimiter):
+    def backoff_seconds(self, attempt) -> float:
+        return 0.05
+
+def test_async_retry_backoff_gives_back_the_concurrency_slot(assertions):
+    client = throttlingOnceEcsClient()
+    utils_instance = asyncEcsUtils(False, ecs_client = client, max_concurrency = 1, rate_limiter = fixedBackoffRateLimiter(rate = None))
+    task_arns = ["arn:aws:ecs:us-west-2:123456789012:task/task{0}".format(i) for i in range(200)]
+    results = asyncio.run(utils_instance.get_image_info_for_task_arns('TestCluster1', task_arns))
+    assertions.assertEqual(task_arns, [a_result['name'] for a_result in results])
+    # the second batch goes out while the first one is backing off
+    assertions.assertEqual([task_arns[0], task_arns[100], task_arns[0]], client.calls)
+
+def test_async_client_pool_is_sized_for_max_concurrency(assertions):
+    session = boto3.Session(aws_access_key_id = 'AKIDASYNC1234567', aws_secret_access_key = 'secret', region_name = 'us-east-1')
+    utils_instance = asyncEcsUtils(False, session = session, max_concurrency = 200)
+    assertions.assertEqual(aws_clients.pool_size_for(200), utils_instance.ecs_client.meta.config.max_pool_connections)
+    # the thread pool backend's shared client keeps its own pool
+    assertions.assertIsNot(utils_instance.ecs_client, ecsUtils(False, session = session).ecs_client)
+
+def test_async_fetch_base_images_from_s3(assertions):
+    s3_client = boto3.client('s3', region_name = 'us-east-1')
+    stubber = Stubber(s3_client)
+    stubber.add_response('get_object', { 'Body': io.BytesIO(b'image_tag,image_type\n"2021.*","python"\n') },
+        { 'Bucket': 'policyBucket', 'Key': 'validBaseImages.csv' })
+    stubber.activate()
+    results = asyncio.run(fetch_base_images_from_s3('policyBucket', 'validBaseImages.csv', s3_client = s3_client))
+    stubber.deactivate()
+    assertions.assertEqual(['2021.*'], results)
+
+
 @pytest.mark.aws_integration
 def test_task_arns_invokes_aws_correctly(assertions, utils_instance):
     results = utils_instance.get_task_arns("TestCluster1", "STOPPED")
@@ -1,11 +1,167 @@
+import csv
+import functools
+import gzip
+import io
 import json
 import pytest
-import sys, os
-
 
 from ecshelpers.ecs_reader import *
+import ecshelpers.ecs_reader as ecs_reader_module
+from docker_image_analyzer import clear_base_image_cache
+from scan_checkpoint import scanCheckpoint
+from scan_coordinator import SHARD_MARKER_SUFFIX
+from scan_engine import scanEngine
+from inspector_findings import findingsIndex
+from ecs_utils import ecsUtils
+from fleet_generator import generate_fleet
+from local_endpoints import localEcsClient, localS3Client
 
 
 def test_do_echo_to_ensure_test_wiring_works(assertions):
     result = do_echo("hello")
     assertions.assertEqual("hello", result)
+
+def test_delta_report_key_adds_suffix_before_extension(assertions):
+    assertions.assertEqual("dockerImagesSecInfo/scanResults1-delta.csv", delta_report_key("dockerImagesSecInfo/scanResults1.csv"))
+
+
+BUCKET_NAME = 'bucket1'
+REPORT_KEY = 'dockerImagesSecInfo/scanResults1.csv'
+
+
+class lambdaContext:
+    aws_request_id = 'request-1'
+
+
+@pytest.fixture
+def fleet():
+    return generate_fleet(cluster_count = 3, task_count = 40, max_containers_per_task = 2, image_count = 10)
+
+@pytest.fixture
+def local_clients(fleet, monkeypatch):
+    clients = { 'ecs': localEcsClient(fleet), 's3': localS3Client({ (BUCKET_NAME, 'validBaseImages.csv'): b'image_tag,image_type\n"2021.*","python"\n' }) }
+    monkeypatch.setattr(ecs_reader_module, 'init_clients', lambda: clients)
+    for a_name in ('SCAN_MODE', 'SCAN_TARGETS', 'REPORT_FORMAT', 'REPORT_PARTITIONED', 'COMPRESS_RESULTS', 'RESULT_SUMMARY_KEY',
+            'RESULT_DELTA_KEY', 'INCLUDE_FINDINGS', 'ANALYSIS_MODE', 'WRITE_SUMMARY'):
+        monkeypatch.delenv(a_name, raising = False)
+    monkeypatch.setenv('BUCKET_NAME', BUCKET_NAME)
+    monkeypatch.setenv('VALID_BASE_IMAGES_KEY', 'validBaseImages.csv')
+    monkeypatch.setenv('RESULT_OUTPUT_KEY', REPORT_KEY)
+    monkeypatch.setenv('SCAN_MAX_WORKERS', '2')
+    clear_base_image_cache()
+    yield clients
+    clear_base_image_cache()
+
+def _container_count(fleet):
+    return sum(len(a_task['containers']) for tasks in fleet.values() for a_task in tasks)
+
+def _read_csv(s3_client, key):
+    return list(csv.DictReader(io.StringIO(s3_client.objects[(BUCKET_NAME, key)].decode('utf-8'))))
+
+def test_handler_full_scan_writes_report_and_summary(assertions, fleet, local_clients, capsys):
+    response = lambda_handler({}, lambdaContext())
+    assertions.assertEqual(200, response['statusCode'])
+    assertions.assertTrue(json.loads(response['body'])['complete'])
+    rows = _read_csv(local_clients['s3'], REPORT_KEY)
+    assertions.assertEqual(_container_count(fleet), len(rows))
+    summary = json.loads(local_clients['s3'].objects[(BUCKET_NAME, 'dockerImagesSecInfo/scanResults1-summary.json')])
+    assertions.assertEqual(len(rows), summary['rows'])
+    assertions.assertEqual(sum(a_row['validBaseImage'] == 'False' for a_row in rows), summary['nonCompliantRows'])
+    assertions.assertIn("wrote {0} rows to {1}".format(len(rows), REPORT_KEY), capsys.readouterr().out)
+
+def test_handler_reports_skipped_task_batches(assertions, fleet, local_clients, monkeypatch):
+    failing_cluster = list(fleet)[0]
+    describe_tasks = local_clients['ecs'].describe_tasks
+
+    def failing_describe_tasks(cluster, tasks, **kwargs):
+        if cluster == failing_cluster:
+            raise RuntimeError("describe failed")
+        return describe_tasks(cluster, tasks, **kwargs)
+
+    monkeypatch.setattr(local_clients['ecs'], 'describe_tasks', failing_describe_tasks)
+    response = json.loads(lambda_handler({}, lambdaContext())['body'])
+    summary = json.loads(local_clients['s3'].objects[(BUCKET_NAME, 'dockerImagesSecInfo/scanResults1-summary.json')])
+    expected_failures = { 'failedTargets': 0, 'failedClusters': 0, 'failedTaskBatches': 1, 'failedTasks': len(fleet[failing_cluster]) }
+    assertions.assertEqual((expected_failures, False), (response['failures'], response['complete']))
+    assertions.assertEqual((expected_failures, False), (summary['failures'], summary['complete']))
+
+class failingTargetSessionPool:
+    ''' can't assume the role in account 222'''
+
+    def get_session(self, account_id, region):
+        if account_id == '222':
+            raise RuntimeError('AccessDenied')
+        return None
+
+def test_handler_target_scan_is_incomplete_when_a_target_fails(assertions, fleet, local_clients, monkeypatch):
+    monkeypatch.setenv('SCAN_TARGETS', '111:us-east-1,222:us-east-1')
+    monkeypatch.setattr(ecs_reader_module, 'get_session_pool', lambda role_name: failingTargetSessionPool())
+    monkeypatch.setattr(ecs_reader_module, 'scanEngine', functools.partial(scanEngine,
+        utils_factory = lambda session, target: ecsUtils(False, ecs_client = local_clients['ecs'])))
+    response = json.loads(lambda_handler({}, lambdaContext())['body'])
+    assertions.assertEqual((1, False), (response['failures']['failedTargets'], response['complete']))
+    # the target that could be scanned is still in the report
+    assertions.assertEqual(_container_count(fleet), len(_read_csv(local_clients['s3'], REPORT_KEY)))
+
+def test_handler_logs_the_key_written_for_the_report_format(assertions, fleet, local_clients, monkeypatch, capsys):
+    monkeypatch.setenv('REPORT_FORMAT', 'jsonl')
+    lambda_handler({}, lambdaContext())
+    body = local_clients['s3'].objects[(BUCKET_NAME, 'dockerImagesSecInfo/scanResults1.jsonl.gz')]
+    assertions.assertEqual(_container_count(fleet), len(gzip.decompress(body).splitlines()))
+    assertions.assertIn("rows to dockerImagesSecInfo/scanResults1.jsonl.gz", capsys.readouterr().out)
+    assertions.assertNotIn((BUCKET_NAME, REPORT_KEY), local_clients['s3'].objects)
+
+def test_handler_partitioned_report_is_named_after_the_request(assertions, fleet, local_clients, monkeypatch):
+    monkeypatch.setenv('REPORT_PARTITIONED', 'true')
+    lambda_handler({}, lambdaContext())
+    partition_keys = [a_key for (_, a_key) in local_clients['s3'].objects if a_key.startswith('dockerImagesSecInfo/scanResults1/dt=')]
+    assertions.assertEqual(len(fleet), len(partition_keys))
+    assertions.assertTrue(all(a_key.endswith('/request-1.csv') for a_key in partition_keys))
+
+def test_handler_incremental_scan_writes_report_delta_and_checkpoint(assertions, fleet, local_clients, monkeypatch):
+    monkeypatch.setenv('SCAN_MODE', 'incremental')
+    monkeypatch.setenv('CHECKPOINT_KEY', 'checkpoint.json.gz')
+    scanCheckpoint().save_to_s3(local_clients['s3'], BUCKET_NAME, 'checkpoint.json.gz')
+    lambda_handler({}, lambdaContext())
+    # first run against an empty checkpoint, every row is new
+    delta_rows = _read_csv(local_clients['s3'], 'dockerImagesSecInfo/scanResults1-delta.csv')
+    assertions.assertEqual(_container_count(fleet), len(_read_csv(local_clients['s3'], REPORT_KEY)))
+    assertions.assertEqual({ 'added' }, { a_row['change'] for a_row in delta_rows })
+    assertions.assertEqual(_container_count(fleet), len(delta_rows))
+    checkpoint = scanCheckpoint.from_bytes(local_clients['s3'].objects[(BUCKET_NAME, 'checkpoint.json.gz')])
+    assertions.assertEqual(sum(len(tasks) for tasks in fleet.values()), checkpoint.task_count())
+    summary = json.loads(local_clients['s3'].objects[(BUCKET_NAME, 'dockerImagesSecInfo/scanResults1-summary.json')])
+    assertions.assertEqual((_container_count(fleet), True), (summary['rows'], summary['complete']))
+
+@pytest.mark.parametrize("name, value", [ ('ANALYSIS_MODE', 'manifest'), ('INCLUDE_FINDINGS', 'true') ])
+def test_handler_incremental_scan_rejects_unsupported_options(local_clients, monkeypatch, name, value):
+    monkeypatch.setenv('SCAN_MODE', 'incremental')
+    monkeypatch.setenv(name, value)
+    with pytest.raises(ValueError, match = 'incremental'):
+        lambda_handler({}, lambdaContext())
+
+def test_handler_shard_scan_writes_partial_report_and_marker(assertions, fleet, local_clients):
+    cluster_arns = list(fleet)[:2]
+    shard_event = { 'shard': { 'shard_id': 0, 'run_id': 'run1', 'account_id': None, 'region': None, 'clusters': cluster_arns,
+        'output_key': 'dockerImagesSecInfo/scanResults1-shards/run1/shard-00000.csv', 'assume_role': False } }
+    lambda_handler(shard_event, lambdaContext())
+    rows = _read_csv(local_clients['s3'], 'dockerImagesSecInfo/scanResults1-shards/run1/shard-00000.csv')
+    expected_rows = sum(len(a_task['containers']) for a_cluster in cluster_arns for a_task in fleet[a_cluster])
+    assertions.assertEqual(expected_rows, len(rows))
+    assertions.assertEqual(set(cluster_arns), { a_row['cluster_arn'] for a_row in rows })
+    marker = json.loads(local_clients['s3'].objects[(BUCKET_NAME, shard_event['shard']['output_key'] + SHARD_MARKER_SUFFIX)])
+    assertions.assertEqual({ 'status': 'ok', 'rows': expected_rows, 'failures': { 'failedTargets': 0, 'failedClusters': 0, 'failedTaskBatches': 0, 'failedTasks': 0 } }, marker)
+
+def test_handler_shard_scan_joins_the_coordinators_findings(assertions, fleet, local_clients, monkeypatch):
+    monkeypatch.setenv('INCLUDE_FINDINGS', 'true')
+    a_task = next(iter(fleet.values()))[0]
+    digest = a_task['containers'][0]['imageDigest']
+    index = findingsIndex.from_findings([{ 'severity': 'HIGH', 'resources': [{ 'details': { 'awsEcrContainerImage': { 'imageHash': digest } } }] }])
+    index.save_to_s3(local_clients['s3'], BUCKET_NAME, 'run1/findings.json.gz')
+    # the shard must not pull the findings itself
+    monkeypatch.setattr(ecs_reader_module, 'pull_findings_index', None)
+    shard_event = { 'shard': { 'shard_id': 0, 'run_id': 'run1', 'account_id': None, 'region': None, 'clusters': [a_task['clusterArn']],
+        'output_key': 'run1/shard-00000.csv', 'assume_role': False, 'findings_key': 'run1/findings.json.gz' } }
+    lambda_handler(shard_event, lambdaContext())
+    rows = _read_csv(local_clients['s3'], 'run1/shard-00000.csv')
+    assertions.assertEqual({ 'HIGH' }, { a_row['maxSeverity'] for a_row in rows if a_row['imageDigest'] == digest })
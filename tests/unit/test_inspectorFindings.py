@@ -0,0 +1,44 @@
+import boto3
+from botocore.stub import Stubber
+from ecshelpers.inspector_findings import findingsIndex, iter_ecr_findings, join_findings, ECR_IMAGE_FILTER
+
+DIGEST_1 = "sha256:" + "1" * 64
+DIGEST_2 = "sha256:" + "2" * 64
+
+
+def _finding(severity, *digests):
+    return { 'severity': severity, 'resources': [{ 'type': 'AWS_ECR_CONTAINER_IMAGE', 'id': 'repo/' + a_digest,
+        'details': { 'awsEcrContainerImage': { 'imageHash': a_digest } } } for a_digest in digests] }
+
+def test_iter_ecr_findings_follows_pagination(assertions):
+    inspector_client = boto3.client('inspector2', region_name = 'us-east-1')
+    stubber = Stubber(inspector_client)
+    stubber.add_response('list_findings', { 'findings': [], 'nextToken': 'page2' }, { 'filterCriteria': ECR_IMAGE_FILTER, 'maxResults': 100 })
+    stubber.add_response('list_findings', { 'findings': [] }, { 'filterCriteria': ECR_IMAGE_FILTER, 'maxResults': 100, 'nextToken': 'page2' })
+    stubber.activate()
+    findings = list(iter_ecr_findings(inspector_client))
+    stubber.assert_no_pending_responses()
+    stubber.deactivate()
+    assertions.assertEqual([], findings)
+
+def test_index_counts_findings_per_digest(assertions):
+    index = findingsIndex.from_findings([_finding('HIGH', DIGEST_1), _finding('CRITICAL', DIGEST_1, DIGEST_2), _finding('LOW', DIGEST_2),
+        _finding('HIGH', DIGEST_1)])
+    assertions.assertEqual(2, len(index))
+    assertions.assertEqual(4, index.finding_count)
+    assertions.assertEqual({ 'cveCount': 3, 'maxSeverity': 'CRITICAL', 'criticalCount': 1, 'highCount': 2, 'mediumCount': 0, 'lowCount': 0 },
+        index.finding_columns(DIGEST_1))
+
+def test_join_findings_adds_columns_to_every_row(assertions):
+    index = findingsIndex.from_findings([_finding('MEDIUM', DIGEST_1)])
+    rows = [{ 'imageDigest': DIGEST_1 }, { 'imageDigest': DIGEST_2 }, { 'imageDigest': 'N/A' }, { 'imageDigest': DIGEST_1 }]
+    joined = list(join_findings(rows, index))
+
+    assertions.assertEqual([1, 0, '', 1], [a_row['cveCount'] for a_row in joined])
+    assertions.assertEqual(['MEDIUM', 'NONE', '', 'MEDIUM'], [a_row['maxSeverity'] for a_row in joined])
+
+def test_index_round_trips_through_bytes(assertions):
+    index = findingsIndex.from_findings([_finding('HIGH', DIGEST_1), _finding('LOW', DIGEST_2)])
+    loaded = findingsIndex.from_bytes(index.to_bytes())
+    assertions.assertEqual((2, 2), (loaded.finding_count, len(loaded)))
+    assertions.assertEqual(index.finding_columns(DIGEST_1), loaded.finding_columns(DIGEST_1))
@@ -0,0 +1,127 @@
+import pytest
+import boto3
+import botocore
+from botocore.stub import Stubber
+from ecshelpers.ecs_utils import ecsUtils
+from ecshelpers.rate_limiter import adaptiveRateLimiter, get_rate_limiter, reset_rate_limiters
+
+
+class fakeTime:
+    ''' clock + sleep pair where sleeping just moves the clock forward '''
+    def __init__(self):
+        self.now = 0.0
+        self.slept = []
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+def _throttling_error():
+    return botocore.exceptions.ClientError({ 'Error': { 'Code': 'ThrottlingException', 'Message': 'Rate exceeded' } }, 'ListTasks')
+
+@pytest.fixture
+def fake_time():
+    return fakeTime()
+
+def test_acquire_waits_once_burst_is_used(assertions, fake_time):
+    limiter = adaptiveRateLimiter(rate = 10, burst = 2, clock = fake_time.clock, sleep = fake_time.sleep)
+    waits = [limiter.acquire() for _ in range(4)]
+    assertions.assertEqual([0.0, 0.0], waits[:2])
+    assertions.assertAlmostEqual(0.1, waits[2])
+    assertions.assertAlmostEqual(0.1, waits[3])
+
+def test_unlimited_limiter_never_waits(assertions, fake_time):
+    limiter = adaptiveRateLimiter(rate = None, clock = fake_time.clock, sleep = fake_time.sleep)
+    assertions.assertEqual([0.0] * 100, [limiter.acquire() for _ in range(100)])
+
+def test_throttled_call_is_retried_and_rate_is_reduced(assertions, fake_time):
+    limiter = adaptiveRateLimiter(rate = 20, burst = 20, clock = fake_time.clock, sleep = fake_time.sleep)
+    responses = [_throttling_error(), _throttling_error(), { 'taskArns': [] }]
+
+    def flaky_call():
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    assertions.assertEqual({ 'taskArns': [] }, limiter.call(flaky_call))
+    stats = limiter.stats()
+    assertions.assertEqual(2, stats['throttles'])
+    assertions.assertEqual(2, stats['retries'])
+    assertions.assertEqual(1, stats['calls'])
+    # halved twice then one additive increase
+    assertions.assertEqual(5.5, stats['rate'])
+
+def test_call_gives_up_after_max_retries(fake_time):
+    limiter = adaptiveRateLimiter(max_retries = 2, clock = fake_time.clock, sleep = fake_time.sleep)
+
+    def always_throttled():
+        raise _throttling_error()
+
+    with pytest.raises(botocore.exceptions.ClientError):
+        limiter.call(always_throttled)
+    assert limiter.stats()['throttles'] == 3
+
+def test_other_errors_are_not_retried(fake_time):
+    limiter = adaptiveRateLimiter(clock = fake_time.clock, sleep = fake_time.sleep)
+
+    def access_denied():
+        raise botocore.exceptions.ClientError({ 'Error': { 'Code': 'AccessDeniedException' } }, 'ListTasks')
+
+    with pytest.raises(botocore.exceptions.ClientError):
+        limiter.call(access_denied)
+    assert limiter.stats()['retries'] == 0
+
+@pytest.mark.parametrize("error", [
+    botocore.exceptions.ClientError({ 'Error': { 'Code': 'ServerException' }, 'ResponseMetadata': { 'HTTPStatusCode': 500 } }, 'ListTasks'),
+    botocore.exceptions.ClientError({ 'Error': { 'Code': 'Unknown' }, 'ResponseMetadata': { 'HTTPStatusCode': 503 } }, 'ListTasks'),
+    botocore.exceptions.ReadTimeoutError(endpoint_url = 'https://ecs.us-east-1.amazonaws.com'),
+    botocore.exceptions.EndpointConnectionError(endpoint_url = 'https://ecs.us-east-1.amazonaws.com') ])
+def test_transient_errors_are_retried_without_slowing_down(assertions, fake_time, error):
+    limiter = adaptiveRateLimiter(rate = 20, burst = 20, clock = fake_time.clock, sleep = fake_time.sleep)
+    responses = [error, { 'taskArns': [] }]
+
+    def flaky_call():
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    assertions.assertEqual({ 'taskArns': [] }, limiter.call(flaky_call))
+    stats = limiter.stats()
+    assertions.assertEqual(1, stats['retries'])
+    assertions.assertEqual(0, stats['throttles'])
+    assertions.assertEqual(20, stats['rate'])
+
+def test_ecs_utils_retries_server_errors(assertions, fake_time):
+    ecs_client = boto3.client('ecs', region_name = 'us-east-1')
+    limiter = adaptiveRateLimiter(clock = fake_time.clock, sleep = fake_time.sleep)
+    utils_instance = ecsUtils(False, ecs_client = ecs_client, rate_limiter = limiter)
+    stubber = Stubber(ecs_client)
+    stubber.add_client_error('list_tasks', service_error_code = 'ServerException', http_status_code = 500)
+    stubber.add_response('list_tasks', { 'taskArns': [ 'arn:aws:ecs:us-east-1:123456789012:task/task1' ] })
+    stubber.activate()
+    results = utils_instance.get_task_arns('clusterName1', 'STOPPED')
+    stubber.deactivate()
+    assertions.assertEqual([ 'arn:aws:ecs:us-east-1:123456789012:task/task1' ], results)
+
+def test_get_rate_limiter_is_shared_per_account_and_region(assertions):
+    reset_rate_limiters()
+    assertions.assertIs(get_rate_limiter('123456789012', 'us-east-1'), get_rate_limiter('123456789012', 'us-east-1'))
+    assertions.assertIsNot(get_rate_limiter('123456789012', 'us-east-1'), get_rate_limiter('123456789012', 'us-west-2'))
+    reset_rate_limiters()
+
+def test_ecs_utils_retries_throttled_calls(assertions, fake_time):
+    limiter = adaptiveRateLimiter(clock = fake_time.clock, sleep = fake_time.sleep)
+    utils_instance = ecsUtils(False, ecs_client = boto3.client('ecs', region_name = 'us-east-1'), rate_limiter = limiter)
+    stubber = Stubber(utils_instance.ecs_client)
+    stubber.add_client_error('list_tasks', service_error_code = 'ThrottlingException')
+    stubber.add_response('list_tasks', { 'taskArns': [ 'task1' ] })
+    stubber.activate()
+    results = utils_instance.get_task_arns('clusterName1', 'STOPPED')
+    stubber.deactivate()
+    assertions.assertEqual([ 'task1' ], results)
+    assertions.assertEqual(1, limiter.stats()['throttles'])
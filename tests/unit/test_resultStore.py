@@ -0,0 +1,80 @@
+import csv
+import io
+import json
+import pytest
+from ecshelpers.result_store import resultStore, account_id_from_arn
+
+CLUSTER_ARN = 'arn:aws:ecs:us-east-1:123456789012:cluster/TestCluster1'
+
+
+def _rows():
+    return [
+        { 'name': 'container1', 'image': 'dockerImage1', 'imageDigest': 'sha256:d5e4', 'group': 'service:Svc1', 'cluster_arn': CLUSTER_ARN,
+            'account_id': '123456789012' },
+        { 'name': 'container2', 'image': 'dockerImage1', 'imageDigest': 'sha256:d5e4', 'group': 'service:Svc1', 'cluster_arn': CLUSTER_ARN,
+            'account_id': '123456789012' },
+    ]
+
+def test_store_behaves_like_a_list_of_dicts(assertions):
+    store = resultStore(_rows())
+    assertions.assertEqual(2, len(store))
+    assertions.assertEqual(_rows(), store)
+    assertions.assertEqual(_rows()[1], store[-1])
+    assertions.assertEqual(_rows(), [dict(a_row) for a_row in store])
+    assertions.assertEqual(['name', 'image', 'imageDigest', 'group', 'cluster_arn', 'account_id'], list(store[0].keys()))
+    assertions.assertEqual('N/A', store[0].get('region', 'N/A'))
+    with pytest.raises(IndexError):
+        store[2]
+
+def test_repeated_values_are_stored_once(assertions):
+    store = resultStore(_rows() * 50)
+    # two names plus the image, digest, group, arn and account shared by every row
+    assertions.assertEqual(7, store.distinct_values())
+
+def test_rows_write_back_to_the_store(assertions):
+    store = resultStore(_rows())
+    store[0]['validBaseImage'] = True
+    store[1].update({ 'validBaseImage': False, 'region': 'us-east-1' })
+    del store[1]['imageDigest']
+
+    assertions.assertIs(True, store[0]['validBaseImage'])
+    assertions.assertNotIn('region', store[0])
+    assertions.assertNotIn('imageDigest', store[1])
+    assertions.assertEqual(False, store[1]['validBaseImage'])
+    assertions.assertEqual('us-east-1', dict(store[1], change = 'added')['region'])
+
+def test_csv_export_matches_dicts(assertions):
+    def export(rows):
+        output = io.StringIO()
+        writer = csv.DictWriter(output, ['account_id', 'name', 'validBaseImage', 'region'], extrasaction = 'ignore')
+        writer.writerows(rows)
+        return output.getvalue()
+
+    rows = [dict(a_row, validBaseImage = True) for a_row in _rows()]
+    assertions.assertEqual(export(rows), export(resultStore(rows)))
+
+def test_unhashable_values_are_stored_uninterned(assertions):
+    store = resultStore([{ 'name': 'container1', 'ports': [80, 443] }, { 'name': 'container2', 'ports': [80, 443] }])
+    store[1]['labels'] = { 'team': 'pets' }
+    assertions.assertEqual([{ 'name': 'container1', 'ports': [80, 443] }, { 'name': 'container2', 'ports': [80, 443], 'labels': { 'team': 'pets' } }],
+        store.to_dicts())
+
+def test_rows_are_json_serializable_dicts(assertions):
+    store = resultStore(_rows())
+    assertions.assertIsInstance(store[0], dict)
+    assertions.assertEqual(json.dumps(_rows()[0]), json.dumps(store[0]))
+    assertions.assertEqual(json.dumps(_rows()), json.dumps(list(store)))
+    assertions.assertEqual(json.dumps(_rows()), json.dumps(store.to_dicts()))
+
+def test_dict_methods_write_back_to_the_store(assertions):
+    store = resultStore(_rows())
+    assertions.assertEqual('sha256:d5e4', store[0].pop('imageDigest'))
+    store[0].setdefault('region', 'us-east-1')
+    store[1].clear()
+    assertions.assertEqual({ 'name': 'container1', 'image': 'dockerImage1', 'group': 'service:Svc1', 'cluster_arn': CLUSTER_ARN,
+        'account_id': '123456789012', 'region': 'us-east-1' }, store[0])
+    assertions.assertEqual({}, store[1])
+
+def test_account_id_from_arn(assertions):
+    assertions.assertEqual('123456789012', account_id_from_arn(CLUSTER_ARN))
+    assertions.assertEqual('unknown', account_id_from_arn('arn:aws:'))
@@ -0,0 +1,179 @@
+import pytest
+import gzip
+import io
+import json
+import boto3
+from botocore.stub import Stubber, ANY
+from ecshelpers.s3_report_writer import (s3MultipartWriter, s3ReportWriter, s3JsonLinesWriter, partitionedReportWriter, create_report_writer,
+    report_key_for_format, MIN_PART_SIZE)
+import ecshelpers.s3_report_writer as s3_report_writer_module
+from ecshelpers.ecs_reader import write_results_to_s3
+
+
+@pytest.fixture
+def s3_client():
+    return boto3.client('s3', region_name='us-east-1')
+
+@pytest.fixture
+def sample_row():
+    return {
+        'account_id': '123456789012', 'name': 'container1', 'group': 'service:Svc1', 'validBaseImage': True,
+        'image': 'dockerImage1', 'imageDigest': 'sha256:d5e4', 'cluster_arn': 'arn:aws:ecs:us-east-1:123456789012:cluster/TestCluster1'
+    }
+
+def test_small_report_is_written_with_single_put(assertions, s3_client, sample_row):
+    stubber = Stubber(s3_client)
+    expected_body = ("name,image\r\n" + "container1,dockerImage1\r\n").encode('utf-8')
+    stubber.add_response('put_object', {}, { 'Bucket': 'bucket1', 'Key': 'report.csv', 'ContentType': 'text/csv', 'Body': expected_body })
+    stubber.activate()
+    with s3ReportWriter('bucket1', 'report.csv', ['name', 'image'], s3_client = s3_client) as report_writer:
+        report_writer.write_row(sample_row)
+    stubber.assert_no_pending_responses()
+    stubber.deactivate()
+    assertions.assertEqual(1, report_writer.rows_written)
+
+def test_large_output_is_uploaded_in_parts(assertions, s3_client):
+    stubber = Stubber(s3_client)
+    stubber.add_response('create_multipart_upload', { 'UploadId': 'upload1' }, { 'Bucket': 'bucket1', 'Key': 'report.csv', 'ContentType': 'text/csv' })
+    stubber.add_response('upload_part', { 'ETag': 'etag1' }, { 'Bucket': 'bucket1', 'Key': 'report.csv', 'UploadId': 'upload1', 'PartNumber': 1, 'Body': ANY })
+    stubber.add_response('upload_part', { 'ETag': 'etag2' }, { 'Bucket': 'bucket1', 'Key': 'report.csv', 'UploadId': 'upload1', 'PartNumber': 2, 'Body': b'tail' })
+    stubber.add_response('complete_multipart_upload', {}, { 'Bucket': 'bucket1', 'Key': 'report.csv', 'UploadId': 'upload1',
+        'MultipartUpload': { 'Parts': [ { 'PartNumber': 1, 'ETag': 'etag1' }, { 'PartNumber': 2, 'ETag': 'etag2' } ] } })
+    stubber.activate()
+    with s3MultipartWriter('bucket1', 'report.csv', s3_client = s3_client, part_size = MIN_PART_SIZE) as output:
+        output.write(b'x' * MIN_PART_SIZE)
+        output.write(b'tail')
+    stubber.assert_no_pending_responses()
+    stubber.deactivate()
+    assertions.assertEqual(MIN_PART_SIZE + 4, output.bytes_written)
+
+def test_multipart_upload_is_aborted_on_error(assertions, s3_client):
+    stubber = Stubber(s3_client)
+    stubber.add_response('create_multipart_upload', { 'UploadId': 'upload1' })
+    stubber.add_client_error('upload_part', service_error_code = 'InternalError')
+    stubber.add_response('abort_multipart_upload', {}, { 'Bucket': 'bucket1', 'Key': 'report.csv', 'UploadId': 'upload1' })
+    stubber.activate()
+    output = s3MultipartWriter('bucket1', 'report.csv', s3_client = s3_client, part_size = MIN_PART_SIZE)
+    output.write(b'x' * MIN_PART_SIZE)
+    with pytest.raises(Exception):
+        output.close()
+    stubber.assert_no_pending_responses()
+    stubber.deactivate()
+
+class recordingS3Client:
+    def __init__(self):
+        self.objects = {}
+
+    def put_object(self, **kwargs):
+        self.objects[kwargs['Key']] = kwargs
+        return {}
+
+def test_compressed_report_is_gzipped(assertions):
+    s3_client = recordingS3Client()
+    output = s3MultipartWriter('bucket1', 'report.csv.gz', s3_client = s3_client, compress = True)
+    output.write("name\r\ncontainer1\r\n")
+    output.close()
+    put_args = s3_client.objects['report.csv.gz']
+    assertions.assertEqual('gzip', put_args['ContentEncoding'])
+    assertions.assertEqual(b"name\r\ncontainer1\r\n", gzip.decompress(put_args['Body']))
+
+def test_write_results_to_s3_streams_rows(assertions, s3_client, sample_row):
+    stubber = Stubber(s3_client)
+    stubber.add_response('put_object', {}, { 'Bucket': 'bucket1', 'Key': 'report.csv', 'ContentType': 'text/csv', 'Body': ANY })
+    stubber.activate()
+    rows_written = write_results_to_s3([ sample_row, sample_row ], 'bucket1', 'report.csv', s3_client = s3_client)
+    stubber.deactivate()
+    assertions.assertEqual(2, rows_written)
+
+def test_json_lines_report_only_has_report_fields(assertions, sample_row):
+    s3_client = recordingS3Client()
+    with s3JsonLinesWriter('bucket1', 'report.jsonl.gz', ['name', 'validBaseImage'], s3_client = s3_client) as report_writer:
+        report_writer.write_rows([ sample_row, sample_row ])
+    put_args = s3_client.objects['report.jsonl.gz']
+    lines = gzip.decompress(put_args['Body']).decode('utf-8').splitlines()
+    assertions.assertEqual('application/x-ndjson', put_args['ContentType'])
+    assertions.assertEqual([{ 'name': 'container1', 'validBaseImage': True }] * 2, [json.loads(a_line) for a_line in lines])
+
+def test_parquet_report_dictionary_encodes_repetitive_columns(assertions, sample_row):
+    parquet = pytest.importorskip('pyarrow.parquet')
+    s3_client = recordingS3Client()
+    field_names = ['account_id', 'name', 'validBaseImage', 'image', 'cluster_arn']
+    with create_report_writer('parquet', 'bucket1', 'report.parquet', field_names, s3_client = s3_client) as report_writer:
+        report_writer.write_rows([ sample_row, dict(sample_row, validBaseImage = 'False') ])
+    parquet_file = parquet.ParquetFile(io.BytesIO(s3_client.objects['report.parquet']['Body']))
+    assertions.assertEqual({ 'account_id': ['123456789012'] * 2, 'name': ['container1'] * 2, 'validBaseImage': [True, False],
+        'image': ['dockerImage1'] * 2, 'cluster_arn': [sample_row['cluster_arn']] * 2 }, parquet_file.read().to_pydict())
+    image_column = parquet_file.metadata.row_group(0).column(field_names.index('image'))
+    assertions.assertIn('RLE_DICTIONARY', image_column.encodings)
+
+def test_partitioned_report_writes_one_object_per_account_and_cluster(assertions, sample_row):
+    s3_client = recordingS3Client()
+    other_cluster = dict(sample_row, cluster_arn = 'arn:aws:ecs:us-east-1:123456789012:cluster/TestCluster2')
+    with partitionedReportWriter('bucket1', 'dockerImagesSecInfo/scanResults1', ['name'], 'jsonl', s3_client = s3_client, compress = True,
+            run_id = 'run1', run_date = '2022-03-01') as report_writer:
+        report_writer.write_rows([ sample_row, other_cluster, sample_row ])
+    assertions.assertEqual(3, report_writer.rows_written)
+    assertions.assertEqual([
+        'dockerImagesSecInfo/scanResults1/dt=2022-03-01/account_id=123456789012/cluster=TestCluster1/run1.jsonl.gz',
+        'dockerImagesSecInfo/scanResults1/dt=2022-03-01/account_id=123456789012/cluster=TestCluster2/run1.jsonl.gz'], sorted(s3_client.objects))
+
+def test_partitioned_report_bounds_open_partitions(assertions, sample_row):
+    s3_client = recordingS3Client()
+    rows = [dict(sample_row, cluster_arn = 'arn:aws:ecs:us-east-1:123456789012:cluster/TestCluster{0}'.format(i % 3)) for i in range(6)]
+    with partitionedReportWriter('bucket1', 'scanResults1', ['name'], s3_client = s3_client, run_id = 'run1', run_date = '2022-03-01',
+            max_open_partitions = 2) as report_writer:
+        for a_row in rows:
+            report_writer.write_row(a_row)
+            assertions.assertLessEqual(len(report_writer.writers), 2)
+    # clusters arrive interleaved, each evicted partition continues in a new part object
+    assertions.assertEqual([
+        'scanResults1/dt=2022-03-01/account_id=123456789012/cluster=TestCluster0/run1-00001.csv',
+        'scanResults1/dt=2022-03-01/account_id=123456789012/cluster=TestCluster0/run1.csv',
+        'scanResults1/dt=2022-03-01/account_id=123456789012/cluster=TestCluster1/run1-00001.csv',
+        'scanResults1/dt=2022-03-01/account_id=123456789012/cluster=TestCluster1/run1.csv',
+        'scanResults1/dt=2022-03-01/account_id=123456789012/cluster=TestCluster2/run1-00001.csv',
+        'scanResults1/dt=2022-03-01/account_id=123456789012/cluster=TestCluster2/run1.csv'], sorted(s3_client.objects))
+    assertions.assertEqual(6, report_writer.rows_written)
+
+def test_partitioned_report_run_ids_are_unique(assertions):
+    first = partitionedReportWriter('bucket1', 'scanResults1', ['name'], s3_client = recordingS3Client())
+    second = partitionedReportWriter('bucket1', 'scanResults1', ['name'], s3_client = recordingS3Client())
+    assertions.assertNotEqual(first.run_id, second.run_id)
+
+class failingPutS3Client(recordingS3Client):
+    ''' fails the put of every key containing failing_part'''
+
+    def __init__(self, failing_part):
+        super().__init__()
+        self.failing_part = failing_part
+
+    def put_object(self, **kwargs):
+        if self.failing_part in kwargs['Key']:
+            raise RuntimeError('put failed')
+        return super().put_object(**kwargs)
+
+    def delete_object(self, Bucket, Key):
+        del self.objects[Key]
+        return {}
+
+def test_partitioned_report_deletes_closed_partitions_when_close_fails(assertions, sample_row):
+    s3_client = failingPutS3Client('TestCluster2')
+    report_writer = partitionedReportWriter('bucket1', 'scanResults1', ['name'], s3_client = s3_client, run_id = 'run1', run_date = '2022-03-01')
+    report_writer.write_rows([ sample_row, dict(sample_row, cluster_arn = 'arn:aws:ecs:us-east-1:123456789012:cluster/TestCluster2') ])
+    with pytest.raises(RuntimeError):
+        report_writer.close()
+    # TestCluster1 was uploaded before TestCluster2 failed, it is deleted again so no partial report is left behind
+    assertions.assertEqual({}, s3_client.objects)
+
+def test_parquet_without_pyarrow_fails_before_writing(monkeypatch):
+    monkeypatch.setattr(s3_report_writer_module, 'pyarrow', None)
+    with pytest.raises(ImportError, match = 'pyarrow'):
+        partitionedReportWriter('bucket1', 'scanResults1', ['name'], 'parquet', s3_client = recordingS3Client())
+
+def test_report_key_for_format(assertions):
+    assertions.assertEqual('scanResults1.jsonl.gz', report_key_for_format('scanResults1.csv', 'jsonl', compress = True))
+    assertions.assertEqual('scanResults1.parquet', report_key_for_format('scanResults1.csv', 'parquet', compress = True))
+
+def test_unknown_report_format_is_rejected():
+    with pytest.raises(ValueError):
+        create_report_writer('xml', 'bucket1', 'report.xml', ['name'], s3_client = recordingS3Client())
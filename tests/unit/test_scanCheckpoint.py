@@ -0,0 +1,144 @@
+import csv
+import io
+import pytest
+import boto3
+import botocore
+from botocore.stub import Stubber
+from ecshelpers.ecs_utils import ecsUtils
+from ecshelpers.docker_image_analyzer import dockerImageAnalyzer
+from ecshelpers.scan_checkpoint import scanCheckpoint, incrementalScanner
+from ecshelpers.ecs_reader import run_incremental_scan
+from ecshelpers.scan_metrics import metricsCollector
+
+
+CLUSTER_ARN = 'arn:aws:ecs:us-east-1:123456789012:cluster/TestCluster1'
+
+def _row(name, image, valid_base_image = None):
+    row = { 'name': name, 'image': image, 'imageDigest': 'sha256:d5e4', 'group': 'service:Svc1', 'cluster_arn': CLUSTER_ARN, 'account_id': '123456789012' }
+    if valid_base_image is not None:
+        row['validBaseImage'] = valid_base_image
+    return row
+
+@pytest.fixture
+def analyzer_instance():
+    return dockerImageAnalyzer(False)
+
+@pytest.fixture
+def utils_instance():
+    return ecsUtils(False, ecs_client = boto3.client('ecs', region_name = 'us-east-1'))
+
+def test_checkpoint_round_trips_through_bytes(assertions):
+    checkpoint = scanCheckpoint({ 'TestCluster1': { 'task1': [ _row('c1', 'repo:1_base-2021.09.25', True), _row('c2', 'repo:1_base-2021.09.25', False) ] } }, 'abc')
+    loaded = scanCheckpoint.from_bytes(checkpoint.to_bytes())
+    assertions.assertEqual(checkpoint.clusters, loaded.clusters)
+    assertions.assertEqual('abc', loaded.policy_fingerprint)
+    assertions.assertEqual(1, loaded.task_count())
+
+def test_load_from_s3_returns_empty_checkpoint_when_missing(assertions):
+    s3_client = boto3.client('s3', region_name = 'us-east-1')
+    stubber = Stubber(s3_client)
+    stubber.add_client_error('get_object', service_error_code = 'NoSuchKey')
+    stubber.activate()
+    checkpoint = scanCheckpoint.load_from_s3(s3_client, 'bucket1', 'checkpoint.json.gz')
+    stubber.deactivate()
+    assertions.assertEqual(0, checkpoint.task_count())
+
+def test_incremental_scan_only_describes_new_tasks(assertions, utils_instance, analyzer_instance):
+    policy = analyzer_instance.compile_base_images([ '2021.09.25' ])
+    previous = scanCheckpoint({ 'TestCluster1': {
+        'task0': [ _row('old', 'repo:1_base-2021.09.25', True) ],
+        'task1': [ _row('kept', 'repo:1_base-2021.09.25', True) ] } }, policy.fingerprint)
+
+    stubber = Stubber(utils_instance.ecs_client)
+    stubber.add_response('list_tasks', { 'taskArns': [ 'task1', 'task2' ] })
+    stubber.add_response('describe_tasks', { 'tasks': [ { 'taskArn': 'task2', 'group': 'service:Svc1', 'clusterArn': CLUSTER_ARN,
+        'containers': [ { 'name': 'new', 'image': 'repo:2_base-2020.01.01', 'imageDigest': 'sha256:ffff' } ] } ] },
+        { 'cluster': 'TestCluster1', 'tasks': [ 'task2' ] })
+    stubber.activate()
+    scanner = incrementalScanner(utils_instance, analyzer_instance, policy, previous)
+    all_rows, added_rows, removed_rows = scanner.scan_cluster('TestCluster1')
+    stubber.assert_no_pending_responses()
+    stubber.deactivate()
+
+    assertions.assertEqual([ 'kept', 'new' ], [ a_row['name'] for a_row in all_rows ])
+    assertions.assertEqual([ ('new', False) ], [ (a_row['name'], a_row['validBaseImage']) for a_row in added_rows ])
+    assertions.assertEqual([ 'old' ], [ a_row['name'] for a_row in removed_rows ])
+    assertions.assertEqual([ 'task1', 'task2' ], list(scanner.next_checkpoint.clusters['TestCluster1'].keys()))
+
+def test_incremental_scan_reclassifies_known_tasks_when_policy_changes(assertions, utils_instance, analyzer_instance):
+    policy = analyzer_instance.compile_base_images([ '2021.10.22' ])
+    previous = scanCheckpoint({ 'TestCluster1': { 'task1': [ _row('kept', 'repo:1_base-2021.09.25', True) ] } }, 'old-fingerprint')
+
+    stubber = Stubber(utils_instance.ecs_client)
+    stubber.add_response('list_tasks', { 'taskArns': [ 'task1' ] })
+    stubber.activate()
+    scanner = incrementalScanner(utils_instance, analyzer_instance, policy, previous)
+    all_rows, added_rows, removed_rows = scanner.scan_cluster('TestCluster1')
+    stubber.deactivate()
+
+    assertions.assertEqual([ False ], [ a_row['validBaseImage'] for a_row in all_rows ])
+    assertions.assertEqual(([], []), (added_rows, removed_rows))
+
+def test_incremental_scan_keeps_previous_rows_when_cluster_fails(assertions, analyzer_instance):
+    utils_instance = ecsUtils(False, ecs_client = boto3.client('ecs', region_name = 'us-east-1'), metrics = metricsCollector())
+    policy = analyzer_instance.compile_base_images([ '2021.09.25' ])
+    previous = scanCheckpoint({ 'TestCluster1': { 'task1': [ _row('kept', 'repo:1_base-2021.09.25', True) ] } }, policy.fingerprint)
+
+    stubber = Stubber(utils_instance.ecs_client)
+    stubber.add_client_error('list_tasks', service_error_code = 'ClusterNotFoundException')
+    stubber.activate()
+    scanner = incrementalScanner(utils_instance, analyzer_instance, policy, previous)
+    all_rows, added_rows, removed_rows = scanner.scan_cluster('TestCluster1')
+    stubber.deactivate()
+
+    assertions.assertEqual([ 'kept' ], [ a_row['name'] for a_row in all_rows ])
+    assertions.assertEqual(previous.clusters['TestCluster1'], scanner.next_checkpoint.clusters['TestCluster1'])
+    # the carried forward rows are stale, the run must not look complete
+    assertions.assertEqual(1, utils_instance.metrics.failure_counts()['failedClusters'])
+
+
+class memoryS3Client:
+    ''' get_object/put_object against a dict of key -> body'''
+
+    def __init__(self) -> None:
+        self.objects = {}
+
+    def put_object(self, **kwargs):
+        self.objects[kwargs['Key']] = kwargs['Body']
+        return {}
+
+    def get_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise botocore.exceptions.ClientError({ 'Error': { 'Code': 'NoSuchKey' } }, 'GetObject')
+        return { 'Body': io.BytesIO(self.objects[Key]) }
+
+def _run_incremental_scan(utils_instance, analyzer_instance, previous_clusters, cluster_arns, task_arns):
+    policy = analyzer_instance.compile_base_images([ '2021.09.25' ])
+    s3_client = memoryS3Client()
+    s3_client.objects['delta.csv'] = b'stale delta from the previous run'
+    scanCheckpoint(previous_clusters, policy.fingerprint).save_to_s3(s3_client, 'bucket1', 'checkpoint.json.gz')
+
+    stubber = Stubber(utils_instance.ecs_client)
+    stubber.add_response('list_clusters', { 'clusterArns': cluster_arns })
+    for a_task_arns in task_arns:
+        stubber.add_response('list_tasks', { 'taskArns': a_task_arns })
+    stubber.activate()
+    checkpoint = run_incremental_scan(utils_instance, analyzer_instance, policy, s3_client, 'bucket1', 'report.csv', 'delta.csv',
+        'checkpoint.json.gz', max_workers = 1)
+    stubber.assert_no_pending_responses()
+    stubber.deactivate()
+    delta_rows = list(csv.DictReader(io.StringIO(s3_client.objects['delta.csv'].decode('utf-8'))))
+    return checkpoint, delta_rows
+
+def test_incremental_scan_writes_an_empty_delta_when_nothing_changed(assertions, utils_instance, analyzer_instance):
+    previous_clusters = { CLUSTER_ARN: { 'task1': [ _row('kept', 'repo:1_base-2021.09.25', True) ] } }
+    _, delta_rows = _run_incremental_scan(utils_instance, analyzer_instance, previous_clusters, [ CLUSTER_ARN ], [ [ 'task1' ] ])
+    assertions.assertEqual([], delta_rows)
+
+def test_incremental_scan_reports_deleted_clusters_as_removed(assertions, utils_instance, analyzer_instance):
+    gone_cluster_arn = 'arn:aws:ecs:us-east-1:123456789012:cluster/GoneCluster'
+    previous_clusters = { CLUSTER_ARN: { 'task1': [ _row('kept', 'repo:1_base-2021.09.25', True) ] },
+        gone_cluster_arn: { 'task9': [ dict(_row('gone', 'repo:1_base-2021.09.25', True), cluster_arn = gone_cluster_arn) ] } }
+    checkpoint, delta_rows = _run_incremental_scan(utils_instance, analyzer_instance, previous_clusters, [ CLUSTER_ARN ], [ [ 'task1' ] ])
+    assertions.assertEqual([ ('removed', 'gone', gone_cluster_arn) ], [ (a_row['change'], a_row['name'], a_row['cluster_arn']) for a_row in delta_rows ])
+    assertions.assertEqual([ CLUSTER_ARN ], list(checkpoint.clusters))
@@ -0,0 +1,146 @@
+import csv
+import gzip
+import io
+import json
+import pytest
+import boto3
+from botocore.stub import Stubber
+
+from ecshelpers.ecs_utils import ecsUtils
+from ecshelpers.docker_image_analyzer import dockerImageAnalyzer
+from ecshelpers.rate_limiter import adaptiveRateLimiter
+from ecshelpers.ecs_reader import run_shard_scan, REPORT_FIELD_NAMES
+from ecshelpers.scan_coordinator import (scanCoordinator, scanShard, localInvoker, lambdaInvoker, build_shards, shard_output_key,
+    shard_findings_key, write_shard_marker)
+from ecshelpers.compliance_summary import complianceSummary
+from ecshelpers.scan_engine import scanTarget
+import base_image_finder as base_image_finder_module
+from fleet_generator import generate_fleet
+from local_endpoints import localEcsClient, localS3Client
+
+BUCKET_NAME = 'bucket'
+REPORT_KEY = 'dockerImagesSecInfo/scanResults1.csv'
+
+
+class noopInvoker:
+    def __init__(self):
+        self.events = []
+
+    def invoke(self, event):
+        self.events.append(event)
+
+@pytest.fixture
+def fleet():
+    return generate_fleet(cluster_count = 7, task_count = 300, max_containers_per_task = 2, image_count = 20)
+
+def _read_report(s3_client, key) -> list:
+    body = s3_client.objects[(BUCKET_NAME, key)]
+    if s3_client.content_encodings.get((BUCKET_NAME, key)) == 'gzip':
+        body = gzip.decompress(body)
+    return list(csv.DictReader(io.StringIO(body.decode('utf-8'))))
+
+def test_build_shards_never_span_targets(assertions):
+    shards = build_shards({ ('111', 'us-east-1'): ['c1', 'c2', 'c3'], ('222', 'us-west-2'): ['c4'] }, shard_size = 2)
+    assertions.assertEqual([
+        scanShard(0, '111', 'us-east-1', ['c1', 'c2']),
+        scanShard(1, '111', 'us-east-1', ['c3']),
+        scanShard(2, '222', 'us-west-2', ['c4'])], shards)
+
+def test_shard_output_key_is_under_the_run_prefix(assertions):
+    assertions.assertEqual("dockerImagesSecInfo/scanResults1-shards/run1/shard-00003.csv", shard_output_key(REPORT_KEY, 'run1', 3))
+
+def test_scatter_gather_merges_every_shard(assertions, fleet):
+    ecs_client = localEcsClient(fleet)
+    s3_client = localS3Client()
+    analyzer = dockerImageAnalyzer(False)
+    policy = analyzer.compile_base_images([ "2021.*" ])
+
+    def ecs_reader_stand_in(event, context):
+        utils_instance = ecsUtils(False, ecs_client = ecs_client, rate_limiter = adaptiveRateLimiter(rate = None))
+        return run_shard_scan(event['shard'], utils_instance, analyzer, policy, s3_client, BUCKET_NAME, max_workers = 2, compress = True)
+
+    invoker = localInvoker(ecs_reader_stand_in, max_workers = 3)
+    compliance_summary = complianceSummary()
+    coordinator = scanCoordinator(invoker, s3_client, BUCKET_NAME, REPORT_KEY, REPORT_FIELD_NAMES, poll_seconds = 0.01, timeout_seconds = 10,
+        summary = compliance_summary)
+    summary = coordinator.run(build_shards({ (None, None): list(fleet.keys()) }, shard_size = 3), 'run1')
+    invoker.close()
+
+    container_count = sum(len(a_task['containers']) for tasks in fleet.values() for a_task in tasks)
+    assertions.assertEqual({ 'run_id': 'run1', 'shards': 3, 'rows': container_count, 'failed': [], 'missing': [],
+        'scanFailures': { 'failedTargets': 0, 'failedClusters': 0, 'failedTaskBatches': 0, 'failedTasks': 0, 'failedShards': 0, 'missingShards': 0 } }, summary)
+    rows = _read_report(s3_client, REPORT_KEY)
+    assertions.assertEqual(container_count, len(rows))
+    assertions.assertEqual(REPORT_FIELD_NAMES, list(rows[0].keys()))
+    assertions.assertEqual(container_count, compliance_summary.rows)
+    assertions.assertEqual(sum(a_row['validBaseImage'] == 'False' for a_row in rows), compliance_summary.non_compliant_rows)
+
+def test_failed_and_missing_shards_are_reported(assertions):
+    s3_client = localS3Client()
+    shards = [scanShard(0, None, None, ['c1']), scanShard(1, None, None, ['c2']), scanShard(2, None, None, ['c3'])]
+
+    def ecs_reader_stand_in(event, context):
+        shard = event['shard']
+        if shard['shard_id'] == 0:
+            s3_client.put_object(Bucket = BUCKET_NAME, Key = shard['output_key'], Body = "name,image\napp,repo:1.0\n")
+            write_shard_marker(s3_client, BUCKET_NAME, shard['output_key'], 1, failures = { 'failedTaskBatches': 1, 'failedTasks': 100 })
+        elif shard['shard_id'] == 1:
+            write_shard_marker(s3_client, BUCKET_NAME, shard['output_key'], 0, ValueError('boom'))
+
+    invoker = localInvoker(ecs_reader_stand_in)
+    coordinator = scanCoordinator(invoker, s3_client, BUCKET_NAME, REPORT_KEY, ['name', 'image'], poll_seconds = 0.01, timeout_seconds = 0.2)
+    summary = coordinator.run(shards, 'run2')
+    invoker.close()
+
+    assertions.assertEqual({ 'run_id': 'run2', 'shards': 3, 'rows': 1, 'failed': [1], 'missing': [2],
+        'scanFailures': { 'failedTaskBatches': 1, 'failedTasks': 100, 'failedShards': 1, 'missingShards': 1 } }, summary)
+    assertions.assertEqual([{ 'name': 'app', 'image': 'repo:1.0' }], _read_report(s3_client, REPORT_KEY))
+
+def test_dispatch_sends_one_event_per_shard(assertions):
+    invoker = noopInvoker()
+    coordinator = scanCoordinator(invoker, localS3Client(), BUCKET_NAME, REPORT_KEY, REPORT_FIELD_NAMES, assume_role = True)
+    output_keys = coordinator.dispatch([scanShard(0, '111', 'us-east-1', ['c1'])], 'run3')
+    assertions.assertEqual({ 0: shard_output_key(REPORT_KEY, 'run3', 0) }, output_keys)
+    assertions.assertEqual([{ 'shard': { 'shard_id': 0, 'run_id': 'run3', 'account_id': '111', 'region': 'us-east-1', 'clusters': ['c1'],
+        'output_key': output_keys[0], 'assume_role': True } }], invoker.events)
+
+def test_dispatch_hands_every_shard_the_findings_key(assertions):
+    invoker = noopInvoker()
+    coordinator = scanCoordinator(invoker, localS3Client(), BUCKET_NAME, REPORT_KEY, REPORT_FIELD_NAMES,
+        findings_key = shard_findings_key(REPORT_KEY, 'run4'))
+    coordinator.dispatch([scanShard(0, None, None, ['c1']), scanShard(1, None, None, ['c2'])], 'run4')
+    assertions.assertEqual(["dockerImagesSecInfo/scanResults1-shards/run4/findings.json.gz"] * 2,
+        [an_event['shard']['findings_key'] for an_event in invoker.events])
+
+def test_lambda_invoker_invokes_asynchronously():
+    lambda_client = boto3.client('lambda', region_name = 'us-east-1')
+    event = { 'shard': { 'shard_id': 0 } }
+    stubber = Stubber(lambda_client)
+    stubber.add_response('invoke', { 'StatusCode': 202 },
+        { 'FunctionName': 'ecs-reader', 'InvocationType': 'Event', 'Payload': json.dumps(event).encode('utf-8') })
+    stubber.activate()
+    lambdaInvoker('ecs-reader', lambda_client).invoke(event)
+    stubber.assert_no_pending_responses()
+    stubber.deactivate()
+
+class targetSessionPool:
+    def get_session(self, account_id, region):
+        return None
+
+class targetEcsUtils:
+    ''' lists one cluster per account, fails for account 222'''
+
+    def __init__(self, verbose_mode = False, session = None, account_id = None) -> None:
+        self.account_id = account_id
+
+    def get_cluster_arns(self) -> list:
+        if self.account_id == '222':
+            raise RuntimeError('AccessDenied')
+        return ['cluster-{0}'.format(self.account_id)]
+
+def test_targets_that_cant_be_listed_are_returned_as_failed(assertions, monkeypatch):
+    monkeypatch.setattr(base_image_finder_module, 'ecsUtils', targetEcsUtils)
+    targets = [scanTarget('111', 'us-east-1'), scanTarget('222', 'us-east-1')]
+    clusters_by_target, failed_targets = base_image_finder_module.list_clusters_by_target(targets, None, targetSessionPool())
+    assertions.assertEqual({ ('111', 'us-east-1'): ['cluster-111'] }, clusters_by_target)
+    assertions.assertEqual([scanTarget('222', 'us-east-1')], failed_targets)
@@ -0,0 +1,111 @@
+import pytest
+import datetime
+import boto3
+from botocore.stub import Stubber
+from ecshelpers.ecs_utils import ecsUtils
+from ecshelpers.scan_engine import scanEngine, scanTarget, assumedRoleSessionPool, parse_scan_targets
+from ecshelpers.scan_metrics import metricsCollector
+
+
+def _assume_role_response(access_key, expiration):
+    return {
+        'Credentials': {
+            'AccessKeyId': access_key,
+            'SecretAccessKey': 'secret',
+            'SessionToken': 'token',
+            'Expiration': expiration
+        }
+    }
+
+class fakeClock:
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def sts_client():
+    return boto3.client('sts', region_name='us-east-1')
+
+@pytest.fixture
+def expiration():
+    return datetime.datetime(2030, 1, 1, tzinfo=datetime.timezone.utc)
+
+def test_parse_scan_targets(assertions):
+    results = parse_scan_targets(" 123456789012:us-east-1, 210987654321:us-west-2 ,")
+    assertions.assertEqual([scanTarget('123456789012', 'us-east-1'), scanTarget('210987654321', 'us-west-2')], results)
+
+def test_parse_scan_targets_rejects_missing_region():
+    with pytest.raises(ValueError):
+        parse_scan_targets("123456789012")
+
+def test_session_pool_caches_credentials_until_close_to_expiry(assertions, sts_client, expiration):
+    clock = fakeClock(expiration.timestamp() - 3600)
+    stubber = Stubber(sts_client)
+    expected_params = { 'RoleArn': 'arn:aws:iam::123456789012:role/ScanRole', 'RoleSessionName': 'ecs-image-scanner', 'DurationSeconds': 3600 }
+    stubber.add_response('assume_role', _assume_role_response('AKIDFIRST1234567', expiration), expected_params)
+    stubber.add_response('assume_role', _assume_role_response('AKIDSECOND123456', expiration), expected_params)
+    stubber.activate()
+    session_pool = assumedRoleSessionPool('ScanRole', sts_client = sts_client, session_factory = dict, clock = clock)
+
+    first_session = session_pool.get_session('123456789012', 'us-east-1')
+    cached_session = session_pool.get_session('123456789012', 'us-west-2')
+    # sessions are reused until their credentials are refreshed
+    assertions.assertIs(cached_session, session_pool.get_session('123456789012', 'us-west-2'))
+    clock.now = expiration.timestamp() - 60
+    refreshed_session = session_pool.get_session('123456789012', 'us-east-1')
+    stubber.assert_no_pending_responses()
+    stubber.deactivate()
+
+    assertions.assertEqual('AKIDFIRST1234567', first_session['aws_access_key_id'])
+    assertions.assertEqual('AKIDFIRST1234567', cached_session['aws_access_key_id'])
+    assertions.assertEqual('us-west-2', cached_session['region_name'])
+    assertions.assertEqual('AKIDSECOND123456', refreshed_session['aws_access_key_id'])
+    assertions.assertIsNot(first_session, refreshed_session)
+
+def test_scan_engine_tags_rows_with_account_and_region(assertions, sts_client, expiration):
+    sts_stubber = Stubber(sts_client)
+    sts_stubber.add_response('assume_role', _assume_role_response('AKIDFIRST1234567', expiration))
+    sts_stubber.add_response('assume_role', _assume_role_response('AKIDSECOND123456', expiration))
+    sts_stubber.activate()
+    session_pool = assumedRoleSessionPool('ScanRole', sts_client = sts_client, session_factory = dict)
+
+    # one stubbed ecs client per target, each with a single cluster and task
+    ecs_stubbers = {}
+    for a_target in [scanTarget('111111111111', 'us-east-1'), scanTarget('222222222222', 'us-west-2')]:
+        ecs_client = boto3.client('ecs', region_name = a_target.region)
+        stubber = Stubber(ecs_client)
+        cluster_arn = 'arn:aws:ecs:{0}:{1}:cluster/Cluster1'.format(a_target.region, a_target.account_id)
+        task_arn = 'arn:aws:ecs:{0}:{1}:task/task1'.format(a_target.region, a_target.account_id)
+        stubber.add_response('list_clusters', { 'clusterArns': [ cluster_arn ] })
+        stubber.add_response('list_tasks', { 'taskArns': [ task_arn ] })
+        stubber.add_response('describe_tasks', { 'tasks': [ {
+            'taskArn': task_arn, 'group': 'service:Svc1', 'clusterArn': cluster_arn,
+            'containers': [ { 'name': 'container1', 'image': 'dockerImage1', 'imageDigest': 'sha256:d5e4' } ] } ] })
+        stubber.activate()
+        ecs_stubbers[a_target] = (ecs_client, stubber)
+
+    engine = scanEngine(session_pool, max_workers = 4,
+        utils_factory = lambda session, target: ecsUtils(False, ecs_client = ecs_stubbers[target][0]))
+    results = engine.scan(list(ecs_stubbers.keys()))
+
+    for _, stubber in ecs_stubbers.values():
+        stubber.assert_no_pending_responses()
+        stubber.deactivate()
+    sts_stubber.deactivate()
+
+    tagged = sorted((a_result['account_id'], a_result['region']) for a_result in results)
+    assertions.assertEqual([('111111111111', 'us-east-1'), ('222222222222', 'us-west-2')], tagged)
+
+def test_scan_engine_skips_targets_that_fail_to_assume_role(assertions, sts_client):
+    sts_stubber = Stubber(sts_client)
+    sts_stubber.add_client_error('assume_role', service_error_code = 'AccessDenied')
+    sts_stubber.activate()
+    session_pool = assumedRoleSessionPool('ScanRole', sts_client = sts_client, session_factory = dict)
+    metrics = metricsCollector()
+    engine = scanEngine(session_pool, max_workers = 2, metrics = metrics)
+    results = engine.scan([scanTarget('111111111111', 'us-east-1')])
+    sts_stubber.deactivate()
+    assertions.assertEqual([], results)
+    assertions.assertEqual(1, metrics.failure_counts()['failedTargets'])
@@ -0,0 +1,127 @@
+import json
+import pytest
+import boto3
+from botocore.stub import Stubber
+from ecshelpers.ecs_utils import ecsUtils
+from ecshelpers.rate_limiter import adaptiveRateLimiter
+import ecshelpers.scan_metrics as scan_metrics_module
+from ecshelpers.scan_metrics import metricsCollector, percentile, reset_metrics
+
+
+class fakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock():
+    return fakeClock()
+
+@pytest.fixture
+def collector(clock):
+    return metricsCollector(clock = clock)
+
+def test_percentile_uses_nearest_rank(assertions):
+    values = list(range(1, 101))
+    assertions.assertEqual(50, percentile(values, 50))
+    assertions.assertEqual(99, percentile(values, 99))
+    assertions.assertEqual(1, percentile([1], 99))
+    assertions.assertEqual(0.0, percentile([], 50))
+
+def test_stage_times_accumulate(assertions, collector, clock):
+    for _ in range(2):
+        with collector.stage('describing'):
+            clock.now += 1.5
+    assertions.assertEqual({ 'describing': 3.0 }, collector.summary()['stage_seconds'])
+
+def test_timed_iter_only_counts_time_producing_items(assertions, collector, clock):
+    def produce():
+        for an_item in range(3):
+            clock.now += 1.0
+            yield an_item
+
+    for _ in collector.timed_iter('listing', produce()):
+        # consumer time is not part of the stage
+        clock.now += 10.0
+    assertions.assertEqual(3.0, collector.summary()['stage_seconds']['listing'])
+
+def test_api_call_records_latency_and_errors(assertions, collector, clock):
+    for latency in (0.01, 0.02, 0.03):
+        with collector.api_call('list_tasks'):
+            clock.now += latency
+    with pytest.raises(ValueError):
+        with collector.api_call('list_tasks'):
+            clock.now += 0.5
+            raise ValueError('boom')
+
+    summary = collector.api_call_summary()['list_tasks']
+    assertions.assertEqual(4, summary['count'])
+    assertions.assertEqual(1, summary['errors'])
+    assertions.assertEqual(20.0, summary['p50_ms'])
+    assertions.assertEqual(500.0, summary['max_ms'])
+
+def test_emit_writes_one_emf_line(assertions, collector, clock):
+    with collector.stage('discovery'):
+        clock.now += 2.0
+    with collector.api_call('describe_tasks'):
+        clock.now += 0.1
+    collector.add_count('rows', 42)
+
+    lines = []
+    collector.emit('TestNamespace', { 'ScanMode': 'full' }, print_fn = lines.append)
+    assertions.assertEqual(1, len(lines))
+    document = json.loads(lines[0])
+    directive = document['_aws']['CloudWatchMetrics'][0]
+    assertions.assertEqual('TestNamespace', directive['Namespace'])
+    assertions.assertEqual([['ScanMode']], directive['Dimensions'])
+    assertions.assertEqual('full', document['ScanMode'])
+    # every declared metric has a value on the document
+    for a_metric in directive['Metrics']:
+        assertions.assertIn(a_metric['Name'], document)
+    assertions.assertEqual(2.0, document['discoverySeconds'])
+    assertions.assertEqual(1, document['describe_tasks.Calls'])
+    assertions.assertEqual(42, document['rows'])
+
+def test_peak_memory_is_only_reported_when_it_was_reset_for_the_run(assertions, collector):
+    summary = collector.summary()
+    assertions.assertIsNone(summary['peak_memory_mb'])
+    assertions.assertGreater(summary['process_peak_memory_mb'], 0.0)
+    document = collector.to_emf()
+    assertions.assertNotIn('PeakMemory', document)
+    assertions.assertEqual(summary['process_peak_memory_mb'], document['ProcessPeakMemory'])
+
+def test_reset_metrics_resets_the_memory_high_water_mark(assertions, tmp_path, monkeypatch):
+    clear_refs = tmp_path / 'clear_refs'
+    status = tmp_path / 'status'
+    status.write_text("Name:\tpython\nVmHWM:\t   10240 kB\nVmRSS:\t    9000 kB\n")
+    monkeypatch.setattr(scan_metrics_module, 'PROC_CLEAR_REFS', str(clear_refs))
+    monkeypatch.setattr(scan_metrics_module, 'PROC_STATUS', str(status))
+    collector = reset_metrics()
+    assertions.assertEqual('5', clear_refs.read_text())
+    assertions.assertEqual(10.0, collector.summary()['peak_memory_mb'])
+    assertions.assertEqual(10.0, collector.to_emf()['PeakMemory'])
+
+def test_reset_metrics_without_proc_only_reports_the_process_peak(assertions, tmp_path, monkeypatch):
+    monkeypatch.setattr(scan_metrics_module, 'PROC_CLEAR_REFS', str(tmp_path / 'missing' / 'clear_refs'))
+    collector = reset_metrics()
+    assertions.assertFalse(collector.track_peak_memory)
+    assertions.assertIsNone(collector.summary()['peak_memory_mb'])
+
+def test_ecs_utils_records_api_calls(assertions):
+    collector = metricsCollector()
+    utils_instance = ecsUtils(False, ecs_client = boto3.client('ecs', region_name = 'us-east-1'),
+        rate_limiter = adaptiveRateLimiter(rate = None, sleep = lambda seconds: None), metrics = collector)
+    stubber = Stubber(utils_instance.ecs_client)
+    stubber.add_client_error('list_clusters', service_error_code = 'ThrottlingException')
+    stubber.add_response('list_clusters', { 'clusterArns': [ 'cluster1' ], 'nextToken': 'page2' })
+    stubber.add_response('list_clusters', { 'clusterArns': [ 'cluster2' ] })
+    stubber.activate()
+    utils_instance.get_cluster_arns()
+    stubber.deactivate()
+
+    summary = collector.summary()
+    assertions.assertEqual(3, summary['api_calls']['list_clusters']['count'])
+    assertions.assertEqual(1, summary['api_calls']['list_clusters']['errors'])
+    assertions.assertEqual(1, summary['counts']['throttles'])
@@ -0,0 +1,107 @@
+import pytest
+import time
+
+from ecshelpers.ecs_utils import ecsUtils
+from ecshelpers.docker_image_analyzer import dockerImageAnalyzer
+from ecshelpers.scan_pipeline import scan_records, run_pipeline, bounded_map
+from ecshelpers.rate_limiter import adaptiveRateLimiter
+from ecshelpers.scan_metrics import metricsCollector
+from fleet_generator import generate_fleet
+from local_endpoints import localEcsClient
+
+
+class listSink:
+    def __init__(self):
+        self.rows = []
+
+    def write_row(self, row):
+        self.rows.append(row)
+
+@pytest.fixture
+def fleet():
+    return generate_fleet(cluster_count = 10, task_count = 2000, max_containers_per_task = 2, image_count = 20)
+
+@pytest.fixture
+def analyzer_instance():
+    return dockerImageAnalyzer(False)
+
+def test_scan_records_streams_every_container(assertions, fleet, analyzer_instance):
+    ecs_client = localEcsClient(fleet)
+    utils_instance = ecsUtils(False, ecs_client = ecs_client, rate_limiter = adaptiveRateLimiter(rate = None))
+    policy = analyzer_instance.compile_base_images([ "2021.*" ])
+    sink = listSink()
+    count = run_pipeline(scan_records(utils_instance, analyzer_instance, policy, list(fleet.keys()), 'STOPPED', max_workers = 4), sink)
+
+    # rows don't carry the task arn, compare the sorted (multiset of) container identities so drops and duplicates both fail
+    expected = sorted((a_task['clusterArn'], a_task['group'], a_container['name'], a_container['image'])
+        for tasks in fleet.values() for a_task in tasks for a_container in a_task['containers'])
+    assertions.assertEqual(len(expected), count)
+    assertions.assertEqual(expected, sorted((a_row['cluster_arn'], a_row['group'], a_row['name'], a_row['image']) for a_row in sink.rows))
+    for a_row in sink.rows:
+        assertions.assertEqual(policy.matches(analyzer_instance.extract_image_info(a_row['image']).base), a_row['validBaseImage'])
+
+def test_scan_records_applies_backpressure(assertions, fleet, analyzer_instance):
+    ecs_client = localEcsClient(fleet)
+    utils_instance = ecsUtils(False, ecs_client = ecs_client, rate_limiter = adaptiveRateLimiter(rate = None))
+    policy = analyzer_instance.compile_base_images([])
+    records = scan_records(utils_instance, analyzer_instance, policy, list(fleet.keys()), 'STOPPED', max_workers = 2, max_records_in_flight = 200)
+    next(records)
+    # give the listing/describing threads time to run ahead as far as they are allowed to
+    time.sleep(0.3)
+    assertions.assertLessEqual(ecs_client.call_counts['describe_tasks'], 3)
+    assertions.assertLessEqual(ecs_client.call_counts['list_tasks'], 6)
+    records.close()
+
+def test_records_in_flight_are_counted_in_containers(assertions, analyzer_instance):
+    # about 10 containers per task, so a 2000 record budget is 2 batches of 100 tasks rather than 20
+    fleet = generate_fleet(cluster_count = 1, task_count = 3000, max_containers_per_task = 19, image_count = 20)
+    ecs_client = localEcsClient(fleet)
+    utils_instance = ecsUtils(False, ecs_client = ecs_client, rate_limiter = adaptiveRateLimiter(rate = None))
+    policy = analyzer_instance.compile_base_images([])
+    records = scan_records(utils_instance, analyzer_instance, policy, list(fleet.keys()), 'STOPPED', max_workers = 4,
+        max_records_in_flight = 2000)
+    next(records)
+    time.sleep(0.3)
+    assertions.assertLessEqual(ecs_client.call_counts['describe_tasks'], 3)
+    records.close()
+
+def test_scan_records_times_each_stage(assertions, fleet, analyzer_instance):
+    metrics = metricsCollector()
+    utils_instance = ecsUtils(False, ecs_client = localEcsClient(fleet), rate_limiter = adaptiveRateLimiter(rate = None), metrics = metrics)
+    policy = analyzer_instance.compile_base_images([ "2021.*" ])
+    count = run_pipeline(scan_records(utils_instance, analyzer_instance, policy, list(fleet.keys()), 'STOPPED', max_workers = 4), listSink(), metrics)
+
+    summary = metrics.summary()
+    assertions.assertEqual({ 'listing', 'describing', 'classification', 'upload' }, set(summary['stage_seconds']))
+    assertions.assertEqual(count, summary['counts']['rows'])
+    assertions.assertEqual(dict(utils_instance.ecs_client.call_counts), { operation: calls['count'] for operation, calls in summary['api_calls'].items() })
+
+class failingDescribeEcsClient(localEcsClient):
+    ''' fails every describe_tasks call for one cluster'''
+
+    def __init__(self, fleet, failing_cluster) -> None:
+        super().__init__(fleet)
+        self.failing_cluster = failing_cluster
+
+    def describe_tasks(self, cluster, tasks, **kwargs) -> dict:
+        if cluster == self.failing_cluster:
+            raise RuntimeError("describe failed")
+        return super().describe_tasks(cluster, tasks, **kwargs)
+
+def test_failed_describe_batches_are_counted(assertions, fleet, analyzer_instance):
+    metrics = metricsCollector()
+    failing_cluster = list(fleet.keys())[0]
+    utils_instance = ecsUtils(False, ecs_client = failingDescribeEcsClient(fleet, failing_cluster), rate_limiter = adaptiveRateLimiter(rate = None),
+        metrics = metrics)
+    policy = analyzer_instance.compile_base_images([ "2021.*" ])
+    sink = listSink()
+    run_pipeline(scan_records(utils_instance, analyzer_instance, policy, list(fleet.keys()), 'STOPPED', max_workers = 4), sink, metrics)
+
+    failed_tasks = len(fleet[failing_cluster])
+    assertions.assertEqual(-(-failed_tasks // 100), metrics.failure_counts()['failedTaskBatches'])
+    assertions.assertEqual(failed_tasks, metrics.failure_counts()['failedTasks'])
+    assertions.assertNotIn(failing_cluster, { a_row['cluster_arn'] for a_row in sink.rows })
+
+def test_bounded_map_keeps_input_order(assertions):
+    results = list(bounded_map(lambda x: x * 2, range(20), max_workers = 4, max_pending = 3))
+    assertions.assertEqual([x * 2 for x in range(20)], results)
@@ -0,0 +1,71 @@
+import csv
+import json
+import pytest
+
+from ecshelpers.ecs_utils import ecsUtils
+from ecshelpers.docker_image_analyzer import dockerImageAnalyzer
+from ecshelpers.rate_limiter import adaptiveRateLimiter
+from ecshelpers.scan_snapshot import record_snapshot, replay_snapshot, load_manifest, snapshotEcsClient, main
+from fleet_generator import generate_fleet
+from local_endpoints import localEcsClient
+
+POLICY_CSV = 'image_tag,image_type\n"2021.*","python"\n'
+
+
+@pytest.fixture
+def fleet():
+    return generate_fleet(cluster_count = 9, task_count = 400, max_containers_per_task = 2, image_count = 30)
+
+@pytest.fixture
+def snapshot_dir(tmp_path, fleet):
+    utils_instance = ecsUtils(False, ecs_client = localEcsClient(fleet), rate_limiter = adaptiveRateLimiter(rate = None))
+    record_snapshot(utils_instance, str(tmp_path / 'snapshot'), base_images_csv = POLICY_CSV, shard_size = 4, max_workers = 2)
+    return str(tmp_path / 'snapshot')
+
+def _row_key(a_row):
+    return (a_row['cluster_arn'], a_row['group'], a_row['name'], a_row['image'], str(a_row['validBaseImage']))
+
+def _read_csv(path):
+    with open(path, newline = '') as report_file:
+        return list(csv.DictReader(report_file))
+
+def test_record_writes_a_manifest_and_shards(assertions, snapshot_dir):
+    manifest = load_manifest(snapshot_dir)
+    assertions.assertEqual(9, manifest['clusters'])
+    assertions.assertEqual(['shard-00000.json.gz', 'shard-00001.json.gz', 'shard-00002.json.gz'], manifest['shards'])
+    assertions.assertEqual('STOPPED', manifest['task_status'])
+
+def test_replay_matches_a_live_scan(assertions, fleet, snapshot_dir, tmp_path):
+    output_path = str(tmp_path / 'scanResults.csv')
+    result = replay_snapshot(snapshot_dir, output_path, processes = 2)
+
+    analyzer = dockerImageAnalyzer(False)
+    policy = analyzer.compile_base_images(["2021.*"])
+    utils_instance = ecsUtils(False, ecs_client = localEcsClient(fleet), rate_limiter = adaptiveRateLimiter(rate = None))
+    live_rows = utils_instance.get_image_info_for_all_clusters('STOPPED')
+    for a_row in live_rows:
+        a_row['validBaseImage'] = policy.matches(analyzer.extract_image_info(a_row['image']).base)
+
+    replayed_rows = _read_csv(output_path)
+    assertions.assertEqual(sorted(map(_row_key, live_rows)), sorted(map(_row_key, replayed_rows)))
+    assertions.assertEqual(len(live_rows), result['rows'])
+    assertions.assertEqual(sum(not a_row['validBaseImage'] for a_row in live_rows), result['nonCompliantRows'])
+    assertions.assertEqual(3, len(result['shards']))
+
+def test_replay_with_a_new_policy(assertions, snapshot_dir, tmp_path):
+    output_path = str(tmp_path / 'scanResults.csv')
+    result = replay_snapshot(snapshot_dir, output_path, base_images_csv = 'image_tag,image_type\n"*","any"\n', processes = 1)
+    assertions.assertEqual(0, result['nonCompliantRows'])
+    assertions.assertTrue(all(a_row['validBaseImage'] == 'True' for a_row in _read_csv(output_path)))
+
+def test_snapshot_client_pages_recorded_tasks(assertions):
+    client = snapshotEcsClient({ 'arn:aws:ecs:us-east-1:123456789012:cluster/c1': { 'task_arn_pages': [['t1', 't2'], ['t3']],
+        'tasks': [{ 'taskArn': 't1' }, { 'taskArn': 't3' }] } })
+    assertions.assertEqual({ 'taskArns': ['t1', 't2'], 'nextToken': '1' }, client.list_tasks(cluster = 'c1', desiredStatus = 'STOPPED'))
+    assertions.assertEqual({ 'taskArns': ['t3'] }, client.list_tasks(cluster = 'c1', desiredStatus = 'STOPPED', nextToken = '1'))
+    assertions.assertEqual([{ 'arn': 't2', 'reason': 'MISSING' }], client.describe_tasks(cluster = 'c1', tasks = ['t1', 't2'])['failures'])
+
+def test_cli_replay(assertions, snapshot_dir, tmp_path, capsys):
+    output_path = str(tmp_path / 'cliResults.csv')
+    assertions.assertEqual(0, main(['replay', snapshot_dir, '--output', output_path, '--processes', '1']))
+    assertions.assertEqual(json.loads(capsys.readouterr().out)['rows'], len(_read_csv(output_path)))
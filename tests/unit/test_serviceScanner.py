@@ -0,0 +1,131 @@
+import threading
+import time
+import pytest
+import boto3
+from botocore.stub import Stubber
+from ecshelpers.ecs_utils import ecsUtils
+from ecshelpers.rate_limiter import adaptiveRateLimiter
+from ecshelpers.service_scanner import serviceScanner, taskDefinitionCache
+
+CLUSTER_ARN = "arn:aws:ecs:us-east-1:123456789012:cluster/TestCluster1"
+TASK_DEFINITION_ARN = "arn:aws:ecs:us-east-1:123456789012:task-definition/sample-core-service:7"
+
+
+@pytest.fixture
+def utils_instance():
+    return ecsUtils(False, ecs_client = boto3.client('ecs', region_name = 'us-east-1'), max_workers = 1,
+        rate_limiter = adaptiveRateLimiter(rate = None))
+
+def _service(name, task_definition_arns):
+    return { 'serviceName': name, 'clusterArn': CLUSTER_ARN,
+        'deployments': [{ 'taskDefinition': an_arn, 'runningCount': 200 } for an_arn in task_definition_arns] }
+
+def _task_definition(image):
+    return { 'taskDefinition': { 'containerDefinitions': [{ 'name': 'app', 'image': image }] } }
+
+def test_scan_cluster_describes_each_task_definition_once(assertions, utils_instance):
+    image = "99999999.dkr.ecr.us-east-1.amazonaws.com/sample-core-service:1.1.1_base-2021.09.25"
+    service_arns = ["arn:aws:ecs:us-east-1:123456789012:service/TestCluster1/svc{0}".format(i) for i in range(12)]
+    stubber = Stubber(utils_instance.ecs_client)
+    stubber.add_response('list_services', { 'serviceArns': service_arns[:10], 'nextToken': 'page2' }, { 'cluster': 'TestCluster1' })
+    stubber.add_response('list_services', { 'serviceArns': service_arns[10:] }, { 'cluster': 'TestCluster1', 'nextToken': 'page2' })
+    # every service runs the same task definition revision
+    stubber.add_response('describe_services', { 'services': [_service('svc{0}'.format(i), [TASK_DEFINITION_ARN]) for i in range(10)] },
+        { 'cluster': 'TestCluster1', 'services': service_arns[:10] })
+    stubber.add_response('describe_services', { 'services': [_service('svc{0}'.format(i), [TASK_DEFINITION_ARN]) for i in range(10, 12)] },
+        { 'cluster': 'TestCluster1', 'services': service_arns[10:] })
+    stubber.add_response('describe_task_definition', _task_definition(image), { 'taskDefinition': TASK_DEFINITION_ARN })
+    stubber.activate()
+    rows = serviceScanner(utils_instance).scan_cluster('TestCluster1')
+    stubber.assert_no_pending_responses()
+    stubber.deactivate()
+
+    assertions.assertEqual(12, len(rows))
+    assertions.assertEqual({ 'name': 'app', 'image': image, 'imageDigest': 'N/A', 'group': 'service:svc0', 'cluster_arn': CLUSTER_ARN,
+        'account_id': '123456789012', 'taskDefinition': TASK_DEFINITION_ARN, 'runningCount': 200 }, rows[0])
+
+def test_cached_task_definitions_are_not_described_again(assertions, utils_instance):
+    cache = taskDefinitionCache({ TASK_DEFINITION_ARN: [('app', 'repo:1.0')] })
+    stubber = Stubber(utils_instance.ecs_client)
+    stubber.add_response('list_services', { 'serviceArns': [ 'svc1' ] })
+    stubber.add_response('describe_services', { 'services': [_service('svc1', [TASK_DEFINITION_ARN])] })
+    stubber.activate()
+    rows = serviceScanner(utils_instance, cache).scan_cluster('TestCluster1')
+    stubber.deactivate()
+
+    assertions.assertEqual([ 'repo:1.0' ], [a_row['image'] for a_row in rows])
+    assertions.assertEqual({ 'entries': 1, 'hits': 1, 'misses': 0 }, cache.stats())
+    assertions.assertFalse(cache.dirty)
+
+def test_concurrent_lookups_share_one_describe(assertions):
+    cache = taskDefinitionCache()
+    calls = []
+
+    def slow_describe(an_arn):
+        calls.append(an_arn)
+        time.sleep(0.05)
+        return { 'containerDefinitions': [{ 'name': 'app', 'image': 'repo:1.0' }] }
+
+    results = []
+    threads = [threading.Thread(target = lambda: results.append(cache.get_containers(TASK_DEFINITION_ARN, slow_describe))) for _ in range(8)]
+    for a_thread in threads:
+        a_thread.start()
+    for a_thread in threads:
+        a_thread.join()
+
+    assertions.assertEqual([TASK_DEFINITION_ARN], calls)
+    assertions.assertEqual([[('app', 'repo:1.0')]] * 8, results)
+    assertions.assertTrue(cache.dirty)
+
+class slowServicesEcsClient:
+    ''' one service per task definition, describe_task_definition takes a while and records how many calls were in flight at once'''
+
+    def __init__(self, task_definition_count) -> None:
+        self.task_definition_count = task_definition_count
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def list_services(self, **kwargs):
+        return { 'serviceArns': [ 'svc{0}'.format(i) for i in range(self.task_definition_count) ] }
+
+    def describe_services(self, cluster, services):
+        # every cluster runs its own task definitions so the cache doesn't dedupe them across clusters
+        return { 'services': [_service(a_service, ['{0}-{1}:1'.format(cluster, a_service)]) for a_service in services] }
+
+    def describe_task_definition(self, taskDefinition):
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(0.01)
+        with self._lock:
+            self.in_flight -= 1
+        return _task_definition('repo:1.0')
+
+def test_parallel_cluster_scans_share_max_workers(assertions):
+    client = slowServicesEcsClient(8)
+    utils_instance = ecsUtils(False, ecs_client = client, max_workers = 4, rate_limiter = adaptiveRateLimiter(rate = None))
+    scanner = serviceScanner(utils_instance, taskDefinitionCache())
+    results = list(utils_instance.iter_image_info_for_clusters('RUNNING', ['Cluster1', 'Cluster2'], max_cluster_workers = 2,
+        scan_cluster = scanner.scan_cluster))
+    assertions.assertEqual([8, 8], [len(cluster_results) for _, cluster_results in results])
+    # 2 clusters at a time with 2 describe threads each, not 2 x 4
+    assertions.assertLessEqual(client.max_in_flight, 4)
+
+def test_unpinned_task_definitions_are_not_cached(assertions):
+    cache = taskDefinitionCache()
+    cache.get_containers('sample-core-service', lambda an_arn: { 'containerDefinitions': [] })
+    assertions.assertEqual(0, len(cache))
+
+def test_cache_round_trips_through_bytes(assertions):
+    cache = taskDefinitionCache({ TASK_DEFINITION_ARN: [('app', 'repo:1.0'), ('sidecar', 'envoy:1.2')] })
+    assertions.assertEqual(cache.entries, taskDefinitionCache.from_bytes(cache.to_bytes()).entries)
+
+def test_load_from_s3_returns_empty_cache_when_missing(assertions):
+    s3_client = boto3.client('s3', region_name = 'us-east-1')
+    stubber = Stubber(s3_client)
+    stubber.add_client_error('get_object', service_error_code = 'NoSuchKey', http_status_code = 404)
+    stubber.activate()
+    cache = taskDefinitionCache.load_from_s3(s3_client, 'bucket', 'taskDefinitionCache.json.gz')
+    stubber.deactivate()
+    assertions.assertEqual(0, len(cache))